@@ -1,6 +1,8 @@
 import os
+import queue
+import threading
 import tkinter as tk
-from tkinter import filedialog, ttk
+from tkinter import filedialog, messagebox, ttk
 from tkinter.constants import DISABLED, NORMAL
 
 from openai import OpenAI
@@ -79,11 +81,22 @@ class DocumentQAApp:
         )
         self.upload_button.pack(side=tk.LEFT, padx=(5, 10), pady=10)
 
+        self.cancel_button = ctk.CTkButton(
+            self.doc_frame,
+            text="Cancel",
+            command=self.cancel_upload,
+        )
+
         self.file_label = ttk.Label(self.doc_frame, text="No document selected")
         self.file_label.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
 
+        self.progress_bar = ttk.Progressbar(self.doc_frame, mode="determinate", length=150)
+
 
         self.vector_stores = []
+        # the upload thread reports to the main loop through this queue, polled with `after`
+        self.upload_events = queue.Queue()
+        self.upload_cancel = threading.Event()
 
         self.client = OpenAI()
         self.LLM = os.environ.get("OPEN_AI_MODEL")
@@ -102,31 +115,75 @@ class DocumentQAApp:
             initialdir=home
         )
 
-        self.file_label.config(text="Uploading files")
-        self.ask_button.configure(state=DISABLED)
-        self.question_entry.configure(state=DISABLED)
-
         if len(file_paths) == 0:
             self.file_label.config(text=f"No document(s) selected")
-            self.ask_button.configure(state=NORMAL)
-            self.question_entry.configure(state=NORMAL)
 
             return
 
-        selected_files = ""
-
+        # questions about the documents already uploaded can still be asked meanwhile
+        self.file_label.config(text="Uploading files")
+        self.upload_button.configure(state=DISABLED)
+        self.cancel_button.configure(state=NORMAL)
+        self.cancel_button.pack(side=tk.LEFT, padx=(0, 10), pady=10)
+        self.progress_bar.configure(maximum=len(file_paths), value=0)
+        self.progress_bar.pack(side=tk.RIGHT, padx=5)
+
+        self.upload_cancel.clear()
+        threading.Thread(target=self.upload_files, args=(file_paths,), daemon=True).start()
+        self.root.after(100, self.poll_upload, len(file_paths), [], [])
+
+    def upload_files(self, file_paths):
+        # runs in the upload thread and never touches the widgets
         for file_path in file_paths:
-            with open(file_path, "rb") as file:
-                uploaded_file = self.client.files.create(file=file, purpose="user_data")
-                self.vector_stores.append(self.client.vector_stores.create(file_ids=[uploaded_file.id]).id)
-
-            filename = os.path.basename(file_path)
-            selected_files += f"{filename}, "
-
-        self.file_label.config(text=f"Selected: {selected_files}")
-
-        self.ask_button.configure(state=NORMAL)
-        self.question_entry.configure(state=NORMAL)
+            if self.upload_cancel.is_set():
+                break
+            self.upload_events.put(("started", file_path, None))
+            try:
+                with open(file_path, "rb") as file:
+                    uploaded_file = self.client.files.create(file=file, purpose="user_data")
+                    vector_store = self.client.vector_stores.create(file_ids=[uploaded_file.id]).id
+                self.upload_events.put(("done", file_path, vector_store))
+            except Exception as e:
+                self.upload_events.put(("failed", file_path, str(e)))
+        self.upload_events.put(("finished", None, None))
+
+    def poll_upload(self, total, selected, errors):
+        while True:
+            try:
+                event, file_path, value = self.upload_events.get_nowait()
+            except queue.Empty:
+                break
+
+            if event == "started":
+                self.file_label.config(
+                    text=f"Uploading {int(self.progress_bar['value']) + 1}/{total}: {os.path.basename(file_path)}"
+                )
+            elif event == "done":
+                self.vector_stores.append(value)
+                selected.append(os.path.basename(file_path))
+                self.progress_bar["value"] += 1
+            elif event == "failed":
+                errors.append(f"{os.path.basename(file_path)}: {value}")
+                self.progress_bar["value"] += 1
+            else:
+                selected_files = "".join(f"{filename}, " for filename in selected)
+                cancelled = " (upload cancelled)" if self.upload_cancel.is_set() else ""
+                failed = f" ({len(errors)} failed)" if errors else ""
+                self.file_label.config(text=f"Selected: {selected_files}{cancelled}{failed}")
+                self.progress_bar.pack_forget()
+                self.cancel_button.pack_forget()
+                self.upload_button.configure(state=NORMAL)
+                if errors:
+                    messagebox.showerror("Upload failed", "Could not upload:\n" + "\n".join(errors))
+                return
+
+        self.root.after(100, self.poll_upload, total, selected, errors)
+
+    def cancel_upload(self):
+        # the file being uploaded is finished, the remaining ones are skipped
+        self.upload_cancel.set()
+        self.cancel_button.configure(state=DISABLED)
+        self.file_label.config(text="Cancelling upload")
 
     def retrieve_relevant_contexts(self, query, top_k=0.3):
         responses = []
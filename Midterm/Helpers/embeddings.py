@@ -0,0 +1,520 @@
+import asyncio
+import collections
+import hashlib
+import itertools
+import os
+import random
+import threading
+import time
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Tuple
+
+import numpy as np
+from openai import (APIConnectionError, AsyncOpenAI, BadRequestError, InternalServerError, OpenAI,
+                    RateLimitError)
+
+from Midterm.embedding_cache import EmbeddingCache
+from Midterm.Helpers.text import Chunk, approximate_tokens
+from Midterm.sqlite_DB import VectorDB, content_hash
+
+
+class EmbeddingBatcher:
+    """
+    Embeds many texts with as few requests as possible: texts are packed into requests of at most
+    `max_items` inputs and `max_tokens` estimated tokens, and the embeddings are mapped back to
+    their texts by the index the API returns. When a request is rejected (e.g. because the
+    estimate was too low) or comes back incomplete, the batch is split in half and retried, so
+    one bad input only fails itself.
+
+    With a `cache`, texts embedded before (by any batcher using the same cache file) are served
+    from it, and only the others are requested.
+    """
+
+    def __init__(self, client: OpenAI, model: str = "text-embedding-3-large", max_items: int = 512,
+                 max_tokens: int = 200000, count_tokens: Callable[[str], int] = approximate_tokens,
+                 dimensions: int = None, cache: EmbeddingCache = None, cache_window: int = 4096):
+        """
+        Args:
+            client (OpenAI):
+                An OpenAI client instance used to generate text embeddings.
+            model (str):
+                Embedding model.
+            max_items (int):
+                Maximum number of inputs per request (the API allows 2048).
+            max_tokens (int):
+                Maximum number of tokens per request (the API allows 300,000).
+            count_tokens (Callable[[str], int]):
+                Token counter, e.g. a tiktoken encoder's `lambda text: len(encoding.encode(text))`.
+            dimensions (int):
+                Number of dimensions requested from the API, by default the model's full size.
+            cache (EmbeddingCache):
+                Persistent cache of embeddings, see Midterm.embedding_cache.
+            cache_window (int):
+                Number of texts looked up in the cache together.
+        """
+        self.client = client
+        self.model = model
+        self.max_items = max_items
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens
+        self.dimensions = dimensions
+        self.cache = cache
+        self.cache_window = cache_window
+        self.requests = 0
+        self.splits = 0
+
+    def _create_options(self) -> dict:
+        options = {"model": self.model}
+        if self.dimensions is not None:
+            options["dimensions"] = self.dimensions
+        return options
+
+    def _batches(self, texts: Iterable[str]) -> Iterator[List[str]]:
+        batch = []
+        tokens = 0
+        for text in texts:
+            text_tokens = self.count_tokens(text)
+            if batch and (len(batch) >= self.max_items or tokens + text_tokens > self.max_tokens):
+                yield batch
+                batch = []
+                tokens = 0
+            batch.append(text)
+            tokens += text_tokens
+        if batch:
+            yield batch
+
+    def _embed_batch(self, texts: List[str]) -> List[np.ndarray]:
+        """
+        Embeds one batch, splitting it in half on a rejected or incomplete response.
+        """
+        try:
+            self.requests += 1
+            res = self.client.embeddings.create(input=texts, **self._create_options())
+            embeddings = {item.index: np.array(item.embedding) for item in res.data}
+        except BadRequestError:
+            if len(texts) == 1:
+                raise
+            embeddings = {}
+        if len(embeddings) == len(texts) and all(i in embeddings for i in range(len(texts))):
+            return [embeddings[i] for i in range(len(texts))]
+        if len(texts) == 1:
+            raise ValueError("The embeddings response did not contain the requested input")
+
+        self.splits += 1
+        half = len(texts) // 2
+        return self._embed_batch(texts[:half]) + self._embed_batch(texts[half:])
+
+    def _embed_uncached(self, texts: Iterable[str]) -> Iterator[np.ndarray]:
+        # the texts of one request are read, embedded and yielded before the next request is made
+        for batch in self._batches(texts):
+            yield from self._embed_batch(batch)
+
+    def embed_iter(self, texts: Iterable[str]) -> Iterator[np.ndarray]:
+        """
+        Embeds texts lazily, a batch (or with a cache, `cache_window` texts) at a time. With a
+        cache, every text is looked up first; the missing ones are embedded once each, even if
+        repeated, and stored in the cache.
+
+        Args:
+            texts (Iterable[str]):
+                Texts to embed, e.g. a generator.
+
+        Returns:
+            An iterator over the embeddings, in the order of the texts.
+        """
+        if self.cache is None:
+            yield from self._embed_uncached(texts)
+            return
+        dimensions = self.dimensions or 0
+        iterator = iter(texts)
+        while part := list(itertools.islice(iterator, self.cache_window)):
+            hashes = [content_hash(text) for text in part]
+            found = self.cache.get_many(self.model, dimensions, hashes)
+            missing = {}
+            for text, text_hash in zip(part, hashes):
+                if text_hash not in found:
+                    missing.setdefault(text_hash, text)
+            if missing:
+                embedded = dict(zip(missing, self._embed_uncached(missing.values())))
+                self.cache.put_many(self.model, dimensions, embedded)
+                found.update(embedded)
+            for text_hash in hashes:
+                yield found[text_hash]
+
+    def embed(self, texts: Iterable[str]) -> List[np.ndarray]:
+        """
+        Embeds texts, see `embed_iter`.
+
+        Args:
+            texts (Iterable[str]):
+                Texts to embed.
+
+        Returns:
+            The embeddings, in the order of the texts.
+        """
+        return list(self.embed_iter(texts))
+
+
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute budgets as two token buckets that refill
+    continuously, for use from one asyncio event loop.
+    """
+
+    def __init__(self, rpm: int, tpm: int):
+        """
+        Args:
+            rpm (int):
+                Requests per minute.
+            tpm (int):
+                Tokens per minute.
+        """
+        self.capacity = (float(rpm), float(tpm))
+        self.available = list(self.capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        for i, capacity in enumerate(self.capacity):
+            self.available[i] = min(capacity, self.available[i] + elapsed * capacity / 60)
+
+    async def acquire(self, tokens: int):
+        """
+        Waits until one request with `tokens` tokens fits in both budgets, and takes it from them.
+
+        Args:
+            tokens (int):
+                Tokens of the request; requests larger than the whole budget wait for a full one.
+        """
+        wanted = (1.0, min(float(tokens), self.capacity[1]))
+        while True:
+            self._refill()
+            if all(available >= amount for available, amount in zip(self.available, wanted)):
+                self.available = [available - amount for available, amount in zip(self.available, wanted)]
+                return
+            await asyncio.sleep(max(
+                (amount - available) * 60 / capacity
+                for available, amount, capacity in zip(self.available, wanted, self.capacity)
+            ))
+
+    def refund(self, tokens: int):
+        """
+        Returns tokens that were taken by `acquire` but not used, e.g. when the estimate was too high.
+        """
+        self._refill()
+        self.available[1] = min(self.capacity[1], self.available[1] + tokens)
+
+
+class AsyncEmbeddingPipeline(EmbeddingBatcher):
+    """
+    An EmbeddingBatcher that keeps up to `concurrency` batch requests in flight with AsyncOpenAI,
+    within requests-per-minute and tokens-per-minute budgets. Rate-limited (429), server (5xx) and
+    connection errors are retried with exponential backoff and full jitter, honoring Retry-After.
+
+    Requests run on an event loop in a background thread shared by every caller, so several files
+    ingested at once (from several threads) share one set of budgets, and throughput is bounded
+    by the rate limits rather than by the latency of single requests. `embed_iter` still yields the
+    embeddings in the order of the texts, so it can feed VectorDB.bulk_insert directly.
+    """
+
+    def __init__(self, client: AsyncOpenAI, model: str = "text-embedding-3-large", max_items: int = 512,
+                 max_tokens: int = 200000, count_tokens: Callable[[str], int] = approximate_tokens,
+                 concurrency: int = 8, rpm: int = 3000, tpm: int = 1000000, max_retries: int = 6,
+                 base_delay: float = 0.5, max_delay: float = 60.0, dimensions: int = None,
+                 cache: EmbeddingCache = None, cache_window: int = 4096):
+        """
+        Args:
+            client (AsyncOpenAI):
+                An AsyncOpenAI client instance; its own retries are disabled in favour of the pipeline's.
+            model (str), max_items (int), max_tokens (int), count_tokens (Callable[[str], int]):
+                See EmbeddingBatcher.
+            concurrency (int):
+                Maximum number of requests in flight.
+            rpm (int):
+                Requests-per-minute budget of the API key.
+            tpm (int):
+                Tokens-per-minute budget of the API key.
+            max_retries (int):
+                Number of retries of a failed request before the error is raised.
+            base_delay (float):
+                Backoff in seconds before the first retry; it doubles with every retry.
+            max_delay (float):
+                Upper bound of the backoff in seconds.
+            dimensions (int), cache (EmbeddingCache), cache_window (int):
+                See EmbeddingBatcher.
+        """
+        super().__init__(client.with_options(max_retries=0), model, max_items, max_tokens, count_tokens,
+                         dimensions, cache, cache_window)
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rpm, tpm)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = 0
+        self._loop = None
+        self._semaphore = None
+        self._start_lock = threading.Lock()
+
+    def _event_loop(self) -> asyncio.AbstractEventLoop:
+        with self._start_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._semaphore = asyncio.Semaphore(self.concurrency)
+                threading.Thread(target=self._loop.run_forever, name="embedding-pipeline", daemon=True).start()
+            return self._loop
+
+    def _retry_delay(self, attempt: int, error: Exception) -> float:
+        retry_after = getattr(getattr(error, "response", None), "headers", {}).get("retry-after")
+        try:
+            if retry_after is not None:
+                return min(float(retry_after), self.max_delay)
+        except ValueError:
+            pass
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def _request(self, texts: List[str]) -> dict:
+        """
+        Sends one request within the budgets, retrying transient errors.
+
+        Returns:
+            Dict mapping input index to embedding.
+        """
+        tokens = sum(self.count_tokens(text) for text in texts)
+        for attempt in range(self.max_retries + 1):
+            async with self._semaphore:
+                await self.limiter.acquire(tokens)
+                try:
+                    self.requests += 1
+                    res = await self.client.embeddings.create(input=texts, **self._create_options())
+                except (RateLimitError, InternalServerError, APIConnectionError) as error:
+                    if attempt == self.max_retries:
+                        raise
+                    delay = self._retry_delay(attempt, error)
+                else:
+                    usage = getattr(res, "usage", None)
+                    if usage is not None and usage.total_tokens < tokens:
+                        self.limiter.refund(tokens - usage.total_tokens)
+                    return {item.index: np.array(item.embedding) for item in res.data}
+            self.retries += 1
+            await asyncio.sleep(delay)
+
+    async def _embed_batch_async(self, texts: List[str]) -> List[np.ndarray]:
+        """
+        Embeds one batch, splitting it in half on a rejected or incomplete response; the halves
+        are requested concurrently.
+        """
+        try:
+            embeddings = await self._request(texts)
+        except BadRequestError:
+            if len(texts) == 1:
+                raise
+            embeddings = {}
+        if len(embeddings) == len(texts) and all(i in embeddings for i in range(len(texts))):
+            return [embeddings[i] for i in range(len(texts))]
+        if len(texts) == 1:
+            raise ValueError("The embeddings response did not contain the requested input")
+
+        self.splits += 1
+        half = len(texts) // 2
+        first, second = await asyncio.gather(self._embed_batch_async(texts[:half]),
+                                             self._embed_batch_async(texts[half:]))
+        return first + second
+
+    def _submit(self, texts: List[str]):
+        return asyncio.run_coroutine_threadsafe(self._embed_batch_async(texts), self._event_loop())
+
+    def _embed_batch(self, texts: List[str]) -> List[np.ndarray]:
+        return self._submit(texts).result()
+
+    def _embed_uncached(self, texts: Iterable[str]) -> Iterator[np.ndarray]:
+        # up to `concurrency` requests in flight for this caller; the embeddings are yielded in the
+        # order of the texts as soon as every earlier batch has completed
+        pending = collections.deque()
+        try:
+            for batch in self._batches(texts):
+                pending.append(self._submit(batch))
+                # bounds the number of embedded but not yet consumed batches held in memory
+                while len(pending) > self.concurrency:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            # a caller that stops consuming (e.g. a cancelled ingestion) does not wait for, or pay for, the rest
+            for future in pending:
+                future.cancel()
+
+    def close(self):
+        """
+        Stops the event loop thread.
+        """
+        with self._start_lock:
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._loop = None
+
+
+def file_fingerprint(file_path: str) -> str:
+    """
+    Computes the SHA-256 of a file's contents.
+
+    Args:
+        file_path (str):
+            Path of the file.
+
+    Returns:
+        The hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class IngestionCancelled(Exception):
+    """
+    Raised by `store_chunks` when its `cancel` event is set.
+    """
+
+
+class FileState(NamedTuple):
+    """
+    The hash of a file's contents, and its size and modification time, see `check_file`.
+    """
+    fingerprint: str
+    size: int
+    mtime: float
+
+
+def check_file(db: VectorDB, file_path: str) -> Tuple[dict, FileState]:
+    """
+    Checks whether a file was already ingested with the same contents, in which case it does
+    not need to be parsed or embedded again. A file whose size and modification time are those
+    recorded is not even read; otherwise it is hashed and compared with the recorded fingerprint.
+
+    Args:
+        db (VectorDB):
+            The vector database.
+        file_path (str):
+            Path of the file.
+
+    Returns:
+        Statistics reporting every chunk of the file as reused if it is unchanged, otherwise None;
+        and the file's current state, to be recorded once it is ingested.
+    """
+    filename = os.path.basename(file_path)
+    stat = os.stat(file_path)
+    ingested = db.ingested_file(filename)
+    if ingested is not None and (ingested.size, ingested.mtime) == (stat.st_size, stat.st_mtime):
+        state = FileState(ingested.fingerprint, stat.st_size, stat.st_mtime)
+    else:
+        state = FileState(file_fingerprint(file_path), stat.st_size, stat.st_mtime)
+        if ingested is None or ingested.fingerprint != state.fingerprint:
+            return None, state
+        # touched but unchanged: the new modification time spares hashing it next time
+        db.record_file(filename, state.fingerprint, ingested.chunks, state.size, state.mtime)
+    chunks = ingested.chunks
+    return {"rows": 0, "skipped": chunks, "embedded": 0, "reused": chunks, "requests": 0,
+            "file_skipped": True}, state
+
+
+def store_chunks(client: OpenAI, db: VectorDB, filename: str, chunks: Iterable, state: FileState,
+                 batcher: EmbeddingBatcher = None, window: int = 4096, pages: List[Tuple[int, str]] = None,
+                 progress: Callable[[int], None] = None, cancel: threading.Event = None) -> dict:
+    """
+    Embeds the chunks of a file and synchronizes them into the vector database with
+    VectorDB.sync_file, in one transaction: when a file is ingested again after a change, its
+    chunks that did not change keep their rows, only the new ones are inserted, and the ones no
+    longer in the file are deleted. Chunks whose text is already stored (under any filename, or
+    earlier in the same file) reuse the stored vector instead of being sent to the embeddings API;
+    the others are embedded in batched requests. The chunks are consumed lazily, `window` at a
+    time, so a chunk generator is never held in memory as a whole.
+
+    Args:
+        client (OpenAI):
+            An OpenAI client instance used to generate text embeddings.
+        db (VectorDB):
+            A vector database instance where the embeddings and associated data will be stored.
+        filename (str):
+            Name the chunks are stored under.
+        chunks (Iterable):
+            Text chunks of the file, as strings or Helpers.text.Chunk records with page numbers.
+        state (FileState):
+            Fingerprint, size and modification time of the file (see `check_file`), recorded once
+            all chunks are stored.
+        batcher (EmbeddingBatcher):
+            Batcher used for the embedding requests, by default one with its default limits.
+        window (int):
+            Number of chunks looked up and embedded together.
+        pages (List[Tuple[int, str]]):
+            (page number, page hash) of the file's pages, recorded with the file; it may be filled
+            while the chunks are consumed, e.g. by Helpers.pdf.iter_pdf_pages.
+        progress (Callable[[int], None]):
+            Called with the number of chunks done so far after every chunk.
+        cancel (threading.Event):
+            When set, the ingestion stops before the next chunk and raises IngestionCancelled. The
+            rows already written are kept, but the file is not recorded as ingested, so the next
+            ingestion of it picks up from them instead of embedding them again.
+
+    Returns:
+        Ingestion statistics from VectorDB.sync_file, plus the number of chunks that were
+        `embedded` and `reused`, and the number of embedding `requests`.
+    """
+    batcher = batcher or EmbeddingBatcher(client)
+    requests = batcher.requests
+    counts = {"embedded": 0, "reused": 0, "chunks": 0}
+    # hashes of the chunks stored for the file by an earlier version; they keep their rows
+    stored = db.file_hashes(filename)
+    # hashes of the chunks already passed on; their repetitions are skipped by the unique index anyway
+    seen = set()
+
+    def embedded_chunks():
+        iterator = iter(chunks)
+        done = 0
+        while True:
+            part = [chunk if isinstance(chunk, Chunk) else Chunk(chunk)
+                    for chunk in itertools.islice(iterator, window)]
+            if not part:
+                return
+            counts["chunks"] += len(part)
+            hashes = [content_hash(chunk.text) for chunk in part]
+            known = db.vectors_by_hash([chunk_hash for chunk_hash in hashes if chunk_hash not in stored])
+
+            # every new text is embedded once, in the order it first occurs
+            new = {}
+            for chunk, chunk_hash in zip(part, hashes):
+                if chunk_hash not in stored and chunk_hash not in known and chunk_hash not in seen:
+                    new.setdefault(chunk_hash, chunk.text)
+            embedded = zip(new, batcher.embed_iter(new.values()))
+
+            for chunk, chunk_hash in zip(part, hashes):
+                if cancel is not None and cancel.is_set():
+                    raise IngestionCancelled(filename)
+                if progress is not None:
+                    progress(done)
+                done += 1
+                if chunk_hash in seen:
+                    counts["reused"] += 1
+                    continue
+                seen.add(chunk_hash)
+                if chunk_hash in stored:
+                    vector = None
+                    counts["reused"] += 1
+                elif chunk_hash in known:
+                    vector = known[chunk_hash]
+                    counts["reused"] += 1
+                else:
+                    vector = next(embedded)[1]
+                    counts["embedded"] += 1
+                chunk_pages = (chunk.page_start, chunk.page_end) if chunk.page_start is not None else None
+                yield vector, chunk.text, None, chunk_pages
+
+    # chunks are written batch by batch as their embeddings arrive, instead of after the whole file
+    stats = db.sync_file(filename, embedded_chunks())
+    if progress is not None:
+        progress(counts["chunks"])
+    db.record_file(filename, state.fingerprint, counts.pop("chunks"), state.size, state.mtime, pages)
+    stats.update(counts)
+    stats["requests"] = batcher.requests - requests
+    return stats
@@ -0,0 +1,434 @@
+import collections
+import os
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Tuple
+
+import PyPDF2
+from openai import OpenAI
+
+from Midterm.Helpers.embeddings import EmbeddingBatcher, IngestionCancelled, check_file, store_chunks
+from Midterm.Helpers.pdf import pdf_page_hash
+from Midterm.Helpers.text import Chunk, split_tokens
+from Midterm.Helpers.txt import iter_text_blocks
+from Midterm.sqlite_DB import VectorDB
+
+# seconds between checks of the `cancel` event while waiting for work units
+POLL_INTERVAL = 0.1
+
+
+class ChunkStream:
+    """
+    The chunks of a file in document order, handed over work unit by work unit as the process
+    pool finishes them (see `parse_documents`), so that storing a file starts before all of it is
+    parsed and only the chunks of finished units that were not consumed yet are held. The parser
+    submits a file's units only a few ahead of the consumer (see `consumed`), so their number
+    stays bounded when storing is slower than parsing.
+    """
+
+    def __init__(self, file_path: str, pages: int, units: int):
+        """
+        Args:
+            file_path (str):
+                The file.
+            pages (int):
+                Number of pages of the file, 1 for a text file.
+            units (int):
+                Number of work units the file is parsed in; with none, e.g. for a PDF without
+                pages, the stream is complete and empty.
+        """
+        self.file_path = file_path
+        # (page number, page hash) of the pages whose chunks were consumed, for VectorDB.record_file
+        self.pages = []
+        self._page_count = pages
+        self._units = units
+        # results of units that finished before an earlier unit of the file, by unit index
+        self._early = {}
+        self._next_unit = 0
+        self._consumed = 0
+        self._closed = False
+        self._chunks_parsed = 0
+        self._pages_parsed = 0
+        self._queue = queue.Queue()
+        if self.complete:
+            self._queue.put(None)
+
+    @property
+    def started(self) -> bool:
+        """
+        Whether the first unit of the file has been handed over.
+        """
+        return self._next_unit > 0
+
+    @property
+    def complete(self) -> bool:
+        """
+        Whether every unit of the file has been handed over.
+        """
+        return self._next_unit == self._units
+
+    @property
+    def consumed(self) -> int:
+        """
+        Number of work units whose chunks the consumer has taken.
+        """
+        return self._consumed
+
+    @property
+    def closed(self) -> bool:
+        """
+        Whether the consumer stopped taking chunks, see `close`.
+        """
+        return self._closed
+
+    def close(self):
+        """
+        Tells the parser that the consumer stopped, e.g. on an error, so the file's remaining units
+        are not parsed.
+        """
+        self._closed = True
+
+    def put(self, unit: int, chunks: List[Chunk], pages: List[Tuple[int, str]]):
+        """
+        Hands over the result of a work unit; units that finish early are held until their turn.
+        """
+        self._early[unit] = (chunks, pages)
+        while self._next_unit in self._early:
+            chunks, pages = self._early.pop(self._next_unit)
+            self._chunks_parsed += len(chunks)
+            self._pages_parsed += max(len(pages), 1)
+            self._queue.put((chunks, pages))
+            self._next_unit += 1
+        if self.complete:
+            self._queue.put(None)
+
+    def fail(self, error: Exception):
+        """
+        Ends the stream with an error, raised by the iteration once the chunks before it are consumed.
+        """
+        self._next_unit = self._units
+        self._queue.put(error)
+
+    def expected_chunks(self) -> int:
+        """
+        Number of chunks of the file: exact once it is parsed, until then estimated from the pages
+        parsed so far.
+        """
+        if self.complete or not self._pages_parsed:
+            return self._chunks_parsed
+        return round(self._chunks_parsed * self._page_count / self._pages_parsed)
+
+    def __iter__(self) -> Iterator[Chunk]:
+        while (item := self._queue.get()) is not None:
+            if isinstance(item, Exception):
+                raise item
+            chunks, pages = item
+            self._consumed += 1
+            self.pages.extend(pages)
+            yield from chunks
+
+
+class ParsedDocument(NamedTuple):
+    """
+    A file whose parsing has started: its chunks, or the error that prevented parsing it, and
+    for a PDF the (page number, page hash) of its pages, filled while the chunks are consumed.
+    """
+    file_path: str
+    chunks: Iterable[Chunk]
+    error: Exception = None
+    pages: List[Tuple[int, str]] = None
+
+
+def pdf_page_count(file_path: str) -> int:
+    """
+    Args:
+        file_path (str):
+            The path to the PDF file.
+
+    Returns:
+        The number of pages of the PDF.
+    """
+    with open(file_path, 'rb') as file:
+        return len(PyPDF2.PdfReader(file).pages)
+
+
+def chunk_pdf_pages(file_path: str, first_page: int, last_page: int) -> Tuple[List[Chunk], List[Tuple[int, str]]]:
+    """
+    Extracts and chunks the text of a range of pages, as one work unit of `parse_documents`.
+
+    Args:
+        file_path (str):
+            The path to the PDF file.
+        first_page (int):
+            First page to extract, numbered from 1.
+        last_page (int):
+            Last page to extract (inclusive).
+
+    Returns:
+        The chunks of the range (see Helpers.text.split_tokens), and the (page number, page hash)
+        of its pages (see Helpers.pdf.pdf_page_hash).
+    """
+    pages = []
+
+    def page_texts():
+        with open(file_path, 'rb') as file:
+            pdf_reader = PyPDF2.PdfReader(file)
+            for page_number in range(first_page, last_page + 1):
+                page = pdf_reader.pages[page_number - 1]
+                pages.append((page_number, pdf_page_hash(page)))
+                # a page break ends a line, not a paragraph: sentences often continue on the next page
+                yield page_number, (page.extract_text() or "") + "\n"
+
+    return list(split_tokens(page_texts())), pages
+
+
+def chunk_text_file(file_path: str) -> Tuple[List[Chunk], List[Tuple[int, str]]]:
+    """
+    Reads and chunks a text file, as one work unit of `parse_documents`.
+
+    Args:
+        file_path (str):
+            The path to the text file.
+
+    Returns:
+        The chunks of the file, and no pages.
+    """
+    return list(split_tokens(iter_text_blocks(file_path))), []
+
+
+def parse_documents(file_paths: Iterable[str], max_workers: int = None, pages_per_unit: int = 50,
+                    max_pending: int = None, units_ahead: int = None,
+                    cancel: threading.Event = None) -> Iterator[ParsedDocument]:
+    """
+    Extracts and chunks PDF and TXT files in a process pool, so that parsing many files (PyPDF2 and
+    the chunker are pure Python and CPU-bound) uses every core. A PDF is split into work units of
+    `pages_per_unit` pages, each extracted and chunked by one process, so a very large PDF is
+    parsed by several processes as well; chunks do not span the pages of two units. The chunks of
+    a file are streamed in document order (see ChunkStream) as its units finish.
+
+    Args:
+        file_paths (Iterable[str]):
+            Paths of the files to parse.
+        max_workers (int):
+            Number of worker processes, default one per core.
+        pages_per_unit (int):
+            Number of PDF pages extracted and chunked by one work unit.
+        max_pending (int):
+            Maximum number of work units submitted at once, default four per worker.
+        units_ahead (int):
+            Maximum number of a file's units submitted but not yet consumed from its ChunkStream,
+            default two per worker; further units of the file wait until the consumer catches up.
+        cancel (threading.Event):
+            When set, parsing stops as if the iterator was closed, also while a file's units are
+            still being waited for.
+
+    Returns:
+        An iterator over the files in the order their first chunks are ready, not the order of
+        `file_paths`. A unit failing after its file was yielded ends the file's chunks with the
+        error. The iterator finishes once every file is parsed; closing it early or setting
+        `cancel` cancels the work units not started yet and ends the unfinished files' chunks with
+        IngestionCancelled.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    max_pending = max_pending or 4 * max_workers
+    units_ahead = units_ahead or 2 * max_workers
+    backlog = collections.deque()
+    for file_path in file_paths:
+        extension = os.path.splitext(file_path)[1].lower()
+        if extension == '.pdf':
+            backlog.append((pdf_page_count, (file_path,), file_path, None))
+        elif extension == '.txt':
+            backlog.append((chunk_text_file, (file_path,), file_path, 0))
+        else:
+            yield ParsedDocument(file_path, [], ValueError(f"Unsupported file type: {extension}"))
+
+    # per file being parsed: its stream, yielded once its first unit is done
+    streams = {}
+    failed = set()
+    # per file, the number of its units submitted
+    submitted = collections.Counter()
+
+    def next_unit():
+        # the first unit in the backlog whose file is not too far ahead of its consumer
+        for position, entry in enumerate(backlog):
+            stream = streams.get(entry[2])
+            if stream is not None and stream.closed:
+                failed.add(entry[2])
+            if stream is None or stream.closed or submitted[entry[2]] - stream.consumed < units_ahead:
+                del backlog[position]
+                return entry
+        return None
+
+    pool = ProcessPoolExecutor(max_workers=max_workers)
+    pending = {}
+    try:
+        while backlog or pending:
+            if cancel is not None and cancel.is_set():
+                return
+            while len(pending) < max_pending and (entry := next_unit()) is not None:
+                function, args, file_path, unit = entry
+                if file_path in failed:
+                    continue  # the file's consumer stopped
+                submitted[file_path] += 1
+                pending[pool.submit(function, *args)] = (function, file_path, unit)
+            if not pending:
+                # every unit left waits for its file's consumer
+                time.sleep(POLL_INTERVAL)
+                continue
+            done, _ = wait(pending, timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED)
+            for future in done:
+                function, file_path, unit = pending.pop(future)
+                if file_path in failed:
+                    continue  # an earlier unit of this file failed, or its consumer stopped
+                try:
+                    result = future.result()
+                except Exception as error:
+                    failed.add(file_path)
+                    stream = streams.pop(file_path, None)
+                    if stream is not None and stream.started:
+                        stream.fail(error)
+                    else:
+                        yield ParsedDocument(file_path, [], error)
+                    continue
+
+                if function is pdf_page_count:
+                    ranges = [(first, min(first + pages_per_unit - 1, result))
+                              for first in range(1, result + 1, pages_per_unit)]
+                    if not ranges:
+                        stream = ChunkStream(file_path, 0, 0)
+                        yield ParsedDocument(file_path, stream, pages=stream.pages)
+                        continue
+                    streams[file_path] = ChunkStream(file_path, result, len(ranges))
+                    file_units = [(chunk_pdf_pages, (file_path, first, last), file_path, i)
+                                  for i, (first, last) in enumerate(ranges)]
+                    # the units go to the front, so files finish one after another rather than all at the end
+                    backlog.extendleft(reversed(file_units))
+                    continue
+
+                if function is chunk_text_file:
+                    streams[file_path] = ChunkStream(file_path, 1, 1)
+                stream = streams[file_path]
+                started = stream.started
+                stream.put(unit, *result)
+                if stream.complete:
+                    del streams[file_path]
+                if not started and stream.started:
+                    yield ParsedDocument(file_path, stream,
+                                         pages=stream.pages if function is chunk_pdf_pages else None)
+    finally:
+        # stopped early: the units not started are dropped, and the running ones finish in the
+        # background instead of being waited for
+        pool.shutdown(wait=not pending, cancel_futures=True)
+        for file_path, stream in streams.items():
+            stream.fail(IngestionCancelled(file_path))
+
+
+def ingest_documents(client: OpenAI, db: VectorDB, file_paths: List[str], batcher: EmbeddingBatcher = None,
+                     max_workers: int = None, pages_per_unit: int = 50, units_ahead: int = None,
+                     embed_workers: int = 4, progress: Callable[[str, int, int], None] = None,
+                     cancel: threading.Event = None) -> Iterator[Tuple[str, dict]]:
+    """
+    Parses files in a process pool (see `parse_documents`) and stores every file as soon as its
+    first chunks are parsed, in that order, on `embed_workers` threads that embed and insert
+    concurrently while the rest of the file is still being parsed.
+    Files already ingested unchanged are skipped without being parsed; of modified files, only the
+    chunks that changed are embedded and written again.
+
+    Args:
+        client (OpenAI):
+            An OpenAI client instance used to generate text embeddings.
+        db (VectorDB):
+            A vector database instance where the embeddings and associated data will be stored.
+        file_paths (List[str]):
+            Paths of the PDF and TXT files.
+        batcher (EmbeddingBatcher):
+            Batcher shared by all files, e.g. a Helpers.embeddings.AsyncEmbeddingPipeline.
+        max_workers (int), pages_per_unit (int), units_ahead (int):
+            See `parse_documents`.
+        embed_workers (int):
+            Number of files embedded and inserted at the same time.
+        progress (Callable[[str, int, int], None]):
+            Called from the embedding threads with a file path, its number of chunks done and its
+            number of chunks, after every chunk; while the file is still being parsed, the number
+            of chunks is an estimate (see ChunkStream.expected_chunks).
+        cancel (threading.Event):
+            When set, parsing stops (see `parse_documents`) and the files being stored stop before
+            their next chunk (see Helpers.embeddings.store_chunks).
+
+    Returns:
+        An iterator over (file path, ingestion statistics) in the order the files are done. The
+        statistics are those of Helpers.embeddings.store_chunks (with `pages_changed` for PDFs);
+        for a file that could not be read, parsed or stored they are zero and contain the `error`, and
+        `cancelled` is True if that is because of `cancel`.
+    """
+    batcher = batcher or EmbeddingBatcher(client)
+
+    def failed(error: Exception) -> dict:
+        return {"rows": 0, "skipped": 0, "embedded": 0, "reused": 0, "requests": 0, "error": str(error),
+                "cancelled": isinstance(error, IngestionCancelled)}
+
+    states = {}
+    known_pages = {}
+    for file_path in file_paths:
+        try:
+            unchanged, state = check_file(db, file_path)
+        except OSError as error:
+            # e.g. a file deleted or unreadable since it was selected: it fails alone
+            yield file_path, failed(error)
+            continue
+        if unchanged is not None:
+            yield file_path, unchanged
+        else:
+            states[file_path] = state
+            known_pages[file_path] = db.ingested_pages(os.path.basename(file_path))
+
+    def store(document: ParsedDocument) -> dict:
+        file_progress = None
+        if progress is not None:
+            def file_progress(done: int):
+                progress(document.file_path, done, document.chunks.expected_chunks())
+        try:
+            stats = store_chunks(client, db, os.path.basename(document.file_path), document.chunks,
+                                 states[document.file_path], batcher, pages=document.pages,
+                                 progress=file_progress, cancel=cancel)
+        finally:
+            document.chunks.close()
+        if document.pages is not None:
+            known = known_pages[document.file_path]
+            stats["pages_changed"] = sum(1 for _, page_hash in document.pages if page_hash not in known)
+        return stats
+
+    def finished(futures: dict, block: bool) -> Iterator[Tuple[str, dict]]:
+        done = wait(futures, return_when=FIRST_COMPLETED)[0] if block else [f for f in futures if f.done()]
+        for future in done:
+            file_path = futures.pop(future)
+            try:
+                yield file_path, future.result()
+            except Exception as error:
+                yield file_path, failed(error)
+
+    parsed = set()
+    with ThreadPoolExecutor(max_workers=embed_workers) as embedders:
+        futures = {}
+        documents = parse_documents(list(states), max_workers, pages_per_unit, units_ahead=units_ahead,
+                                    cancel=cancel)
+        for document in documents:
+            parsed.add(document.file_path)
+            if cancel is not None and cancel.is_set():
+                documents.close()
+                yield document.file_path, failed(IngestionCancelled(document.file_path))
+                break
+            if document.error is not None:
+                yield document.file_path, failed(document.error)
+                continue
+            future = embedders.submit(store, document)
+            futures[future] = document.file_path
+            yield from finished(futures, block=False)
+        while futures:
+            yield from finished(futures, block=True)
+
+    for file_path in states:
+        if file_path not in parsed:
+            yield file_path, failed(IngestionCancelled(file_path))
@@ -1,16 +1,65 @@
+import hashlib
 import os.path
+from typing import Iterator, List, Tuple
 
-import numpy as np
 from openai import OpenAI
 import PyPDF2
 
-from Midterm.Helpers.text import split_text_numpy
+from Midterm.Helpers.embeddings import EmbeddingBatcher, check_file, store_chunks
+from Midterm.Helpers.text import split_tokens
 from Midterm.sqlite_DB import VectorDB
 
-def store_pdf_to_db(client: OpenAI, db: VectorDB, file_path: str):
+
+def pdf_page_hash(page: PyPDF2.PageObject) -> str:
+    """
+    Hashes what is drawn on a page (its content streams), which takes a fraction of the time
+    of extracting its text.
+
+    Args:
+        page (PyPDF2.PageObject):
+            A page of a PdfReader.
+
+    Returns:
+        The hex digest.
+    """
+    contents = page.get_contents()
+    if contents is None:
+        data = b""
+    elif hasattr(contents, "get_data"):
+        data = contents.get_data()
+    else:
+        data = b"".join(part.get_object().get_data() for part in contents)
+    return hashlib.sha256(data).hexdigest()
+
+
+def iter_pdf_pages(file_path: str, records: List[Tuple[int, str]] = None) -> Iterator[Tuple[int, str]]:
+    """
+    Extracts the text of a PDF file lazily, one page at a time.
+
+    Args:
+        file_path (str):
+            The path to the PDF file.
+        records (List[Tuple[int, str]]):
+            If given, (page number, page hash) of every page is appended to it, for
+            VectorDB.record_file. The text itself is not kept.
+
+    Returns:
+        An iterator over (page number, text) pairs, numbered from 1.
+    """
+    with open(file_path, 'rb') as file:
+        pdf_reader = PyPDF2.PdfReader(file)
+        for page_number, page in enumerate(pdf_reader.pages, start=1):
+            if records is not None:
+                records.append((page_number, pdf_page_hash(page)))
+            yield page_number, page.extract_text() or ""
+
+
+def store_pdf_to_db(client: OpenAI, db: VectorDB, file_path: str, batcher: EmbeddingBatcher = None):
     """
-    Extracts text from a PDF file, splits it into chunks, generates embeddings for each chunk,
-    and stores the embeddings, filename, and corresponding text chunks into a vector database.
+    Extracts text from a PDF file page by page, splits it into chunks, generates embeddings for each
+    chunk, and stores the embeddings, filename, corresponding text chunks and the pages they come
+    from into a vector database. Pages are read, chunked and embedded as a stream, so memory use
+    does not grow with the size of the PDF.
 
     Args:
         client (OpenAI):
@@ -19,26 +68,24 @@ def store_pdf_to_db(client: OpenAI, db: VectorDB, file_path: str):
             A vector database instance where the embeddings and associated data will be stored.
         file_path (str):
             The path to the PDF file to be processed.
+        batcher (EmbeddingBatcher):
+            Batcher used for the embedding requests (see Helpers.embeddings.EmbeddingBatcher).
 
     Returns:
-        None
+        Ingestion statistics (see Helpers.embeddings.store_chunks), including how many chunks were
+        newly embedded and how many reused. Files already ingested unchanged are not read again;
+        of a modified file, only the chunks that changed are embedded and written, and the pages
+        whose hash is not recorded for the file are counted (`pages_changed`).
     """
-    text = ""
     filename = os.path.basename(file_path)
-    with open(file_path, 'rb') as file:
-        pdf_reader = PyPDF2.PdfReader(file)
-        for page_num in range(len(pdf_reader.pages)):
-            page = pdf_reader.pages[page_num]
-            text += page.extract_text() + "\n"
-
-    chunks = split_text_numpy(text)
-    to_insert_to_db = []
-
-    for chunk in chunks:
-        res = client.embeddings.create(input=chunk, model="text-embedding-3-large")
-        embedding = res.data[0].embedding
-        embedding = np.array(embedding)
-        to_insert_to_db.append((embedding, filename, chunk))
+    unchanged, state = check_file(db, file_path)
+    if unchanged is not None:
+        return unchanged
 
-    db.insert(to_insert_to_db)
-    return
\ No newline at end of file
+    known_pages = db.ingested_pages(filename)
+    pages = []
+    # a page break ends a line, not a paragraph: sentences often continue on the next page
+    chunks = split_tokens((page_number, text + "\n") for page_number, text in iter_pdf_pages(file_path, pages))
+    stats = store_chunks(client, db, filename, chunks, state, batcher, pages=pages)
+    stats["pages_changed"] = sum(1 for _, page_hash in pages if page_hash not in known_pages)
+    return stats
@@ -1,5 +1,38 @@
+import bisect
+import re
+from typing import Callable, Iterable, Iterator, NamedTuple, Tuple
+
 import numpy as np
 
+
+# word-like pieces a tokenizer would not split further, and the ends of paragraphs, sentences and words
+WORD_PIECE = re.compile(r"\w+|[^\w\s]")
+LONG_WORD = re.compile(r"\w{8,}")
+PARAGRAPH_END = re.compile(r"\S(?=[ \t]*\n[ \t]*\n)")
+# what PARAGRAPH_END looks for, in a form the regex engine finds quickly
+BLANK_LINE = re.compile(r"\n[ \t]*\n")
+# the punctuation comes first (the check for a one-letter word before it follows), which lets the
+# regex engine skip ahead to candidate characters
+SENTENCE_END = re.compile(r"[.!?](?<!\b\w[.!?])[\"')\]]*(?=\s)")
+WORD_END = re.compile(r"\S(?=\s)")
+WORD_START = re.compile(r"(?<=\s)\S")
+NON_SPACE = re.compile(r"\S")
+# the same pieces, captured by re.split so that their offsets follow from the lengths of the parts
+WORD_PIECE_PARTS = re.compile(r"(\w+|[^\w\s])")
+NON_SPACE_PARTS = re.compile(r"(\S+)")
+# characters after a cut a boundary pattern may look at, e.g. the blank line ending a paragraph
+LOOKAHEAD = 64
+
+
+class Chunk(NamedTuple):
+    """
+    A chunk of a document's text and the first and last page it was taken from, if known.
+    """
+    text: str
+    page_start: int = None
+    page_end: int = None
+
+
 def split_text_numpy(text, chunk_size=500, chunk_overlap=50):
     """
     Splits up text into smaller chunks with the specified chunk-size and overlap.
@@ -22,3 +55,267 @@ def split_text_numpy(text, chunk_size=500, chunk_overlap=50):
     return chunks
 
 
+def approximate_tokens(text: str) -> int:
+    """
+    Approximate number of tokens of a text without a tokenizer: one token per word or punctuation
+    mark, plus one for every further eight characters of long words, numbers or identifiers.
+
+    Args:
+        text (str):
+            The text.
+
+    Returns:
+        The approximate number of tokens.
+    """
+    return len(WORD_PIECE.findall(text)) + sum(len(word) // 8 for word in LONG_WORD.findall(text))
+
+
+def token_units(text: str, count_tokens: Callable[[str], int] = approximate_tokens):
+    """
+    Splits a text into the units its tokens are counted in, so that the tokens of any part of it
+    are a difference of running totals: the word pieces of `approximate_tokens` (each one token,
+    plus one for every eight characters), whose counts add up to exactly that of the whole text,
+    or for any other counter the runs of non-whitespace, counted one by one.
+
+    Args:
+        text (str):
+            The text.
+        count_tokens (Callable[[str], int]):
+            Token counter, see `split_tokens`.
+
+    Returns:
+        (starts, ends, tokens) arrays of the units, in text order.
+    """
+    default = count_tokens is approximate_tokens
+    # whitespace and units alternate: [space, unit, space, unit, ..., space]
+    parts = (WORD_PIECE_PARTS if default else NON_SPACE_PARTS).split(text)
+    offsets = np.cumsum(np.fromiter(map(len, parts), dtype=np.int64, count=len(parts)))
+    starts, ends = offsets[0:-1:2], offsets[1::2]
+    if default:
+        return starts, ends, 1 + (ends - starts) // 8
+    return starts, ends, np.fromiter(map(count_tokens, parts[1::2]), dtype=np.int64, count=len(ends))
+
+
+def split_tokens(pieces: Iterable[Tuple[int, str]], max_tokens: int = 200, overlap_tokens: int = 20,
+                 count_tokens: Callable[[str], int] = approximate_tokens, min_fill: float = 0.5) -> Iterator[Chunk]:
+    """
+    Splits a stream of text into chunks of at most `max_tokens` tokens, cut at the end of a
+    paragraph if that fills at least `min_fill` of the budget, else at the end of a sentence, else
+    at the end of a word; only a single word longer than the budget is cut inside. Consecutive
+    chunks share up to `overlap_tokens` tokens of whole words. The text is consumed piece by piece
+    and only the text of the current chunk and the last piece is held, so files of any size can be
+    split in bounded memory. Every unit of the text (see `token_units`) is counted once, as it
+    arrives; the tokens of a candidate chunk are the difference of two running totals.
+
+    Args:
+        pieces (Iterable[Tuple[int, str]]):
+            (page number, text) pairs in document order, concatenated as they are; the page number
+            may be None, e.g. for the blocks of Helpers.txt.iter_text_blocks.
+        max_tokens (int):
+            Maximum number of tokens of each chunk.
+        overlap_tokens (int):
+            Maximum number of tokens repeated from the end of the previous chunk.
+        count_tokens (Callable[[str], int]):
+            Counts the tokens of a text, `approximate_tokens` by default; pass a real tokenizer, e.g.
+            `lambda text: len(tiktoken.get_encoding("cl100k_base").encode(text))`, for tighter
+            budgets. It is applied to every word, and a chunk counts the sum over its words.
+        min_fill (float):
+            Fraction of `max_tokens` a chunk cut at a paragraph or sentence end has to reach.
+
+    Returns:
+        An iterator over the chunks, with whitespace stripped and the pages they cover.
+    """
+    if not 0 <= overlap_tokens < max_tokens:
+        raise ValueError("overlap_tokens must be at least 0 and less than max_tokens")
+
+    # text of the stream from offset `base` on, and the offsets at which its pages start
+    buffer = ""
+    base = 0
+    page_offsets = []
+    page_numbers = []
+    # start of the next chunk, and the end of the previous one, which the next cut has to pass
+    start = 0
+    floor = 0
+    # characters per token of the last chunk, where the searches for the next one start
+    ratio = 4.0
+    # units of the buffer (see `token_units`) by their stream offsets, and the tokens before each
+    unit_starts = np.empty(0, dtype=np.int64)
+    unit_ends = np.empty(0, dtype=np.int64)
+    totals = np.zeros(1, dtype=np.int64)
+
+    def add_units(end: int):
+        # counts the text appended after `end`; a unit touching `end` may continue, so it is counted again
+        nonlocal unit_starts, unit_ends, totals
+        if len(unit_ends) and unit_ends[-1] == end:
+            end = int(unit_starts[-1])
+            unit_starts, unit_ends, totals = unit_starts[:-1], unit_ends[:-1], totals[:-1]
+        starts, ends, counts = token_units(buffer[end - base:], count_tokens)
+        unit_starts = np.concatenate([unit_starts, starts + end])
+        unit_ends = np.concatenate([unit_ends, ends + end])
+        totals = np.concatenate([totals, totals[-1] + np.cumsum(counts)])
+
+    def tokens(begin: int, end: int) -> int:
+        # tokens of the units overlapping [begin, end); a unit cut by either end (after a cut inside
+        # a word) counts only its part in the range
+        first = unit_ends.searchsorted(begin, "right")
+        last = unit_starts.searchsorted(end, "left")
+        if last <= first:
+            return 0
+        total = int(totals[last] - totals[first])
+        for unit in {first, last - 1}:
+            low, high = int(unit_starts[unit]), int(unit_ends[unit])
+            if low < begin or end < high:
+                total += count_tokens(buffer[max(low, begin) - base:min(high, end) - base]) - int(totals[unit + 1] - totals[unit])
+        return total
+
+    def first_unit() -> Tuple[int, int]:
+        # the first unit of the text from `start`, and the running total the text's tokens add to;
+        # a unit cut by `start` counts only its part after it
+        first = int(unit_ends.searchsorted(start, "right"))
+        total = int(totals[first])
+        if first < len(unit_starts) and unit_starts[first] < start:
+            total += int(totals[first + 1] - totals[first]) - count_tokens(buffer[start - base:int(unit_ends[first]) - base])
+        return first, total
+
+    def last_fitting(fits: Callable[[int], bool], low: int, high: int, guess: int) -> int:
+        # the largest position in [low, high] that `fits`, given that `low` does and that fitting is
+        # monotone; searches outwards from `guess`, so that a good guess needs few token counts
+        step = max(1, (guess - low) // 64)
+        probe = min(max(guess, low + 1), high)
+        if low == high:
+            return low
+        if fits(probe):
+            low = probe
+            while low < high:
+                probe = min(low + step, high)
+                if not fits(probe):
+                    high = probe - 1
+                    break
+                low, step = probe, 2 * step
+        else:
+            high = probe - 1
+            while low < high:
+                probe = max(high - step, low)
+                if probe == low or fits(probe):
+                    low = probe
+                    break
+                high, step = probe - 1, 2 * step
+        while low < high:
+            middle = (low + high + 1) // 2
+            if fits(middle):
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def limit(final: bool) -> int:
+        # end of the longest text from `start` within the budget, None if that needs more input
+        nonlocal ratio
+        end = base + len(buffer)
+        first, total = first_unit()
+        # units first..fitting-1 fit in the budget
+        fitting = totals.searchsorted(total + max_tokens, "right") - 1
+        if fitting >= len(unit_starts):
+            found = end
+        else:
+            # unit `fitting` runs over the budget, so the text may still take the start of it
+            begin = max(int(unit_starts[fitting]), start)
+            used = tokens(start, begin)
+            found = last_fitting(lambda position: used + count_tokens(buffer[begin - base:position - base]) <= max_tokens,
+                                 begin, int(unit_ends[fitting]), begin + int(ratio * (max_tokens - used)))
+        if not final and found + LOOKAHEAD > end:
+            return None  # the boundaries near the cut depend on text still to come
+        if found == end:
+            return end
+        ratio = max((found - start) / max_tokens, 1.0)
+        return found
+
+    def last_boundary(pattern: re.Pattern, end: int, low: int) -> int:
+        # the last match ending in (low, end], searched for in windows before `end` that grow until
+        # they hold a match (matches are a few characters long, so a window hardly ever cuts one)
+        low = max(low, floor)
+        lowest = max(low - LOOKAHEAD, start)
+        size = LOOKAHEAD
+        while True:
+            begin = max(end - size, lowest)
+            found = None
+            if pattern is not PARAGRAPH_END or BLANK_LINE.search(buffer, begin - base, end - base + LOOKAHEAD):
+                for match in pattern.finditer(buffer, begin - base, end - base + LOOKAHEAD):
+                    if match.end() + base > end:
+                        break
+                    found = match.end() + base
+            if found is not None or begin == lowest:
+                return found if found is not None and found > low else None
+            size *= 4
+
+    def cut(end: int) -> int:
+        # a paragraph or sentence end has to come after the unit at which the chunk fills `min_fill`
+        first, total = first_unit()
+        filled = totals.searchsorted(total + min_fill * max_tokens, "left")
+        if filled <= len(unit_starts):
+            low = int(unit_starts[max(filled - 1, first)])
+            for pattern in (PARAGRAPH_END, SENTENCE_END):
+                boundary = last_boundary(pattern, end, low)
+                if boundary is not None and tokens(start, boundary) >= min_fill * max_tokens:
+                    return boundary
+        return last_boundary(WORD_END, end, floor) or max(end, floor + 1)
+
+    def emit(end: int) -> Iterator[Chunk]:
+        text = buffer[start - base:end - base]
+        first = start + len(text) - len(text.lstrip())
+        last = end - (len(text) - len(text.rstrip()))
+        if first < last:
+            yield Chunk(buffer[first - base:last - base],
+                        page_numbers[bisect.bisect_right(page_offsets, first) - 1],
+                        page_numbers[bisect.bisect_right(page_offsets, last - 1) - 1])
+
+    def overlap_start(end: int) -> int:
+        # the earliest word start after `start` whose text up to `end` fits the overlap; the word
+        # starts are taken from a window before `end` that grows until one of them does not fit
+        size = int(2 * ratio * overlap_tokens) + LOOKAHEAD
+        while True:
+            begin = max(end - size, start + 1)
+            starts = [match.start() + base for match in WORD_START.finditer(buffer, begin - base, end - base)]
+            if begin == start + 1 or (starts and tokens(starts[0], end) > overlap_tokens):
+                break
+            size *= 4
+        starts.reverse()
+        if not starts or tokens(starts[0], end) > overlap_tokens:
+            return end
+        # the guess is the index of the word start about `overlap_tokens` tokens before `end`
+        guess = sum(1 for position in starts if position >= end - ratio * overlap_tokens)
+        return starts[last_fitting(lambda i: tokens(starts[i], end) <= overlap_tokens, 0, len(starts) - 1, guess)]
+
+    def drain(final: bool) -> Iterator[Chunk]:
+        nonlocal start, floor
+        while NON_SPACE.search(buffer, floor - base):
+            end = limit(final)
+            if end is None:
+                return
+            if end == base + len(buffer):
+                yield from emit(end)
+                floor = start = end
+                return
+            end = cut(end)
+            yield from emit(end)
+            start = overlap_start(end) if overlap_tokens else end
+            floor = end
+
+    for page_number, text in pieces:
+        end = base + len(buffer)
+        page_offsets.append(end)
+        page_numbers.append(page_number)
+        buffer += text
+        add_units(end)
+        if tokens(start, base + len(buffer)) <= max_tokens:
+            continue
+        yield from drain(final=False)
+        # drop the text, the units and the pages no later chunk starts in
+        buffer = buffer[start - base:]
+        base = start
+        keep = unit_ends.searchsorted(base, "right")
+        unit_starts, unit_ends, totals = unit_starts[keep:], unit_ends[keep:], totals[keep:]
+        keep = bisect.bisect_right(page_offsets, base) - 1
+        del page_offsets[:keep], page_numbers[:keep]
+
+    yield from drain(final=True)
@@ -1,12 +1,32 @@
 import os
+from typing import Iterator, Tuple
 
-import numpy as np
 from openai import OpenAI
 
-from Midterm.Helpers.text import split_text_numpy
+from Midterm.Helpers.embeddings import EmbeddingBatcher, check_file, store_chunks
+from Midterm.Helpers.text import split_tokens
 from Midterm.sqlite_DB import VectorDB
 
-def store_txt_to_db(client: OpenAI, db: VectorDB, file_path: str):
+
+def iter_text_blocks(file_path: str, block_size: int = 1 << 16) -> Iterator[Tuple[None, str]]:
+    """
+    Reads a text file block by block, so that it can be chunked without reading it whole.
+
+    Args:
+        file_path (str):
+            The path to the text file.
+        block_size (int):
+            Number of characters per block.
+
+    Returns:
+        An iterator over (None, block) pairs, for Helpers.text.split_tokens; text files have no pages.
+    """
+    with open(file_path, 'r') as file:
+        while block := file.read(block_size):
+            yield None, block
+
+
+def store_txt_to_db(client: OpenAI, db: VectorDB, file_path: str, batcher: EmbeddingBatcher = None):
     """
     Extracts contents from text file, splits it into chunks, generates embeddings for each chunk,
     and stores the embeddings, filename, and corresponding text chunks into a vector database.
@@ -18,24 +38,19 @@ def store_txt_to_db(client: OpenAI, db: VectorDB, file_path: str):
             A vector database instance where the embeddings and associated data will be stored.
         file_path (str):
             The path to the PDF file to be processed.
+        batcher (EmbeddingBatcher):
+            Batcher used for the embedding requests (see Helpers.embeddings.EmbeddingBatcher).
 
     Returns:
-        None
+        Ingestion statistics (see Helpers.embeddings.store_chunks), including how many chunks were
+        newly embedded and how many reused. Files already ingested unchanged are not read again;
+        of a modified file, only the chunks that changed are embedded and written.
     """
 
-    text = ""
     filename = os.path.basename(file_path)
-    with open(file_path, 'r+') as file:
-        text += file.read()
-
-    chunks = split_text_numpy(text)
-    to_insert_to_db = []
-
-    for chunk in chunks:
-        res = client.embeddings.create(input=chunk, model="text-embedding-3-large")
-        embedding = res.data[0].embedding
-        embedding = np.array(embedding)
-        to_insert_to_db.append((embedding, filename, chunk))
+    unchanged, state = check_file(db, file_path)
+    if unchanged is not None:
+        return unchanged
 
-    db.insert(to_insert_to_db)
-    return
\ No newline at end of file
+    chunks = split_tokens(iter_text_blocks(file_path))
+    return store_chunks(client, db, filename, chunks, state, batcher)
@@ -0,0 +1,384 @@
+import argparse
+import base64
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from openai import AsyncOpenAI, OpenAI
+
+from Midterm.embedding_cache import EmbeddingCache
+from Midterm.Helpers.embeddings import AsyncEmbeddingPipeline, EmbeddingBatcher, FileState, store_chunks
+from Midterm.Helpers.pdf import iter_pdf_pages
+from Midterm.Helpers.text import approximate_tokens, split_text_numpy, split_tokens
+from Midterm.Helpers.txt import store_txt_to_db
+from Midterm.indexes import MatryoshkaIndex
+from Midterm.sharding import ShardedVectorDB
+from Midterm.sqlite_DB import VectorDB
+
+
+def synthetic_corpus(n: int, dim: int, clusters: int = 256, seed: int = 0, decay: bool = False):
+    """
+    Generates clustered random vectors, which behave more like real embeddings than uniform noise.
+
+    Args:
+        n (int): Number of vectors.
+        dim (int): Vector dimension.
+        clusters (int): Number of cluster centres.
+        seed (int): Random seed.
+        decay (bool): Concentrate variance in the leading dimensions, like Matryoshka embeddings.
+
+    Returns:
+        A (vectors, queries) tuple; queries are perturbed copies of random corpus vectors.
+    """
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(clusters, dim)).astype(np.float32)
+    vectors = centres[rng.integers(0, clusters, n)] + 0.5 * rng.normal(size=(n, dim)).astype(np.float32)
+    queries = vectors[rng.integers(0, n, 100)] + 0.3 * rng.normal(size=(100, dim)).astype(np.float32)
+    if decay:
+        weights = (1 / np.sqrt(1 + np.arange(dim) / 32)).astype(np.float32)
+        vectors, queries = vectors * weights, queries * weights
+    return vectors, queries
+
+
+def fill(db: VectorDB, vectors: np.ndarray, batch: int = 10000):
+    db.bulk_insert(((vector, "bench", str(i)) for i, vector in enumerate(vectors)), batch_size=batch)
+
+
+def timed_search(db: VectorDB, queries: np.ndarray, top_k: int, **kwargs):
+    """
+    Runs every query and returns (mean latency in ms, list of result id lists).
+    """
+    results = []
+    start = time.perf_counter()
+    for query in queries:
+        results.append([result.id for result in db.search(query, top_k, **kwargs)])
+    return (time.perf_counter() - start) * 1000 / len(queries), results
+
+
+def recall(approximate, exact) -> float:
+    hits = sum(len(set(a) & set(e)) for a, e in zip(approximate, exact))
+    return hits / sum(len(e) for e in exact)
+
+
+def bench_ivf(args):
+    vectors, queries = synthetic_corpus(args.n, args.dim)
+    db = VectorDB(":memory:", "bench", index="ivf")
+    fill(db, vectors)
+    db.search(queries[0])
+
+    exact_ms, exact = timed_search(db, queries, args.top_k, exact=True)
+    print(f"exact           {exact_ms:8.2f} ms/query")
+    for nprobe in (1, 2, 4, 8, 16, 32):
+        db.index.nprobe = nprobe
+        ms, found = timed_search(db, queries, args.top_k)
+        print(f"ivf nprobe={nprobe:<4} {ms:8.2f} ms/query  recall@{args.top_k}={recall(found, exact):.3f}")
+
+
+def bench_hnsw(args):
+    vectors, queries = synthetic_corpus(args.n, args.dim)
+    db = VectorDB(":memory:", "bench", index="hnsw")
+    start = time.perf_counter()
+    fill(db, vectors)
+    db.search(queries[0])
+    print(f"build           {time.perf_counter() - start:8.2f} s")
+
+    exact_ms, exact = timed_search(db, queries, args.top_k, exact=True)
+    print(f"exact           {exact_ms:8.2f} ms/query")
+    for ef_search in (16, 32, 64, 128, 256):
+        db.index.ef_search = ef_search
+        ms, found = timed_search(db, queries, args.top_k)
+        print(f"hnsw ef={ef_search:<7} {ms:8.2f} ms/query  recall@{args.top_k}={recall(found, exact):.3f}")
+
+
+def bench_quantized(args):
+    vectors, queries = synthetic_corpus(args.n, args.dim)
+    float_bytes = vectors.shape[0] * vectors.shape[1] * 4
+    for name in ("sq8", "pq"):
+        db = VectorDB(":memory:", "bench", index=name)
+        fill(db, vectors)
+        db.search(queries[0])
+        exact_ms, exact = timed_search(db, queries, args.top_k, exact=True)
+        ms, found = timed_search(db, queries, args.top_k)
+        print(f"{name:<4} codes={db.index.codes.nbytes / 2 ** 20:7.1f} MiB (float32 {float_bytes / 2 ** 20:.1f} MiB, "
+              f"{db.index.compression_ratio:.0f}x)  {ms:6.2f} ms/query (exact {exact_ms:.2f})  "
+              f"recall@{args.top_k}={recall(found, exact):.3f}")
+
+
+def bench_matryoshka(args):
+    vectors, queries = synthetic_corpus(args.n, args.dim, decay=True)
+    db = VectorDB(":memory:", "bench")
+    fill(db, vectors)
+    db.search(queries[0])
+    exact_ms, exact = timed_search(db, queries, args.top_k)
+    print(f"full {args.dim}-dim brute force  {exact_ms:8.2f} ms/query")
+
+    for coarse_dim in (64, 128, 256):
+        if coarse_dim >= args.dim:
+            continue
+        db.index = MatryoshkaIndex(coarse_dim=coarse_dim, candidates=args.candidates)
+        db._load_matrix()
+        ms, found = timed_search(db, queries, args.top_k)
+        print(f"matryoshka {coarse_dim:>4}-dim + rerank {args.candidates}  {ms:8.2f} ms/query  "
+              f"speedup {exact_ms / ms:5.1f}x  recall@{args.top_k}={recall(found, exact):.3f}")
+
+
+def bench_ingest(args):
+    vectors, queries = synthetic_corpus(args.n, args.dim)
+    with tempfile.TemporaryDirectory() as tmp:
+        db = VectorDB(os.path.join(tmp, "ingest.db"), "per_chunk")
+        sample = vectors[:min(len(vectors), 2000)]
+        start = time.perf_counter()
+        for i, vector in enumerate(sample):
+            db.insert([(vector, "bench", str(i))])
+        rate = len(sample) / (time.perf_counter() - start)
+        print(f"insert per chunk          {rate:10.0f} rows/s")
+        db._close()
+
+        for batch_size in (100, 1000, 10000):
+            db = VectorDB(os.path.join(tmp, "ingest.db"), f"bulk_{batch_size}")
+            db.search(queries[0])  # loaded matrix: index maintenance runs once at the end
+            stats = db.bulk_insert(((vector, "bench", str(i)) for i, vector in enumerate(vectors)), batch_size)
+            print(f"bulk_insert batch={batch_size:<6} {stats['rows_per_sec']:10.0f} rows/s  "
+                  f"({stats['rows']} rows, {stats['batches']} transactions, {stats['seconds']:.2f} s)")
+            db._close()
+
+
+def bench_startup(args):
+    vectors, queries = synthetic_corpus(args.n, args.dim)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "startup.db")
+        db = VectorDB(path, "bench", index=args.index, snapshot=False)
+        fill(db, vectors)
+        db.load()  # builds and persists the backend, so every start below can load it
+        db._close()
+        for label, snapshot in (("rebuild from table", False), ("first start (writes snapshot)", True),
+                                ("restore snapshot", True)):
+            start = time.perf_counter()
+            db = VectorDB(path, "bench", index=args.index, snapshot=snapshot)
+            db.search(queries[0], args.top_k)
+            print(f"{label:<30} {(time.perf_counter() - start) * 1000:10.1f} ms to first result")
+            db._close()
+
+
+def stand_in_embeddings_server(latency: float, dim: int, max_items: int = 2048,
+                               failure_rate: float = 0.0) -> ThreadingHTTPServer:
+    """
+    Starts a local stand-in for the OpenAI embeddings endpoint, which answers every request after
+    a fixed latency with pseudo-random embeddings, so ingestion can be measured without network
+    access or an API key.
+
+    Args:
+        latency (float): Seconds every request takes.
+        dim (int): Embedding dimension.
+        max_items (int): Requests with more inputs are rejected with 400, like oversized API requests.
+        failure_rate (float): Fraction of requests answered with 429 or 503 instead.
+
+    Returns:
+        The running server; its API is at http://127.0.0.1:<server_port>/v1.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+            time.sleep(latency)
+            if np.random.random() < failure_rate:
+                status = int(np.random.choice([429, 503]))
+                self._reply(status, {"error": {"message": "Try again", "type": "rate_limit_error"}})
+                return
+            if len(inputs) > max_items:
+                self._reply(400, {"error": {"message": "Too many inputs", "type": "invalid_request_error"}})
+                return
+            data = []
+            for i, text in enumerate(inputs):
+                vector = np.random.default_rng(abs(hash(text)) % 2 ** 32).normal(size=dim).astype("<f4")
+                embedding = (base64.b64encode(vector.tobytes()).decode() if body.get("encoding_format") == "base64"
+                             else vector.tolist())
+                data.append({"object": "embedding", "index": i, "embedding": embedding})
+            tokens = sum(len(text) // 4 for text in inputs)
+            self._reply(200, {"object": "list", "data": data, "model": body["model"],
+                              "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+
+        def _reply(self, status, payload):
+            content = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_embeddings(args):
+    server = stand_in_embeddings_server(args.latency / 1000, args.dim, failure_rate=args.failure_rate)
+    base_url = f"http://127.0.0.1:{server.server_port}/v1"
+    client = OpenAI(api_key="stand-in", base_url=base_url, max_retries=5)
+    pipeline = AsyncEmbeddingPipeline(AsyncOpenAI(api_key="stand-in", base_url=base_url),
+                                      max_items=args.batch_items, base_delay=0.05)
+    files = [[f"file {f} chunk {i}: " + "lorem ipsum dolor sit amet " * 18 for i in range(args.chunks // 4)]
+             for f in range(4)]
+    state = FileState("fingerprint", 0, 0.0)
+    with tempfile.TemporaryDirectory() as tmp:
+        baseline = None
+        for label, batcher, concurrent_files in (
+                ("one request per chunk", EmbeddingBatcher(client, max_items=1), 1),
+                (f"batched ({args.batch_items}/request)", EmbeddingBatcher(client, max_items=args.batch_items), 1),
+                ("async pipeline, 4 files", pipeline, 4)):
+            db = VectorDB(os.path.join(tmp, f"embeddings_{len(label)}.db"), "bench")
+            requests = batcher.requests
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrent_files) as pool:
+                stats = list(pool.map(lambda f: store_chunks(client, db, f"{f}.txt", files[f], state, batcher),
+                                      range(len(files))))
+            seconds = time.perf_counter() - start
+            rows = sum(file_stats["rows"] for file_stats in stats)
+            baseline = baseline or seconds
+            print(f"{label:<26} {seconds:8.2f} s  {batcher.requests - requests:6} requests  "
+                  f"{rows / seconds:8.0f} chunks/s  speedup {baseline / seconds:6.1f}x")
+            db._close()
+    print(f"pipeline retries: {pipeline.retries}")
+    pipeline.close()
+    server.shutdown()
+
+
+def bench_cache(args):
+    server = stand_in_embeddings_server(args.latency / 1000, args.dim)
+    base_url = f"http://127.0.0.1:{server.server_port}/v1"
+    pipeline_client = AsyncOpenAI(api_key="stand-in", base_url=base_url)
+    # questions as a user asks them: a few are asked again and again
+    rng = np.random.default_rng(0)
+    questions = [f"question {int(i)}: what does the document say about topic {int(i)}?"
+                 for i in rng.zipf(1.5, args.chunks) % 200]
+    with tempfile.TemporaryDirectory() as tmp:
+        baseline = None
+        for label, cache in (("no cache", None), ("cache, first run", EmbeddingCache(os.path.join(tmp, "cache.db"))),
+                             ("cache, after restart", "reopen")):
+            if cache == "reopen":
+                cache = EmbeddingCache(os.path.join(tmp, "cache.db"))
+            pipeline = AsyncEmbeddingPipeline(pipeline_client, cache=cache)
+            start = time.perf_counter()
+            for question in questions:
+                pipeline.embed([question])
+            ms = (time.perf_counter() - start) * 1000 / len(questions)
+            baseline = baseline or ms
+            hit_rate = f"hit rate {cache.stats()['hit_rate']:5.1%}" if cache else ""
+            print(f"{label:<22} {ms:8.2f} ms/question  {pipeline.requests:6} requests  "
+                  f"speedup {baseline / ms:6.1f}x  {hit_rate}")
+            pipeline.close()
+            if cache:
+                cache._close()
+    server.shutdown()
+
+
+def bench_reingest(args):
+    server = stand_in_embeddings_server(args.latency / 1000, args.dim)
+    client = OpenAI(api_key="stand-in", base_url=f"http://127.0.0.1:{server.server_port}/v1")
+    rng = np.random.default_rng(0)
+    words = [f"w{i}" for i in range(5000)]
+    paragraphs = [" ".join(" ".join(rng.choice(words, rng.integers(8, 20))) + "."
+                           for _ in range(rng.integers(3, 7)))
+                  for _ in range(args.chunks)]
+    original = "\n\n".join(paragraphs)
+    # edits 1% of the paragraphs
+    for i in rng.choice(len(paragraphs), max(1, len(paragraphs) // 100), replace=False):
+        paragraphs[i] = "Revised. " + paragraphs[i]
+    edited = "\n\n".join(paragraphs)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "document.txt")
+        for label, incremental in (("delete and ingest again", False), ("incremental", True)):
+            db = VectorDB(os.path.join(tmp, f"reingest_{incremental}.db"), "bench")
+            with open(path, "w") as file:
+                file.write(original)
+            store_txt_to_db(client, db, path)
+            with open(path, "w") as file:
+                file.write(edited)
+            start = time.perf_counter()
+            if not incremental:
+                db.delete("document.txt")
+            stats = store_txt_to_db(client, db, path)
+            seconds = time.perf_counter() - start
+            print(f"{label:<24} {seconds:8.2f} s  {stats['requests']:4} requests  {stats['embedded']:6} chunks embedded  "
+                  f"{stats['rows']:6} rows inserted  {stats['deleted']:6} deleted")
+            db._close()
+    server.shutdown()
+
+
+def bench_shards(args):
+    vectors, queries = synthetic_corpus(args.n, args.dim)
+    with tempfile.TemporaryDirectory() as tmp:
+        baseline = None
+        for shards in (1, 2, 4, 8):
+            db = ShardedVectorDB(os.path.join(tmp, f"shards_{shards}.db"), "bench", shards=shards)
+            # spread the corpus over many "files", since chunks are routed to shards by filename
+            db.bulk_insert(((vector, f"doc{i // 100}", str(i)) for i, vector in enumerate(vectors)), 10000)
+            db.search(queries[0])
+            ms, _ = timed_search(db, queries, args.top_k)
+            baseline = baseline or ms
+            print(f"shards={shards:<3} {ms:8.2f} ms/query  {1000 / ms:8.0f} queries/s  speedup {baseline / ms:5.2f}x")
+            db._close()
+
+
+def bench_chunking(args):
+    # the documentation PDFs of the repository, repeated up to the requested size
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    document = "".join(text + "\n" for path in (os.path.join(root, "Midterm", "AI_Apps_Midterm.pdf.pdf"),
+                                                 os.path.join(root, "Assignment_1", "Samples", "sample_doc.pdf"))
+                       for _, text in iter_pdf_pages(path))
+    text = document * max(1, int(args.text_mb * 2**20) // len(document))
+    block = 1 << 16
+    blocks = [(None, text[i:i + block]) for i in range(0, len(text), block)]
+    baseline = None
+    for label, split in (("500 chars, 50 overlap", lambda: split_text_numpy(text)),
+                         ("200 tokens, 20 overlap", lambda: [chunk.text for chunk in split_tokens(blocks)])):
+        start = time.perf_counter()
+        chunks = split()
+        seconds = time.perf_counter() - start
+        tokens = sum(approximate_tokens(chunk) for chunk in chunks)
+        sentences = sum(1 for chunk in chunks if chunk.rstrip()[-1:] in (".", "!", "?"))
+        baseline = baseline or len(chunks)
+        print(f"{label:<24} {len(chunks):8} chunks ({len(chunks) / baseline:5.2f}x)  {len(chunks) / seconds:9.0f} chunks/s  "
+              f"{len(text) / seconds / 2**20:6.1f} MB/s  {tokens / len(chunks):6.1f} tokens/chunk  "
+              f"{tokens:9} tokens embedded  {sentences / len(chunks):4.0%} end a sentence")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="VectorDB benchmarks on synthetic data")
+    parser.add_argument("benchmark", choices=["ivf", "hnsw", "quantized", "matryoshka", "ingest", "startup", "embeddings", "shards",
+                                              "chunking", "cache",
+                                              "reingest"])
+    parser.add_argument("--n", type=int, default=100000, help="number of stored vectors")
+    parser.add_argument("--dim", type=int, default=256, help="vector dimension")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--candidates", type=int, default=200, help="rerank candidates for matryoshka")
+    parser.add_argument("--index", default="exact", help="search backend for the startup benchmark")
+    parser.add_argument("--chunks", type=int, default=1000, help="number of chunks (embeddings) or questions (cache) to embed, or paragraphs (reingest)")
+    parser.add_argument("--latency", type=float, default=20, help="ms per request of the stand-in embeddings server")
+    parser.add_argument("--batch-items", type=int, default=64, help="inputs per embeddings request")
+    parser.add_argument("--failure-rate", type=float, default=0.0,
+                        help="fraction of stand-in embeddings requests failing with 429/503")
+    parser.add_argument("--text-mb", type=float, default=2, help="megabytes of text for the chunking benchmark")
+    args = parser.parse_args()
+
+    {
+        "ivf": bench_ivf,
+        "hnsw": bench_hnsw,
+        "quantized": bench_quantized,
+        "matryoshka": bench_matryoshka,
+        "ingest": bench_ingest,
+        "startup": bench_startup,
+        "embeddings": bench_embeddings,
+        "shards": bench_shards,
+        "chunking": bench_chunking,
+        "cache": bench_cache,
+        "reingest": bench_reingest,
+    }[args.benchmark](args)
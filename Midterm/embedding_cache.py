@@ -0,0 +1,168 @@
+import collections
+import threading
+import time
+from typing import Dict, Iterable
+
+import numpy as np
+
+from Midterm.sqlite_DB import SQLiteDB
+
+
+class EmbeddingCache(SQLiteDB):
+    """
+    Persistent cache of embeddings in its own SQLite file, keyed by (model, dimensions, SHA-256 of
+    the text), so that a text embedded once - a chunk uploaded again into another collection, or a
+    question asked again - is never sent to the embeddings API again, even after a restart.
+
+    Vectors are stored as raw float32. The cache holds at most `max_entries` vectors; when it grows
+    beyond, the least recently used ones are evicted. The `hot_entries` most recently used vectors
+    are also kept in memory, so repeated lookups (e.g. the same question) do not touch SQLite;
+    their use is written back to the file with the next insertion or on close.
+    """
+
+    def __init__(self, database: str = "embedding_cache.db", max_entries: int = 100000, hot_entries: int = 4096,
+                 pragmas: dict = None):
+        """
+        :param database: Path to the cache file, or ":memory:"
+        :param max_entries: Maximum number of cached vectors; about 12 KB each for 3072 dimensions
+        :param hot_entries: Number of most recently used vectors also held in memory
+        :param pragmas: PRAGMA overrides, see ConnectionManager
+        """
+        super().__init__(database, pragmas)
+        self.max_entries = max_entries
+        self.hot_entries = hot_entries
+        self.hot_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._hot = collections.OrderedDict()
+        # keys used since the last write, with the time of their last use
+        self._touched = {}
+        self._lock = threading.Lock()
+
+        with self._write() as cur:
+            cur.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (model TEXT NOT NULL, dimensions INTEGER NOT NULL, "
+                "text_hash TEXT NOT NULL, arr vector NOT NULL, last_used REAL NOT NULL, "
+                "PRIMARY KEY (model, dimensions, text_hash)) WITHOUT ROWID"
+            )
+            cur.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+            cur.execute("SELECT COUNT(*) FROM embeddings")
+            self._entries = cur.fetchone()[0]
+
+    def get_many(self, model: str, dimensions: int, hashes: Iterable[str]) -> Dict[str, np.ndarray]:
+        """
+        Looks up cached embeddings.
+
+        :param model: Embedding model
+        :param dimensions: Requested dimensions, 0 for the model's default
+        :param hashes: Content hashes of the texts, see sqlite_DB.content_hash
+        :return: Dict mapping every cached hash to its embedding
+        """
+        hashes = list(dict.fromkeys(hashes))
+        now = time.time()
+        found = {}
+        with self._lock:
+            for text_hash in hashes:
+                key = (model, dimensions, text_hash)
+                if key in self._hot:
+                    self._hot.move_to_end(key)
+                    self._touched[key] = now
+                    found[text_hash] = self._hot[key]
+            self.hot_hits += len(found)
+
+        cold = [text_hash for text_hash in hashes if text_hash not in found]
+        loaded = {}
+        with self._read() as cur:
+            for start in range(0, len(cold), 900):
+                part = cold[start:start + 900]
+                cur.execute(
+                    f"SELECT text_hash, arr FROM embeddings WHERE model = ? AND dimensions = ? "
+                    f"AND text_hash IN ({', '.join('?' * len(part))})", [model, dimensions, *part]
+                )
+                loaded.update(cur.fetchall())
+
+        with self._lock:
+            self.disk_hits += len(loaded)
+            self.misses += len(cold) - len(loaded)
+            for text_hash, vector in loaded.items():
+                self._touched[(model, dimensions, text_hash)] = now
+                self._remember((model, dimensions, text_hash), vector)
+        found.update(loaded)
+        return found
+
+    def put_many(self, model: str, dimensions: int, embeddings: Dict[str, np.ndarray]):
+        """
+        Stores embeddings, evicting the least recently used ones beyond `max_entries`.
+
+        :param model: Embedding model
+        :param dimensions: Requested dimensions, 0 for the model's default
+        :param embeddings: Dict mapping content hashes to embeddings
+        :return:
+        """
+        now = time.time()
+        with self._lock:
+            for text_hash, vector in embeddings.items():
+                self._remember((model, dimensions, text_hash), np.asarray(vector, dtype=np.float32))
+            touched, self._touched = self._touched, {}
+
+        with self._write() as cur:
+            self._write_touches(cur, touched)
+            cur.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, dimensions, text_hash, arr, last_used) VALUES (?, ?, ?, ?, ?)",
+                [(model, dimensions, text_hash, np.asarray(vector), now) for text_hash, vector in embeddings.items()],
+            )
+            cur.execute("SELECT COUNT(*) FROM embeddings")
+            self._entries = cur.fetchone()[0]
+            if self._entries > self.max_entries:
+                # evicts down to 90% of the cap, so the next insertions do not evict one by one
+                excess = self._entries - int(0.9 * self.max_entries)
+                cur.execute("SELECT model, dimensions, text_hash FROM embeddings ORDER BY last_used LIMIT ?", (excess,))
+                evicted = cur.fetchall()
+                cur.executemany("DELETE FROM embeddings WHERE model = ? AND dimensions = ? AND text_hash = ?", evicted)
+                self._entries -= len(evicted)
+                with self._lock:
+                    self.evictions += len(evicted)
+                    for key in evicted:
+                        self._hot.pop(key, None)
+
+    def _remember(self, key: tuple, vector: np.ndarray):
+        """
+        Puts a vector into the in-memory tier, dropping its least recently used entries (call with `_lock` held).
+        """
+        self._hot[key] = vector
+        self._hot.move_to_end(key)
+        while len(self._hot) > self.hot_entries:
+            self._hot.popitem(last=False)
+
+    @staticmethod
+    def _write_touches(cur, touched: dict):
+        cur.executemany(
+            "UPDATE embeddings SET last_used = ? WHERE model = ? AND dimensions = ? AND text_hash = ?",
+            [(used, *key) for key, used in touched.items()],
+        )
+
+    def stats(self) -> dict:
+        """
+        :return: Number of entries, hits served from memory and from the file, misses, hit rate and evictions
+        """
+        lookups = self.hot_hits + self.disk_hits + self.misses
+        return {
+            "entries": self._entries,
+            "hot_hits": self.hot_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hot_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+    def _close(self):
+        """
+        Writes back the recent uses of the in-memory tier and closes the connections.
+        """
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        if touched:
+            with self._write() as cur:
+                self._write_touches(cur, touched)
+        super()._close()
@@ -0,0 +1,1024 @@
+import heapq
+import math
+
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+from Midterm.quantization import QUANTIZERS, dump_state, load_state
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """
+    Scales every row of a matrix to unit length, so that dot products become cosine similarities.
+    Rows with zero norm are left as zeros, matching sklearn's cosine_similarity.
+
+    :param matrix: 2D array of vectors (one per row)
+    :return: float32 array with L2-normalized rows
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """
+    Selects positions of the top-k scores, best first, using argpartition instead of a full sort.
+    Ties are ordered the same way as np.argsort(scores)[::-1] (later positions first).
+
+    :param scores: 1D array of similarity scores
+    :param top_k: Number of positions to return
+    :return: Positions of the best scores in descending order
+    """
+    k = min(top_k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.lexsort((-top, -scores[top]))]
+
+
+def positions_of(ids: np.ndarray, wanted: np.ndarray) -> np.ndarray:
+    """
+    Maps row ids to their positions in `ids`. Ids that are not present map to -1.
+
+    :param ids: Row id of every position (-1 for empty positions)
+    :param wanted: Row ids to look up
+    :return: Position of every wanted id
+    """
+    order = np.argsort(ids, kind="stable")
+    sorted_ids = ids[order]
+    found = np.searchsorted(sorted_ids, wanted)
+    found = np.minimum(found, len(sorted_ids) - 1)
+    positions = order[found]
+    positions[sorted_ids[found] != wanted] = -1
+    return positions
+
+
+class SearchIndex:
+    """
+    Search backend interface of VectorDB. A backend indexes positions into the VectorDB's vector
+    matrix (`db._matrix`, whose row ids are `db._ids`; -1 marks an empty position) and returns
+    positions of the best matches. Backends persist themselves in the collection's database.
+    """
+
+    name = ""
+    # whether VectorDB should keep the full-precision vectors in memory for this backend
+    resident = True
+
+    @property
+    def trained(self) -> bool:
+        """
+        Whether the backend can answer queries; VectorDB falls back to exact search otherwise.
+        """
+        return True
+
+    def build(self, db):
+        """
+        Builds the backend from every vector of the loaded matrix, replacing any persisted state.
+
+        :param db: VectorDB whose matrix is loaded
+        :return:
+        """
+
+    def load(self, db) -> bool:
+        """
+        Restores persisted state for the loaded matrix.
+
+        :param db: VectorDB whose matrix is loaded
+        :return: True if persisted state was found, False if the backend has to be built
+        """
+        return True
+
+    def add(self, db, positions: np.ndarray):
+        """
+        Indexes rows that were appended to the matrix.
+
+        :param db: VectorDB whose matrix is loaded
+        :param positions: Positions of the new rows
+        :return:
+        """
+
+    def remove(self, db, positions: np.ndarray):
+        """
+        Drops deleted rows from the persisted state. Called once the transaction that deletes the
+        rows has committed (see VectorDB._tombstone), in a write transaction of its own, before
+        their positions are tombstoned (their ids set to -1); searches already skip tombstoned
+        positions, so in-memory structures may keep them until `compact`.
+
+        The backend's state is therefore not atomic with the deletion: if the process stops
+        between the commit and this call, the persisted state keeps entries of rows that no
+        longer exist. `load` has to ignore ids that are not in the matrix (ids are never reused),
+        so they only cost space, and for HNSW the links around the deleted nodes are dropped
+        without being repaired, until the next `build`.
+
+        :param db: VectorDB whose matrix is loaded
+        :param positions: Positions of the deleted rows
+        :return:
+        """
+
+    def compact(self, db):
+        """
+        Called after VectorDB.compact dropped the tombstoned positions from the matrix, which
+        renumbers all positions. By default the persisted state is loaded again.
+
+        :param db: VectorDB whose matrix is loaded
+        :return:
+        """
+        if not self.load(db):
+            self.build(db)
+
+    def snapshot(self, db) -> dict:
+        """
+        Returns the in-memory state for VectorDB's snapshot files, so that a restart can restore it
+        without reading the persisted state back from the database.
+
+        :param db: VectorDB whose matrix is loaded
+        :return: Dict of numpy arrays, empty if there is nothing to save
+        """
+        return {}
+
+    def restore(self, db, state: dict) -> bool:
+        """
+        Restores the state returned by `snapshot` for the matrix restored from the same snapshot.
+        By default the persisted state is loaded instead.
+
+        :param db: VectorDB whose matrix was restored
+        :param state: Arrays saved by `snapshot`
+        :return: True if the backend is ready, False if it has to be built
+        """
+        return self.load(db)
+
+    def search(self, db, query: np.ndarray, top_k: int) -> np.ndarray:
+        """
+        :param db: VectorDB whose matrix is loaded
+        :param query: Normalized query vector
+        :param top_k: Number of positions to return
+        :return: (positions, cosine similarities) of the best rows, best first
+        """
+        raise NotImplementedError
+
+    def search_many(self, db, queries: np.ndarray, top_k: int) -> list:
+        """
+        :param db: VectorDB whose matrix is loaded
+        :param queries: 2D array of normalized query vectors
+        :param top_k: Number of positions to return per query
+        :return: Per query, (positions, cosine similarities) of the best rows, best first
+        """
+        return [self.search(db, query, top_k) for query in queries]
+
+
+class ExactIndex(SearchIndex):
+    """
+    Brute-force backend: scores every vector of the matrix.
+    """
+
+    name = "exact"
+
+    def search(self, db, query: np.ndarray, top_k: int) -> np.ndarray:
+        return db._score_blocks(query, top_k)
+
+    def search_many(self, db, queries: np.ndarray, top_k: int) -> list:
+        return db._score_blocks_many(queries, top_k)
+
+
+class IVFIndex(SearchIndex):
+    """
+    Inverted-file index: vectors are partitioned with spherical k-means and a query only scores the
+    vectors of the `nprobe` lists whose centroids are closest to it.
+
+    The index keeps positions into the VectorDB's vector matrix, not copies of the vectors, so it
+    works the same with the resident matrix and with the memory-mapped sidecar. Centroids and the
+    list of every row are persisted in the collection's database so the index survives restarts.
+    """
+
+    name = "ivf"
+
+    def __init__(self, n_lists: int = None, nprobe: int = 8, min_train_size: int = 1024,
+                 retrain_growth: float = 2.0, seed: int = 0):
+        """
+        :param n_lists: Number of k-means lists, default 4 * sqrt(number of vectors)
+        :param nprobe: Number of lists scored per query
+        :param min_train_size: Below this many vectors the index is not trained and search is exact
+        :param retrain_growth: Retrain when the collection has grown by this factor since training
+        :param seed: Random seed for k-means
+        """
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.min_train_size = min_train_size
+        self.retrain_growth = retrain_growth
+        self.seed = seed
+        self.centroids = None
+        self.lists = []
+        self.trained_size = 0
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    def _table(self, db) -> str:
+        return f"{db.collection_name}_ivf"
+
+    def _create_table(self, db):
+        with db._write() as cur:
+            cur.execute(
+                f"CREATE TABLE IF NOT EXISTS {self._table(db)} (id INTEGER PRIMARY KEY, list_no INTEGER NOT NULL)"
+            )
+
+    def _assign(self, matrix, positions: np.ndarray, block_size: int = 65536) -> np.ndarray:
+        """
+        Finds the nearest centroid of every given row.
+
+        :param matrix: Vector matrix of the collection
+        :param positions: Rows to assign
+        :param block_size: Number of rows scored at once
+        :return: List number of every row
+        """
+        assignments = np.empty(len(positions), dtype=np.int64)
+        for start in range(0, len(positions), block_size):
+            block = np.asarray(matrix[positions[start:start + block_size]])
+            assignments[start:start + len(block)] = np.argmax(block @ self.centroids.T, axis=1)
+        return assignments
+
+    def _fill_lists(self, positions: np.ndarray, assignments: np.ndarray):
+        """
+        Appends positions to their lists.
+        """
+        order = np.argsort(assignments, kind="stable")
+        bounds = np.searchsorted(assignments[order], np.arange(len(self.centroids) + 1))
+        for list_no in range(len(self.centroids)):
+            members = positions[order[bounds[list_no]:bounds[list_no + 1]]]
+            if len(members):
+                self.lists[list_no] = np.concatenate([self.lists[list_no], members])
+
+    def _save_assignments(self, db, positions: np.ndarray, assignments: np.ndarray):
+        with db._write() as cur:
+            cur.executemany(
+                f"INSERT OR REPLACE INTO {self._table(db)} (id, list_no) VALUES (?, ?)",
+                zip(db._ids[positions].tolist(), assignments.tolist()),
+            )
+
+    def build(self, db):
+        """
+        Trains the centroids on the collection and assigns every vector, replacing any persisted index.
+
+        :param db: VectorDB whose matrix is loaded
+        :return:
+        """
+        positions = np.flatnonzero(db._ids >= 0)
+        if len(positions) < self.min_train_size:
+            self.centroids = None
+            self.lists = []
+            return
+
+        n_lists = self.n_lists or int(4 * np.sqrt(len(positions)))
+        n_lists = max(1, min(n_lists, len(positions) // 39))
+        rng = np.random.default_rng(self.seed)
+        sample_size = min(len(positions), max(n_lists * 64, 10000))
+        sample = np.sort(rng.choice(positions, size=sample_size, replace=False))
+
+        kmeans = MiniBatchKMeans(n_clusters=n_lists, batch_size=4096, n_init=1, random_state=self.seed)
+        kmeans.fit(np.asarray(db._matrix[sample]))
+        centroids = kmeans.cluster_centers_.astype(np.float32)
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        self.centroids = centroids / norms
+
+        assignments = self._assign(db._matrix, positions)
+        self.lists = [np.empty(0, dtype=np.int64) for _ in range(n_lists)]
+        self._fill_lists(positions, assignments)
+        self.trained_size = len(positions)
+
+        with db._write() as cur:
+            self._create_table(db)
+            cur.execute(f"DELETE FROM {self._table(db)}")
+            self._save_assignments(db, positions, assignments)
+            db._set_meta("ivf_centroids", self.centroids.astype("<f4").tobytes())
+            db._set_meta("ivf_lists", n_lists)
+            db._set_meta("ivf_trained_size", self.trained_size)
+
+    def load(self, db) -> bool:
+        """
+        Restores the persisted index for the loaded matrix. Rows that have no persisted list yet
+        are assigned and saved.
+
+        :param db: VectorDB whose matrix is loaded
+        :return: True if a persisted index was found
+        """
+        blob = db._get_meta("ivf_centroids")
+        if blob is None or db._matrix is None:
+            return False
+        n_lists = int(db._get_meta("ivf_lists"))
+        centroids = np.frombuffer(blob, dtype="<f4").reshape(n_lists, -1)
+        if centroids.shape[1] != db._matrix.shape[1]:
+            return False
+
+        self.centroids = centroids
+        self.trained_size = int(db._get_meta("ivf_trained_size", 0))
+        self.lists = [np.empty(0, dtype=np.int64) for _ in range(n_lists)]
+
+        self._create_table(db)
+        with db._read() as cur:
+            cur.execute(f"SELECT id, list_no FROM {self._table(db)}")
+            rows = np.array(cur.fetchall(), dtype=np.int64).reshape(-1, 2)
+        positions = positions_of(db._ids, rows[:, 0])
+        known = positions >= 0
+        self._fill_lists(positions[known], rows[known, 1])
+
+        assigned = np.zeros(len(db._ids), dtype=bool)
+        assigned[positions[known]] = True
+        missing = np.flatnonzero(~assigned & (db._ids >= 0))
+        if len(missing):
+            self.add(db, missing)
+        return True
+
+    def add(self, db, positions: np.ndarray):
+        """
+        Adds new rows of the matrix to the index, training or retraining it when the collection
+        has grown enough.
+
+        :param db: VectorDB whose matrix is loaded
+        :param positions: Positions of the new rows
+        :return:
+        """
+        size = int(np.count_nonzero(db._ids >= 0))
+        if not self.trained:
+            if size >= self.min_train_size:
+                self.build(db)
+            return
+        if size >= self.retrain_growth * self.trained_size:
+            self.build(db)
+            return
+
+        positions = positions[db._ids[positions] >= 0]
+        assignments = self._assign(db._matrix, positions)
+        self._fill_lists(positions, assignments)
+        with db._write():
+            self._create_table(db)
+            self._save_assignments(db, positions, assignments)
+
+    def remove(self, db, positions: np.ndarray):
+        self._create_table(db)
+        with db._write() as cur:
+            cur.executemany(
+                f"DELETE FROM {self._table(db)} WHERE id = ?", [(i,) for i in db._ids[positions].tolist()]
+            )
+
+    def compact(self, db):
+        """
+        Reloads the lists for the renumbered positions, or retrains the centroids if the
+        collection has shrunk by `retrain_growth` since they were trained.
+        """
+        size = int(np.count_nonzero(db._ids >= 0))
+        if self.trained and size * self.retrain_growth <= self.trained_size:
+            self.build(db)
+            return
+        super().compact(db)
+
+    def snapshot(self, db) -> dict:
+        if not self.trained:
+            return {}
+        return {
+            "centroids": self.centroids,
+            "list_sizes": np.array([len(members) for members in self.lists], dtype=np.int64),
+            "list_members": np.concatenate(self.lists),
+            "trained_size": np.array(self.trained_size),
+        }
+
+    def restore(self, db, state: dict) -> bool:
+        # the index may have been retrained since the snapshot was taken
+        if "centroids" not in state or int(state["trained_size"]) != int(db._get_meta("ivf_trained_size", 0)):
+            return self.load(db)
+        self.centroids = state["centroids"]
+        self.trained_size = int(state["trained_size"])
+        self.lists = np.split(state["list_members"], np.cumsum(state["list_sizes"])[:-1])
+        return True
+
+    def search(self, db, query: np.ndarray, top_k: int) -> np.ndarray:
+        """
+        Scores only the vectors in the `nprobe` lists closest to the query.
+
+        :param db: VectorDB whose matrix is loaded
+        :param query: Normalized query vector
+        :param top_k: Number of positions to return
+        :return: (positions, cosine similarities) of the best rows, best first
+        """
+        probe = top_k_indices(self.centroids @ query, self.nprobe)
+        candidates = np.concatenate([self.lists[list_no] for list_no in probe])
+        if len(candidates) == 0:
+            return candidates, np.empty(0, dtype=np.float32)
+        scores = np.asarray(db._matrix[candidates]) @ query
+        scores[db._ids[candidates] < 0] = -np.inf
+        top = top_k_indices(scores, top_k)
+        return candidates[top], scores[top]
+
+
+class HNSWIndex(SearchIndex):
+    """
+    Hierarchical navigable small world graph (Malkov & Yashunin) in pure Python/NumPy.
+
+    Every vector is a node on level 0 and, with exponentially decreasing probability, on higher
+    levels; a query descends greedily from the top level and runs a best-first search with
+    `ef_search` candidates on level 0. Nodes are inserted incrementally and every touched
+    adjacency list is written to the collection's `<collection>_hnsw` table, keyed by row id, so
+    the graph is loaded rather than rebuilt on startup.
+    """
+
+    name = "hnsw"
+
+    def __init__(self, M: int = 16, ef_construction: int = 100, ef_search: int = 50, seed: int = 0):
+        """
+        :param M: Number of links per node on the upper levels (2 * M on level 0)
+        :param ef_construction: Candidate list size while inserting
+        :param ef_search: Candidate list size while searching
+        :param seed: Random seed for level assignment
+        """
+        self.M = M
+        self.m_max0 = 2 * M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.level_mult = 1 / math.log(M)
+        self.rng = np.random.default_rng(seed)
+        self._reset()
+
+    def _reset(self):
+        self.graph = []
+        self.entry_point = None
+        self.max_level = -1
+        self._dirty = set()
+
+    @property
+    def trained(self) -> bool:
+        return self.entry_point is not None
+
+    def _table(self, db) -> str:
+        return f"{db.collection_name}_hnsw"
+
+    def _create_table(self, db):
+        with db._write() as cur:
+            cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self._table(db)} (
+                id INTEGER NOT NULL,
+                level INTEGER NOT NULL,
+                neighbors BLOB NOT NULL,
+                PRIMARY KEY (id, level)
+            )""")
+
+    def _search_layer(self, matrix, query: np.ndarray, entry_points: list, ef: int, level: int) -> list:
+        """
+        Best-first search on one level of the graph.
+
+        :return: Up to `ef` (similarity, position) pairs, in no particular order
+        """
+        graph = self.graph[level]
+        visited = set(entry_points)
+        similarities = (np.asarray(matrix[entry_points]) @ query).tolist()
+        candidates = [(-sim, pos) for sim, pos in zip(similarities, entry_points)]
+        heapq.heapify(candidates)
+        results = [(sim, pos) for sim, pos in zip(similarities, entry_points)]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            neg_sim, pos = heapq.heappop(candidates)
+            if -neg_sim < results[0][0] and len(results) >= ef:
+                break
+            neighbors = [n for n in graph.get(pos, ()) if n not in visited]
+            if not neighbors:
+                continue
+            visited.update(neighbors)
+            for sim, n in zip((np.asarray(matrix[neighbors]) @ query).tolist(), neighbors):
+                if len(results) < ef or sim > results[0][0]:
+                    heapq.heappush(candidates, (-sim, n))
+                    heapq.heappush(results, (sim, n))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return results
+
+    def _select_neighbors(self, matrix, candidates: list, m: int) -> list:
+        """
+        Neighbour selection heuristic: a candidate is kept if it is closer to the base node than to
+        every neighbour already kept, which keeps links spread across clusters. Remaining slots are
+        filled with the closest discarded candidates.
+
+        :param candidates: (similarity to the base node, position) pairs
+        :param m: Maximum number of neighbours
+        :return: Selected positions
+        """
+        if len(candidates) <= m:
+            return [pos for _, pos in candidates]
+        candidates = sorted(candidates, reverse=True)
+        positions = [pos for _, pos in candidates]
+        vectors = np.asarray(matrix[positions])
+        gram = vectors @ vectors.T
+
+        selected = []
+        discarded = []
+        for i, (sim, pos) in enumerate(candidates):
+            if not selected or gram[i, selected].max() < sim:
+                selected.append(i)
+                if len(selected) == m:
+                    break
+            else:
+                discarded.append(i)
+        selected += discarded[:m - len(selected)]
+        return [positions[i] for i in selected]
+
+    def _insert(self, matrix, pos: int):
+        query = np.asarray(matrix[pos])
+        level = int(-math.log(1.0 - self.rng.random()) * self.level_mult)
+        while len(self.graph) <= level:
+            self.graph.append({})
+        for lvl in range(level + 1):
+            self._dirty.add((pos, lvl))
+
+        if self.entry_point is None:
+            for lvl in range(level + 1):
+                self.graph[lvl][pos] = []
+            self.entry_point, self.max_level = pos, level
+            return
+
+        entry_points = [self.entry_point]
+        for lvl in range(self.max_level, level, -1):
+            entry_points = [max(self._search_layer(matrix, query, entry_points, 1, lvl))[1]]
+
+        for lvl in range(min(level, self.max_level), -1, -1):
+            found = self._search_layer(matrix, query, entry_points, self.ef_construction, lvl)
+            m_max = self.m_max0 if lvl == 0 else self.M
+            neighbors = self._select_neighbors(matrix, found, self.M)
+            self.graph[lvl][pos] = neighbors
+            for n in neighbors:
+                links = self.graph[lvl][n]
+                links.append(pos)
+                if len(links) > m_max:
+                    sims = (np.asarray(matrix[links]) @ np.asarray(matrix[n])).tolist()
+                    self.graph[lvl][n] = self._select_neighbors(matrix, list(zip(sims, links)), m_max)
+                self._dirty.add((n, lvl))
+            entry_points = [p for _, p in found]
+
+        for lvl in range(self.max_level + 1, level + 1):
+            self.graph[lvl][pos] = []
+        if level > self.max_level:
+            self.entry_point, self.max_level = pos, level
+
+    def _save(self, db):
+        """
+        Writes the adjacency lists touched since the last save, and the entry point.
+        """
+        rows = []
+        for pos, lvl in self._dirty:
+            neighbors = np.asarray(db._ids[self.graph[lvl][pos]], dtype="<i8")
+            rows.append((int(db._ids[pos]), lvl, neighbors.tobytes()))
+        with db._write() as cur:
+            self._create_table(db)
+            cur.executemany(
+                f"INSERT OR REPLACE INTO {self._table(db)} (id, level, neighbors) VALUES (?, ?, ?)", rows
+            )
+            if self.entry_point is not None:
+                db._set_meta("hnsw_entry", int(db._ids[self.entry_point]))
+                db._set_meta("hnsw_max_level", self.max_level)
+        self._dirty = set()
+
+    def build(self, db):
+        self._reset()
+        with db._write() as cur:
+            self._create_table(db)
+            cur.execute(f"DELETE FROM {self._table(db)}")
+            db._set_meta("hnsw_entry", None)
+        self.add(db, np.flatnonzero(db._ids >= 0))
+
+    def load(self, db) -> bool:
+        entry = db._get_meta("hnsw_entry")
+        if entry is None or db._matrix is None:
+            return False
+        self._reset()
+        self._create_table(db)
+        with db._read() as cur:
+            cur.execute(f"SELECT id, level, neighbors FROM {self._table(db)}")
+            rows = cur.fetchall()
+        if not rows:
+            return False
+
+        node_positions = positions_of(db._ids, np.array([row[0] for row in rows], dtype=np.int64))
+        neighbor_ids = [np.frombuffer(row[2], dtype="<i8") for row in rows]
+        neighbor_positions = positions_of(db._ids, np.concatenate(neighbor_ids))
+        self.graph = [{} for _ in range(int(db._get_meta("hnsw_max_level")) + 1)]
+        offset = 0
+        for (_, lvl, _), pos, ids in zip(rows, node_positions, neighbor_ids):
+            links = neighbor_positions[offset:offset + len(ids)]
+            offset += len(ids)
+            if pos >= 0:
+                self.graph[lvl][int(pos)] = links[links >= 0].tolist()
+
+        entry_position = positions_of(db._ids, np.array([entry], dtype=np.int64))[0]
+        if entry_position < 0:
+            return False
+        self.entry_point = int(entry_position)
+        self.max_level = len(self.graph) - 1
+
+        indexed = np.zeros(len(db._ids), dtype=bool)
+        indexed[list(self.graph[0])] = True
+        missing = np.flatnonzero(~indexed & (db._ids >= 0))
+        if len(missing):
+            self.add(db, missing)
+        return True
+
+    def snapshot(self, db) -> dict:
+        if not self.trained:
+            return {}
+        state = {"entry_point": np.array(self.entry_point), "M": np.array(self.M)}
+        for lvl, layer in enumerate(self.graph):
+            nodes = list(layer)
+            state[f"nodes_{lvl}"] = np.array(nodes, dtype=np.int64)
+            state[f"degrees_{lvl}"] = np.array([len(layer[pos]) for pos in nodes], dtype=np.int64)
+            state[f"links_{lvl}"] = np.array([link for pos in nodes for link in layer[pos]], dtype=np.int64)
+        return state
+
+    def restore(self, db, state: dict) -> bool:
+        if "entry_point" not in state or int(state["M"]) != self.M:
+            return self.load(db)
+        entry_point = int(state["entry_point"])
+        # the graph may have been rebuilt since the snapshot was taken
+        if db._get_meta("hnsw_entry") != int(db._ids[entry_point]):
+            return self.load(db)
+        self._reset()
+        levels = sum(key.startswith("nodes_") for key in state)
+        for lvl in range(levels):
+            links = np.split(state[f"links_{lvl}"], np.cumsum(state[f"degrees_{lvl}"])[:-1])
+            nodes = state[f"nodes_{lvl}"].tolist()
+            self.graph.append({pos: neighbors.tolist() for pos, neighbors in zip(nodes, links)})
+        self.entry_point = entry_point
+        self.max_level = levels - 1
+        return True
+
+    def add(self, db, positions: np.ndarray):
+        for pos in positions[db._ids[positions] >= 0].tolist():
+            self._insert(db._matrix, pos)
+        self._save(db)
+
+    def remove(self, db, positions: np.ndarray):
+        """
+        Unlinks the deleted nodes right away, so that the persisted graph stays connected across
+        restarts: every node that linked to a deleted node re-selects its neighbours from its
+        remaining links and the links of the deleted nodes (the repair step of hnswlib).
+        """
+        deleted = set(positions.tolist())
+        matrix = db._matrix
+        for lvl, graph in enumerate(self.graph):
+            removed = {pos: graph.pop(pos) for pos in deleted if pos in graph}
+            if not removed:
+                continue
+            m_max = self.m_max0 if lvl == 0 else self.M
+            for node, links in graph.items():
+                if not any(n in removed for n in links):
+                    continue
+                candidates = {n for n in links if n not in deleted}
+                for n in links:
+                    if n in removed:
+                        candidates.update(c for c in removed[n] if c not in deleted and c != node)
+                candidates = list(candidates)
+                if candidates:
+                    sims = (np.asarray(matrix[candidates]) @ np.asarray(matrix[node])).tolist()
+                    graph[node] = self._select_neighbors(matrix, list(zip(sims, candidates)), m_max)
+                else:
+                    graph[node] = []
+                self._dirty.add((node, lvl))
+        self._dirty = {(pos, lvl) for pos, lvl in self._dirty if pos not in deleted}
+
+        if self.entry_point in deleted:
+            while self.graph and not self.graph[-1]:
+                self.graph.pop()
+            if self.graph:
+                self.max_level = len(self.graph) - 1
+                self.entry_point = next(iter(self.graph[-1]))
+            else:
+                self.entry_point, self.max_level = None, -1
+
+        with db._write() as cur:
+            self._create_table(db)
+            cur.executemany(
+                f"DELETE FROM {self._table(db)} WHERE id = ?", [(db._ids[pos].item(),) for pos in deleted]
+            )
+            if self.entry_point is None:
+                db._set_meta("hnsw_entry", None)
+            self._save(db)
+
+    def search(self, db, query: np.ndarray, top_k: int) -> np.ndarray:
+        entry_points = [self.entry_point]
+        for lvl in range(self.max_level, 0, -1):
+            entry_points = [max(self._search_layer(db._matrix, query, entry_points, 1, lvl))[1]]
+        found = self._search_layer(db._matrix, query, entry_points, max(self.ef_search, top_k), 0)
+        found = heapq.nlargest(top_k, [(sim, pos) for sim, pos in found if db._ids[pos] >= 0])
+        return (np.array([pos for _, pos in found], dtype=np.int64),
+                np.array([sim for sim, _ in found], dtype=np.float32))
+
+
+class QuantizedIndex(SearchIndex):
+    """
+    Compressed backend: the search pass scores compact codes (see quantization.py) instead of
+    float vectors, and only the best `rerank` candidates are rescored against their full-precision
+    vectors, which VectorDB fetches from storage for those rows alone. VectorDB does not keep a
+    resident float matrix for this backend. Codes are persisted in `<collection>_codes`.
+    """
+
+    resident = False
+
+    def __init__(self, quantizer: str, rerank: int = 100, train_size: int = 65536, min_train_size: int = 1024,
+                 block_size: int = 65536, seed: int = 0, **quantizer_params):
+        """
+        :param quantizer: "sq8" or "pq"
+        :param rerank: Number of candidates rescored with full-precision vectors
+        :param train_size: Number of sampled vectors the quantizer is trained on
+        :param min_train_size: Below this many vectors the index is not trained and search is exact
+        :param block_size: Number of codes scored at once
+        :param seed: Random seed for sampling
+        :param quantizer_params: Keyword arguments for the quantizer, e.g. m for "pq"
+        """
+        self.quantizer = QUANTIZERS[quantizer](**quantizer_params)
+        self.rerank = rerank
+        self.train_size = train_size
+        self.min_train_size = min_train_size
+        self.block_size = block_size
+        self.seed = seed
+        self.codes = None
+
+    @property
+    def trained(self) -> bool:
+        return self.codes is not None
+
+    @property
+    def compression_ratio(self) -> float:
+        """
+        Size of a float32 vector divided by the size of its code.
+        """
+        if not self.trained:
+            return 1.0
+        return self.dim * 4 / self.quantizer.code_size
+
+    def _table(self, db) -> str:
+        return f"{db.collection_name}_codes"
+
+    def _create_table(self, db):
+        with db._write() as cur:
+            cur.execute(f"CREATE TABLE IF NOT EXISTS {self._table(db)} (id INTEGER PRIMARY KEY, code BLOB NOT NULL)")
+
+    def _encode(self, db, positions: np.ndarray):
+        """
+        Encodes rows in blocks, stores the codes at their positions and persists them.
+        """
+        if len(self.codes) < len(db._ids):
+            grown = np.zeros((len(db._ids), self.codes.shape[1]), dtype=np.uint8)
+            grown[:len(self.codes)] = self.codes
+            self.codes = grown
+
+        self._create_table(db)
+        for start in range(0, len(positions), self.block_size):
+            block = positions[start:start + self.block_size]
+            codes = self.quantizer.encode(db._vectors(block))
+            self.codes[block] = codes
+            with db._write() as cur:
+                cur.executemany(
+                    f"INSERT OR REPLACE INTO {self._table(db)} (id, code) VALUES (?, ?)",
+                    zip(db._ids[block].tolist(), (code.tobytes() for code in codes)),
+                )
+
+    def build(self, db):
+        positions = np.flatnonzero(db._ids >= 0)
+        self.codes = None
+        if len(positions) < self.min_train_size:
+            return
+
+        rng = np.random.default_rng(self.seed)
+        sample = np.sort(rng.choice(positions, size=min(len(positions), self.train_size), replace=False))
+        vectors = db._vectors(sample)
+        self.dim = vectors.shape[1]
+        self.quantizer.train(vectors)
+
+        with db._write() as cur:
+            self._create_table(db)
+            cur.execute(f"DELETE FROM {self._table(db)}")
+            db._set_meta("quantizer", self.quantizer.name)
+            db._set_meta("quantizer_state", dump_state(self.quantizer))
+            db._set_meta("quantizer_dim", self.dim)
+        self.codes = np.zeros((len(db._ids), self.quantizer.code_size), dtype=np.uint8)
+        self._encode(db, positions)
+
+    def load(self, db) -> bool:
+        if db._get_meta("quantizer") != self.quantizer.name:
+            return False
+        load_state(self.quantizer, db._get_meta("quantizer_state"))
+        self.dim = int(db._get_meta("quantizer_dim"))
+
+        self._create_table(db)
+        with db._read() as cur:
+            cur.execute(f"SELECT id, code FROM {self._table(db)}")
+            rows = cur.fetchall()
+        self.codes = np.zeros((len(db._ids), self.quantizer.code_size), dtype=np.uint8)
+        if rows:
+            positions = positions_of(db._ids, np.array([row[0] for row in rows], dtype=np.int64))
+            codes = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.uint8).reshape(len(rows), -1)
+            known = positions >= 0
+            self.codes[positions[known]] = codes[known]
+        else:
+            positions = np.empty(0, dtype=np.int64)
+
+        encoded = np.zeros(len(db._ids), dtype=bool)
+        encoded[positions[positions >= 0]] = True
+        missing = np.flatnonzero(~encoded & (db._ids >= 0))
+        if len(missing):
+            self._encode(db, missing)
+        return True
+
+    def snapshot(self, db) -> dict:
+        if not self.trained:
+            return {}
+        return {
+            "codes": self.codes,
+            "dim": np.array(self.dim),
+            "quantizer_state": np.frombuffer(dump_state(self.quantizer), dtype=np.uint8),
+        }
+
+    def restore(self, db, state: dict) -> bool:
+        # the quantizer may have been retrained since the snapshot was taken
+        if ("codes" not in state or db._get_meta("quantizer") != self.quantizer.name
+                or db._get_meta("quantizer_state") != state["quantizer_state"].tobytes()):
+            return self.load(db)
+        load_state(self.quantizer, state["quantizer_state"].tobytes())
+        self.dim = int(state["dim"])
+        self.codes = state["codes"]
+        return True
+
+    def add(self, db, positions: np.ndarray):
+        if not self.trained:
+            if np.count_nonzero(db._ids >= 0) >= self.min_train_size:
+                self.build(db)
+            return
+        self._encode(db, positions[db._ids[positions] >= 0])
+
+    def remove(self, db, positions: np.ndarray):
+        self._create_table(db)
+        with db._write() as cur:
+            cur.executemany(
+                f"DELETE FROM {self._table(db)} WHERE id = ?", [(i,) for i in db._ids[positions].tolist()]
+            )
+
+    def search(self, db, query: np.ndarray, top_k: int) -> np.ndarray:
+        n_candidates = max(self.rerank, top_k)
+        best_positions = []
+        best_scores = []
+        for start in range(0, len(self.codes), self.block_size):
+            scores = self.quantizer.scores(self.codes[start:start + self.block_size], query)
+            scores[db._ids[start:start + len(scores)] < 0] = -np.inf
+            top = top_k_indices(scores, n_candidates)
+            best_positions.append(top + start)
+            best_scores.append(scores[top])
+        positions = np.concatenate(best_positions)
+        candidates = positions[top_k_indices(np.concatenate(best_scores), n_candidates)]
+        candidates = candidates[db._ids[candidates] >= 0]
+
+        scores = db._vectors(candidates) @ query
+        top = top_k_indices(scores, top_k)
+        return candidates[top], scores[top]
+
+
+class MatryoshkaIndex(SearchIndex):
+    """
+    Two-stage backend for Matryoshka-style embeddings such as text-embedding-3, whose leading
+    dimensions form a meaningful embedding on their own. A coarse pass scores the normalized
+    `coarse_dim`-dimensional prefixes, kept in memory and stored per row in the table's
+    `short_arr` column, and the best `candidates` rows are rescored with their full vectors.
+    VectorDB does not keep a resident full-precision matrix for this backend.
+    """
+
+    name = "matryoshka"
+    resident = False
+
+    def __init__(self, coarse_dim: int = 256, candidates: int = 200, block_size: int = 65536):
+        """
+        :param coarse_dim: Number of leading dimensions used in the coarse pass
+        :param candidates: Number of coarse candidates rescored with full vectors
+        :param block_size: Number of rows read or scored at once
+        """
+        self.coarse_dim = coarse_dim
+        self.candidates = candidates
+        self.block_size = block_size
+        self.short = None
+
+    @property
+    def trained(self) -> bool:
+        return self.short is not None
+
+    def _read_short(self, db, positions: np.ndarray) -> np.ndarray:
+        """
+        Reads the stored prefixes of the given rows, computing and storing the missing ones.
+        """
+        ids = db._ids[positions].tolist()
+        by_id = {}
+        with db._read() as cur:
+            for start in range(0, len(ids), 900):
+                chunk = ids[start:start + 900]
+                placeholders = ", ".join("?" * len(chunk))
+                cur.execute(
+                    f"SELECT id, short_arr FROM {db.collection_name} WHERE id IN ({placeholders})", chunk
+                )
+                by_id.update(cur.fetchall())
+
+        short = np.zeros((len(ids), self.coarse_dim), dtype=np.float32)
+        missing = []
+        for i, row_id in enumerate(ids):
+            vector = by_id.get(row_id)
+            if vector is None or len(vector) != self.coarse_dim:
+                missing.append(i)
+            else:
+                short[i] = vector
+        if missing:
+            missing = np.array(missing)
+            short[missing] = normalize_rows(db._vectors(positions[missing])[:, :self.coarse_dim])
+            with db._write() as cur:
+                cur.executemany(
+                    f"UPDATE {db.collection_name} SET short_arr = ? WHERE id = ?",
+                    zip((vector.astype("<f4").tobytes() for vector in short[missing]),
+                        db._ids[positions[missing]].tolist()),
+                )
+        return short
+
+    def build(self, db):
+        if db._get_meta("short_dim") != self.coarse_dim:
+            with db._write() as cur:
+                db._set_meta("short_dim", self.coarse_dim)
+                cur.execute(f"UPDATE {db.collection_name} SET short_arr = NULL")
+        db._short_dim = self.coarse_dim
+
+        self.short = np.zeros((len(db._ids), self.coarse_dim), dtype=np.float32)
+        positions = np.flatnonzero(db._ids >= 0)
+        for start in range(0, len(positions), self.block_size):
+            block = positions[start:start + self.block_size]
+            self.short[block] = self._read_short(db, block)
+
+    def load(self, db) -> bool:
+        if db._get_meta("short_dim") != self.coarse_dim:
+            return False
+        self.build(db)
+        return True
+
+    def snapshot(self, db) -> dict:
+        return {} if self.short is None else {"short": self.short}
+
+    def restore(self, db, state: dict) -> bool:
+        if ("short" not in state or state["short"].shape[1] != self.coarse_dim
+                or db._get_meta("short_dim") != self.coarse_dim):
+            return self.load(db)
+        db._short_dim = self.coarse_dim
+        self.short = state["short"]
+        return True
+
+    def add(self, db, positions: np.ndarray):
+        if len(self.short) < len(db._ids):
+            grown = np.zeros((len(db._ids), self.coarse_dim), dtype=np.float32)
+            grown[:len(self.short)] = self.short
+            self.short = grown
+        positions = positions[db._ids[positions] >= 0]
+        self.short[positions] = self._read_short(db, positions)
+
+    def search(self, db, query: np.ndarray, top_k: int) -> np.ndarray:
+        coarse_query = normalize_rows(query[:self.coarse_dim].reshape(1, -1))[0]
+        n_candidates = max(self.candidates, top_k)
+        best_positions = []
+        best_scores = []
+        for start in range(0, len(self.short), self.block_size):
+            scores = self.short[start:start + self.block_size] @ coarse_query
+            scores[db._ids[start:start + len(scores)] < 0] = -np.inf
+            top = top_k_indices(scores, n_candidates)
+            best_positions.append(top + start)
+            best_scores.append(scores[top])
+        positions = np.concatenate(best_positions)
+        candidates = positions[top_k_indices(np.concatenate(best_scores), n_candidates)]
+        candidates = candidates[db._ids[candidates] >= 0]
+
+        scores = db._vectors(candidates) @ query
+        top = top_k_indices(scores, top_k)
+        return candidates[top], scores[top]
+
+
+class ScalarQuantizedIndex(QuantizedIndex):
+    name = "sq8"
+
+    def __init__(self, **params):
+        super().__init__(quantizer="sq8", **params)
+
+
+class ProductQuantizedIndex(QuantizedIndex):
+    name = "pq"
+
+    def __init__(self, **params):
+        super().__init__(quantizer="pq", **params)
+
+
+INDEXES = {
+    ExactIndex.name: ExactIndex,
+    IVFIndex.name: IVFIndex,
+    HNSWIndex.name: HNSWIndex,
+    ScalarQuantizedIndex.name: ScalarQuantizedIndex,
+    ProductQuantizedIndex.name: ProductQuantizedIndex,
+    MatryoshkaIndex.name: MatryoshkaIndex,
+}
@@ -1,31 +1,120 @@
 import os
+import threading
+import time
 import numpy as np
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from dotenv import load_dotenv
 import sys
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
                             QLabel, QPushButton, QLineEdit, QTextEdit, QFileDialog, 
-                            QGroupBox, QFrame)
-from PyQt6.QtCore import Qt, QSize
+                            QGroupBox, QFrame, QProgressBar, QMessageBox)
+from PyQt6.QtCore import Qt, QSize, QThread, pyqtSignal
 from PyQt6.QtGui import QFont, QAction
 from pathlib import Path
 
-from sqlite_DB import VectorDB
-from Helpers.pdf import store_pdf_to_db
-from Helpers.txt import store_txt_to_db
+from sqlite_DB import VectorDB, reciprocal_rank_fusion
+from embedding_cache import EmbeddingCache
+from Helpers.embeddings import AsyncEmbeddingPipeline, EmbeddingBatcher
+from Helpers.parsing import ingest_documents
 
 load_dotenv()
 
+
+class IngestionWorker(QThread):
+    """
+    Ingests files with Helpers.parsing.ingest_documents in the background, so the window stays
+    responsive and questions about the documents already loaded can be asked in the meantime.
+    """
+    # file path and its ingestion statistics, once per file
+    file_done = pyqtSignal(str, dict)
+    # file path, chunks done and chunks of the file
+    chunk_progress = pyqtSignal(str, int, int)
+    # error that stopped the whole ingestion
+    failed = pyqtSignal(str)
+
+    def __init__(self, client, db, embedder, file_paths, parent=None):
+        super().__init__(parent)
+        self.client = client
+        self.db = db
+        self.embedder = embedder
+        self.file_paths = file_paths
+        self.cancel_event = threading.Event()
+        self._last_progress = 0.0
+
+    def cancel(self):
+        """
+        Stops the ingestion before the next chunk; the files done so far stay loaded.
+        """
+        self.cancel_event.set()
+
+    def _progress(self, file_path, done, total):
+        # called by the embedding threads after every chunk; the window is updated at most ten times a second
+        now = time.monotonic()
+        if done == total or now - self._last_progress >= 0.1:
+            self._last_progress = now
+            self.chunk_progress.emit(file_path, done, total)
+
+    def run(self):
+        try:
+            # the files are parsed in worker processes and embedded as they finish
+            for file_path, stats in ingest_documents(self.client, self.db, self.file_paths, self.embedder,
+                                                     progress=self._progress, cancel=self.cancel_event):
+                self.file_done.emit(file_path, stats)
+        except Exception as e:
+            self.failed.emit(str(e))
+
+
+class AnswerWorker(QThread):
+    """
+    Retrieves the context of a question and asks the language model in the background, so the
+    window stays responsive while the answer is generated.
+    """
+    # question and its answer
+    answered = pyqtSignal(str, str)
+    # error that stopped the answer
+    failed = pyqtSignal(str)
+
+    def __init__(self, app, question, parent=None):
+        super().__init__(parent)
+        self.app = app
+        self.question = question
+
+    def run(self):
+        try:
+            # hybrid retrieval also finds exact identifiers and rare terms of the question
+            relevant_docs = self.app.retrieve_relevant_contexts(self.question, mode="hybrid")
+            self.answered.emit(self.question, self.app.generate_answer(self.question, relevant_docs))
+        except Exception as e:
+            self.failed.emit(str(e))
+
+
 class DocumentQAApp(QMainWindow):
     def __init__(self):
         super().__init__()
         
         # Initialize database
         self.db = VectorDB(db="midterm.db", collection_name="vectors")
+        # restores the search state from its snapshot, so the first question does not rebuild it
+        self.db.load()
         
         # Setup OpenAI client ( DO NOT FORGET TO PUT IN YOUR API KEY AND MODEL)
         self.client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
         self.LLM = os.environ.get("OPEN_AI_MODEL") # "gpt-3.5-turbo" # example
+        # every text embedded before, chunk or question, is answered from the cache instead of the API
+        self.embedding_cache = EmbeddingCache("embedding_cache.db")
+        # one embedding pipeline for every upload, so they share the API rate limits
+        self.embedder = AsyncEmbeddingPipeline(
+            AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY")),
+            rpm=int(os.environ.get("EMBEDDING_RPM", 3000)),
+            tpm=int(os.environ.get("EMBEDDING_TPM", 1000000)),
+            cache=self.embedding_cache,
+        )
+        # questions are embedded with their own client, so they do not wait behind an upload's
+        # requests for the pipeline's concurrency and rate budgets
+        self.query_embedder = EmbeddingBatcher(self.client, cache=self.embedding_cache)
+        # the running upload and the question being answered, if any
+        self.ingestion = None
+        self.answering = None
         self.chat_history = [
             {"role": "system",
              "content": "You are a semantic document search engine that answers questions based on provided PDF documents or other types of documents. Always try to answer questions from the files and if it's not possible use your knowledge base. When answering from provided documents, include the name of the document and the page number that was used at the end of the answer."}
@@ -47,6 +136,18 @@ class DocumentQAApp(QMainWindow):
         self.setup_document_area()
         self.apply_styles()
         
+    def closeEvent(self, event):
+        if self.ingestion is not None:
+            self.ingestion.cancel()
+            self.ingestion.wait()
+        if self.answering is not None:
+            self.answering.wait()
+        # saves the search snapshot for the next start
+        self.embedder.close()
+        self.embedding_cache._close()
+        self.db._close()
+        super().closeEvent(event)
+
     def setup_header(self):
         header_layout = QHBoxLayout()
         title_label = QLabel("AI Document Question & Answer")
@@ -94,11 +195,20 @@ class DocumentQAApp(QMainWindow):
         self.upload_button.clicked.connect(self.load_document)
         doc_layout.addWidget(self.upload_button)
         
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.clicked.connect(self.cancel_upload)
+        self.cancel_button.setVisible(False)
+        doc_layout.addWidget(self.cancel_button)
+        
         self.file_label = QLabel("No document selected")
         self.file_label.setFont(QFont("Segoe UI", 10))
         doc_layout.addWidget(self.file_label)
         doc_layout.addStretch()
         
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setVisible(False)
+        doc_layout.addWidget(self.progress_bar)
+        
         self.main_layout.addWidget(doc_group)
         
     def apply_styles(self):
@@ -150,7 +260,8 @@ class DocumentQAApp(QMainWindow):
         """
         Allows user to pick a document and load it,
         Extracts the text and stores the document chunks in the
-        database. Accepts only PDF or TXT files.
+        database. Accepts only PDF or TXT files. The files are loaded
+        by an IngestionWorker, so questions can still be asked meanwhile.
 
         :return:
         """
@@ -162,57 +273,168 @@ class DocumentQAApp(QMainWindow):
             "Documents (*.pdf *.txt)"
         )
         
-        self.file_label.setText("Uploading files")
-        self.ask_button.setEnabled(False)
-        self.question_entry.setEnabled(False)
-        
         if len(file_paths) == 0:
             self.file_label.setText("No document(s) selected")
-            self.ask_button.setEnabled(True)
-            self.question_entry.setEnabled(True)
             return
         
-        selected_files = ""
-        
-        for file_path in file_paths:
-            extension = os.path.splitext(file_path)[1]
-            if extension == '.pdf':
-                store_pdf_to_db(self.client, self.db, file_path)
-            elif extension == '.txt':
-                store_txt_to_db(self.client, self.db, file_path)
-            else:
-                print("No extension for you")
-                
-            filename = os.path.basename(file_path)
-            selected_files += f"{filename}, "
-        
-        self.file_label.setText(f"Selected: {selected_files}")
-        
-        self.ask_button.setEnabled(True)
-        self.question_entry.setEnabled(True)
+        self.upload_stats = {"files": [], "embedded": 0, "reused": 0, "cancelled": 0, "errors": []}
+        # per file, the fraction of its chunks stored
+        self.upload_progress = dict.fromkeys(file_paths, 0.0)
+        self.progress_bar.setRange(0, 1000 * len(file_paths))
+        self.progress_bar.setValue(0)
+        self.progress_bar.setVisible(True)
+        self.upload_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+        self.cancel_button.setVisible(True)
+        self.file_label.setText(f"Uploading {len(file_paths)} file(s)")
+        
+        self.ingestion = IngestionWorker(self.client, self.db, self.embedder, file_paths, self)
+        self.ingestion.chunk_progress.connect(self.show_upload_progress)
+        self.ingestion.file_done.connect(self.file_loaded)
+        self.ingestion.failed.connect(self.upload_failed)
+        self.ingestion.finished.connect(self.upload_finished)
+        self.ingestion.start()
+    
+    def cancel_upload(self):
+        """
+        Stops the running upload; the files loaded so far stay searchable.
+        :return:
+        """
+        if self.ingestion is not None:
+            self.ingestion.cancel()
+            self.cancel_button.setEnabled(False)
+            self.file_label.setText("Cancelling upload")
+    
+    def show_upload_progress(self, file_path, done, total):
+        """
+        Updates the progress bar and label with the chunks stored of a file.
+        :param file_path: File being stored
+        :param done: Number of its chunks stored
+        :param total: Number of its chunks
+        :return:
+        """
+        if file_path in self.upload_progress:
+            self.upload_progress[file_path] = done / total if total else 1.0
+        self.progress_bar.setValue(int(1000 * sum(self.upload_progress.values())))
+        if self.cancel_button.isEnabled():
+            files_done = len(self.upload_stats["files"])
+            self.file_label.setText(
+                f"Uploading {files_done + 1}/{len(self.upload_progress)}: "
+                f"{os.path.basename(file_path)} ({done}/{total} chunks)"
+            )
+    
+    def file_loaded(self, file_path, stats):
+        """
+        Records the statistics of a file whose upload ended.
+        :param file_path: The file
+        :param stats: Its statistics from ingest_documents
+        :return:
+        """
+        if stats.get("cancelled"):
+            self.upload_stats["cancelled"] += 1
+        elif "error" in stats:
+            self.upload_stats["errors"].append(f"{os.path.basename(file_path)}: {stats['error']}")
+        else:
+            self.upload_stats["files"].append(os.path.basename(file_path))
+        self.upload_stats["embedded"] += stats["embedded"]
+        self.upload_stats["reused"] += stats["reused"]
+        self.upload_progress[file_path] = 1.0
+        self.progress_bar.setValue(int(1000 * sum(self.upload_progress.values())))
+    
+    def upload_failed(self, error):
+        """
+        Records the error that stopped the whole upload.
+        :param error: The error message
+        :return:
+        """
+        self.upload_stats["errors"].append(error)
     
-    def retrieve_relevant_contexts(self, query, top_k= 3):
+    def upload_finished(self):
+        """
+        Restores the document area once the upload is done or cancelled.
+        :return:
+        """
+        stats = self.upload_stats
+        selected_files = "".join(f"{filename}, " for filename in stats["files"])
+        text = f"Selected: {selected_files}({stats['embedded']} chunks newly embedded, {stats['reused']} reused)"
+        if stats["cancelled"]:
+            text += f", cancelled {stats['cancelled']} file(s)"
+        if stats["errors"]:
+            text += f", {len(stats['errors'])} failed"
+        self.file_label.setText(text)
+        
+        self.ingestion.deleteLater()
+        self.ingestion = None
+        self.progress_bar.setVisible(False)
+        self.cancel_button.setVisible(False)
+        self.upload_button.setEnabled(True)
+        if stats["errors"]:
+            QMessageBox.warning(self, "Upload failed", "Could not load:\n" + "\n".join(stats["errors"]))
+    
+    def retrieve_relevant_contexts(self, query, top_k= 3, sub_queries=None, filenames=None, mode="vector"):
         """
         Retrieves the most relevant chunks from the database
 
         :param query: Input question from the user
         :param top_k:
+        :param sub_queries: Optional list of rephrasings or sub-questions of the query. They are
+            embedded in the same request and searched as one batch; a chunk found by several of
+            them is kept once, with its best similarity.
+        :param filenames: Optional list of uploaded document names to restrict the search to
+        :param mode: "vector" (embedding similarity), "lexical" (BM25 over the full-text index,
+            without an embedding request) or "hybrid" (both, fused with reciprocal rank fusion,
+            so exact identifiers and rare terms are found as well as paraphrases; the scores of
+            the results are then fused rank scores, not cosine similarities)
         :return: A list of relevant document chunks, each containing:
             - 'content' (str): The text content of the chunk.
             - 'source' (str): The filename and page number.
         """
-        res = self.client.embeddings.create(input=query, model="text-embedding-3-large")
-        embedding = res.data[0].embedding
-        embedding = np.array(embedding)
+        if mode not in ("vector", "lexical", "hybrid"):
+            raise ValueError(f"Unknown retrieval mode: {mode}")
+        filters = {"filenames": filenames} if filenames else None
+        texts = [query] + list(sub_queries or [])
+        # every ranking contributes this many candidates to the fusion
+        candidates = max(top_k, 50)
+
+        def fuse(rankings):
+            by_id = {result.id: result for ranking in rankings for result in ranking}
+            fused = reciprocal_rank_fusion([[result.id for result in ranking] for ranking in rankings])
+            return [by_id[row_id]._replace(score=score) for row_id, score in fused[:top_k]]
 
-        relevant_docs = self.db.search(embedding, top_k)
+        if mode == "lexical":
+            relevant_docs = fuse([self.db.search_lexical(text, candidates, filters=filters) for text in texts])
+        elif sub_queries:
+            embeddings = np.array(self.query_embedder.embed(texts))
+
+            if mode == "hybrid":
+                rankings = self.db.search_many(embeddings, candidates, filters=filters)
+                rankings += [self.db.search_lexical(text, candidates, filters=filters) for text in texts]
+                relevant_docs = fuse(rankings)
+            else:
+                best = {}
+                for results in self.db.search_many(embeddings, top_k, filters=filters):
+                    for result in results:
+                        if result.id not in best or result.score > best[result.id].score:
+                            best[result.id] = result
+                relevant_docs = sorted(best.values(), key=lambda result: result.score, reverse=True)[:top_k]
+        else:
+            embedding = self.query_embedder.embed([query])[0]
+
+            if mode == "hybrid":
+                relevant_docs = self.db.search_hybrid(embedding, query, top_k, candidates, filters=filters)
+            else:
+                relevant_docs = self.db.search(embedding, top_k, filters=filters)
 
         top_docs = []
         
         for doc in relevant_docs:
+            source = doc.filename
+            if doc.page_start is not None:
+                pages = doc.page_start if doc.page_start == doc.page_end else f"{doc.page_start}-{doc.page_end}"
+                source += f", {'page' if doc.page_start == doc.page_end else 'pages'} {pages}"
             top_docs.append({
-                'content': doc[3],
-                'source': doc[2]
+                'content': doc.text_content,
+                'source': source
             })
         
         return top_docs
@@ -245,27 +467,51 @@ class DocumentQAApp(QMainWindow):
     def answer_question(self):
         """
         Encapsulates the flow of what the app does when a user asks a question.
+        The answer is generated by an AnswerWorker, one question at a time.
         :return:
         """
         question = self.question_entry.text().strip()
 
-        if not question:
+        if not question or self.answering is not None:
             return
         
-        try:
-            self.answer_text.append(f"\n\nQ: {question}\nA: Thinking...\n")
-            self.answer_text.ensureCursorVisible()
-            QApplication.processEvents()
-            
-            relevant_docs = self.retrieve_relevant_contexts(question)
-            
-            answer = self.generate_answer(question, relevant_docs)
-            
-            self.display_answer(question, answer)
-            self.question_entry.clear()
-        except Exception as e:
-            self.answer_text.append(f"\nError occurred: {str(e)}\n")
-            self.answer_text.ensureCursorVisible()
+        self.answer_text.append(f"\n\nQ: {question}\nA: Thinking...\n")
+        self.answer_text.ensureCursorVisible()
+        self.ask_button.setEnabled(False)
+        
+        self.answering = AnswerWorker(self, question, self)
+        self.answering.answered.connect(self.question_answered)
+        self.answering.failed.connect(self.question_failed)
+        self.answering.finished.connect(self.answer_finished)
+        self.answering.start()
+    
+    def question_answered(self, question, answer):
+        """
+        Shows the answer and clears the question entry.
+        :param question: User question.
+        :param answer: Answer by AI model
+        :return:
+        """
+        self.display_answer(question, answer)
+        self.question_entry.clear()
+    
+    def question_failed(self, error):
+        """
+        Shows the error that stopped an answer.
+        :param error: The error message
+        :return:
+        """
+        self.answer_text.append(f"\nError occurred: {error}\n")
+        self.answer_text.ensureCursorVisible()
+    
+    def answer_finished(self):
+        """
+        Lets the next question be asked.
+        :return:
+        """
+        self.answering.deleteLater()
+        self.answering = None
+        self.ask_button.setEnabled(True)
     
     def display_answer(self, question, answer):
         """
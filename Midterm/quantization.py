@@ -0,0 +1,163 @@
+import io
+
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+
+class ScalarQuantizer:
+    """
+    int8-style scalar quantization: every dimension is mapped linearly from its [min, max] range
+    onto 256 levels and stored as one uint8, i.e. 4x smaller than float32.
+    """
+
+    name = "sq8"
+
+    def __init__(self):
+        self.low = None
+        self.scale = None
+
+    @property
+    def code_size(self) -> int:
+        return len(self.low)
+
+    def train(self, vectors: np.ndarray):
+        """
+        Learns the per-dimension range from a sample of vectors.
+
+        :param vectors: 2D array of normalized vectors
+        :return:
+        """
+        self.low = vectors.min(axis=0).astype(np.float32)
+        high = vectors.max(axis=0).astype(np.float32)
+        self.scale = (high - self.low) / 255
+        self.scale[self.scale == 0] = 1.0
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        :param vectors: 2D array of normalized vectors
+        :return: uint8 codes, one row per vector
+        """
+        codes = np.rint((vectors - self.low) / self.scale)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """
+        Approximate dot products between the decoded codes and a query, without decoding them:
+        (code * scale + low) . q == code . (scale * q) + low . q
+
+        :param codes: uint8 codes
+        :param query: Normalized query vector
+        :return: Approximate similarity of every code
+        """
+        return codes.astype(np.float32) @ (self.scale * query) + float(self.low @ query)
+
+    def state(self) -> dict:
+        return {"low": self.low, "scale": self.scale}
+
+    def set_state(self, state: dict):
+        self.low = state["low"]
+        self.scale = state["scale"]
+
+
+class ProductQuantizer:
+    """
+    Product quantization (Jegou et al.): the vector is split into `m` sub-vectors and each one is
+    replaced by the index of its nearest of 256 k-means centroids, so a vector costs `m` bytes.
+    Queries are scored with asymmetric distance computation: a (m, 256) table of query/centroid
+    dot products is built once and every code is scored by summing m table lookups.
+    """
+
+    name = "pq"
+
+    def __init__(self, m: int = None, seed: int = 0):
+        """
+        :param m: Number of sub-vectors, default dim / 8 (32x smaller than float32)
+        :param seed: Random seed for k-means
+        """
+        self.m = m
+        self.seed = seed
+        self.codebooks = None
+
+    @property
+    def code_size(self) -> int:
+        return self.codebooks.shape[0]
+
+    def _split(self, vectors: np.ndarray) -> np.ndarray:
+        return vectors.reshape(len(vectors), self.codebooks.shape[0], -1)
+
+    def train(self, vectors: np.ndarray):
+        """
+        Learns 256 centroids per sub-space from a sample of vectors.
+
+        :param vectors: 2D array of normalized vectors
+        :return:
+        """
+        dim = vectors.shape[1]
+        m = self.m or max(1, dim // 8)
+        if dim % m:
+            raise ValueError(f"Vector dimension {dim} is not divisible by m={m}")
+        n_centroids = min(256, len(vectors))
+        sub_vectors = vectors.reshape(len(vectors), m, -1)
+
+        codebooks = np.zeros((m, 256, dim // m), dtype=np.float32)
+        for j in range(m):
+            kmeans = MiniBatchKMeans(n_clusters=n_centroids, batch_size=4096, n_init=1, random_state=self.seed)
+            kmeans.fit(sub_vectors[:, j])
+            codebooks[j, :n_centroids] = kmeans.cluster_centers_
+        self.codebooks = codebooks
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        :param vectors: 2D array of normalized vectors
+        :return: uint8 codes of shape (n, m)
+        """
+        sub_vectors = self._split(vectors)
+        codes = np.empty((len(vectors), self.codebooks.shape[0]), dtype=np.uint8)
+        for j, codebook in enumerate(self.codebooks):
+            distances = (
+                (sub_vectors[:, j] ** 2).sum(axis=1, keepdims=True)
+                - 2 * sub_vectors[:, j] @ codebook.T
+                + (codebook ** 2).sum(axis=1)
+            )
+            codes[:, j] = np.argmin(distances, axis=1)
+        return codes
+
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """
+        Approximate dot products between the decoded codes and a query via lookup tables.
+
+        :param codes: uint8 codes of shape (n, m)
+        :param query: Normalized query vector
+        :return: Approximate similarity of every code
+        """
+        tables = np.einsum("mkd,md->mk", self.codebooks, self._split(query.reshape(1, -1))[0])
+        return tables[np.arange(codes.shape[1]), codes].sum(axis=1)
+
+    def state(self) -> dict:
+        return {"codebooks": self.codebooks}
+
+    def set_state(self, state: dict):
+        self.codebooks = state["codebooks"]
+
+
+QUANTIZERS = {
+    ScalarQuantizer.name: ScalarQuantizer,
+    ProductQuantizer.name: ProductQuantizer,
+}
+
+
+def dump_state(quantizer) -> bytes:
+    """
+    Serializes the learned parameters of a quantizer into a single .npz blob.
+    """
+    out = io.BytesIO()
+    np.savez(out, **quantizer.state())
+    return out.getvalue()
+
+
+def load_state(quantizer, blob: bytes):
+    """
+    Restores the learned parameters of a quantizer from `dump_state` output.
+    """
+    with np.load(io.BytesIO(blob)) as state:
+        quantizer.set_state({key: state[key] for key in state.files})
@@ -0,0 +1,410 @@
+import hashlib
+import heapq
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+from Midterm.indexes import normalize_rows
+from Midterm.sqlite_DB import IngestedFile, SearchResult, VectorDB, reciprocal_rank_fusion
+
+# Result ids of a sharded collection carry the shard number in their high bits, so they stay unique
+# across shards: global id = shard << SHARD_ID_BITS | row id of the shard.
+SHARD_ID_BITS = 40
+
+
+def global_id(shard: int, row_id: int) -> int:
+    return shard << SHARD_ID_BITS | row_id
+
+
+def split_id(row_id: int) -> Tuple[int, int]:
+    """
+    :param row_id: Result id of a sharded collection
+    :return: (shard number, row id within the shard)
+    """
+    return row_id >> SHARD_ID_BITS, row_id & ((1 << SHARD_ID_BITS) - 1)
+
+
+class ShardedVectorDB:
+    def __init__(self, db: str, collection_name: str, shards: int = 4, routing: str = "hash",
+                 max_shard_rows: int = 1000000, workers: int = None, **options):
+        """
+        A collection split across several VectorDB shard files (`midterm.shard0.db`, `midterm.shard1.db`, ...).
+        Searches fan out to every shard on a thread pool and the per-shard top-k lists are merged
+        with a heap. Threads suffice: numpy's matrix products and SQLite release the GIL, and each
+        shard keeps its own resident matrix, index and connections, so shards are scored in parallel.
+
+        Chunks are routed by document: all chunks of a file live in the same shard, so `delete`,
+        `replace` and the ingested-file records stay local to one shard and one transaction.
+
+        :param db: Path of the database; shard files are created next to it
+        :param collection_name: Name of the collection in every shard
+        :param shards: Number of shards for "hash" routing (initial number for "size" routing)
+        :param routing: "hash" (a file goes to the shard selected by the hash of its name, so shards
+            stay evenly filled) or "size" (files are appended to the last shard, and a new shard is
+            started once it holds `max_shard_rows` records)
+        :param max_shard_rows: Shard size limit for "size" routing
+        :param workers: Number of search threads, default one per shard up to the number of cores
+        :param options: Further VectorDB arguments (vector_type, storage, index, ...) used for every shard
+
+        The number of shards and the routing are stored in the first shard and must not change
+        afterwards, since hash routing depends on them.
+        """
+        if routing not in ("hash", "size"):
+            raise ValueError(f"Unknown routing: {routing}")
+        self.collection_name = collection_name
+        self.routing = routing
+        self.max_shard_rows = max_shard_rows
+        self.options = options
+        self._root, self._ext = os.path.splitext(db)
+        self._memory = db == ":memory:"
+        self._lock = threading.RLock()
+        self._rows = {}
+        self._file_shards = {}
+
+        self.shards = [self._open_shard(0)]
+        stored_shards = self.shards[0]._get_meta("shards")
+        stored_routing = self.shards[0]._get_meta("shard_routing")
+        if stored_shards is None:
+            stored_shards = shards
+            with self.shards[0]._write():
+                self.shards[0]._set_meta("shards", shards)
+                self.shards[0]._set_meta("shard_routing", routing)
+        elif stored_routing != routing or (routing == "hash" and stored_shards != shards):
+            raise ValueError(f"Collection was sharded with {stored_shards} shards and "
+                             f"{stored_routing} routing, not {shards} and {routing}")
+        self.shards += [self._open_shard(i) for i in range(1, stored_shards)]
+        self.workers = workers or min(len(self.shards), os.cpu_count() or 1)
+        self._pool = None
+
+    def _shard_path(self, shard: int) -> str:
+        return ":memory:" if self._memory else f"{self._root}.shard{shard}{self._ext}"
+
+    def _open_shard(self, shard: int) -> VectorDB:
+        return VectorDB(self._shard_path(shard), self.collection_name, **self.options)
+
+    def _executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="shard")
+            return self._pool
+
+    def _fan_out(self, function, shards: List[int] = None) -> list:
+        """
+        Calls function(shard number, shard) for every shard in parallel.
+
+        :return: The results, in shard order
+        """
+        shards = range(len(self.shards)) if shards is None else shards
+        if len(shards) == 1:
+            return [function(shards[0], self.shards[shards[0]])]
+        return list(self._executor().map(lambda shard: function(shard, self.shards[shard]), shards))
+
+    def _shard_rows(self, shard: int) -> int:
+        if shard not in self._rows:
+            with self.shards[shard]._read() as cur:
+                cur.execute(f"SELECT COUNT(*) FROM {self.collection_name}")
+                self._rows[shard] = cur.fetchone()[0]
+        return self._rows[shard]
+
+    def _holding_shard(self, filename: str):
+        """
+        :return: Number of the shard holding records or the ingested-file record of a file, or None
+        """
+        def holds(shard, db):
+            with db._read() as cur:
+                cur.execute(f"SELECT 1 FROM {self.collection_name} WHERE filename = ? LIMIT 1", (filename,))
+                if cur.fetchone():
+                    return True
+            return db.ingested_file(filename) is not None
+
+        return next((shard for shard, held in enumerate(self._fan_out(holds)) if held), None)
+
+    def shard_of(self, filename: str) -> int:
+        """
+        Routes a file to its shard.
+
+        :param filename: Name of the file
+        :return: Shard number
+        """
+        if self.routing == "hash":
+            return int(hashlib.sha1(filename.encode()).hexdigest()[:8], 16) % len(self.shards)
+
+        with self._lock:
+            if filename not in self._file_shards:
+                shard = self._holding_shard(filename)
+                if shard is None:
+                    shard = len(self.shards) - 1
+                    if self._shard_rows(shard) >= self.max_shard_rows:
+                        shard = self._add_shard()
+                self._file_shards[filename] = shard
+            return self._file_shards[filename]
+
+    def _add_shard(self) -> int:
+        with self._lock:
+            shard = len(self.shards)
+            self.shards.append(self._open_shard(shard))
+            self._rows[shard] = 0
+            self.shards[0]._set_meta("shards", len(self.shards))
+            return shard
+
+    def ingested_file(self, filename: str) -> IngestedFile:
+        """
+        See `VectorDB.ingested_file`.
+        """
+        return self.shards[self.shard_of(filename)].ingested_file(filename)
+
+    def record_file(self, filename: str, fingerprint: str, chunks: int, size: int = None, mtime: float = None,
+                    pages: List[Tuple[int, str]] = None):
+        """
+        See `VectorDB.record_file`.
+        """
+        self.shards[self.shard_of(filename)].record_file(filename, fingerprint, chunks, size, mtime, pages)
+
+    def ingested_pages(self, filename: str) -> set:
+        """
+        See `VectorDB.ingested_pages`.
+        """
+        return self.shards[self.shard_of(filename)].ingested_pages(filename)
+
+    def file_hashes(self, filename: str) -> set:
+        """
+        See `VectorDB.file_hashes`.
+        """
+        return self.shards[self.shard_of(filename)].file_hashes(filename)
+
+    def vectors_by_hash(self, hashes: List[str]) -> dict:
+        """
+        See `VectorDB.vectors_by_hash`; all shards are searched.
+        """
+        found = {}
+        for shard_found in self._fan_out(lambda shard, db: db.vectors_by_hash(hashes)):
+            found.update(shard_found)
+        return found
+
+    def insert(self, data: List[Tuple[np.array, str, str]]) -> int:
+        """
+        See `VectorDB.insert`; every record goes to the shard of its file.
+        """
+        return self.bulk_insert(data, batch_size=max(len(data), 1))["rows"]
+
+    def bulk_insert(self, records: Iterable[tuple], batch_size: int = 1000) -> dict:
+        """
+        See `VectorDB.bulk_insert`. Every batch is split by shard and the parts are written to their
+        shards in parallel, one transaction per shard; the shards' matrices and indexes are updated
+        once, after the last batch.
+
+        :return: Statistics as `VectorDB.bulk_insert`, with batches counting per-shard transactions
+        """
+        records = iter(records)
+        rows = 0
+        skipped = 0
+        batches = 0
+        write_seconds = 0.0
+        touched = set()
+        start = time.perf_counter()
+
+        def write(shard, db):
+            return db._write_batch(parts[shard])
+
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                break
+            parts = {}
+            for record in batch:
+                shard = self.shard_of(record[1])
+                parts.setdefault(shard, []).append(record)
+                if self.routing == "size":
+                    # counted when routed, so the rest of the batch already sees the shard filling up
+                    self._rows[shard] = self._shard_rows(shard) + 1
+            write_start = time.perf_counter()
+            inserted = self._fan_out(write, sorted(parts))
+            write_seconds += time.perf_counter() - write_start
+            if self.routing == "size":
+                for shard, count in zip(sorted(parts), inserted):
+                    self._rows[shard] -= len(parts[shard]) - count
+            rows += sum(inserted)
+            skipped += len(batch) - sum(inserted)
+            batches += len(parts)
+            touched.update(parts)
+
+        loaded = [shard for shard in sorted(touched) if self.shards[shard]._ids is not None]
+        if rows and loaded:
+            write_start = time.perf_counter()
+            self._fan_out(lambda shard, db: db._sync(), loaded)
+            write_seconds += time.perf_counter() - write_start
+        seconds = time.perf_counter() - start
+        return {
+            "rows": rows,
+            "skipped": skipped,
+            "batches": batches,
+            "seconds": seconds,
+            "write_seconds": write_seconds,
+            "rows_per_sec": rows / seconds if seconds > 0 else 0.0,
+        }
+
+    def delete(self, filename: str) -> int:
+        """
+        See `VectorDB.delete`.
+        """
+        shard = self.shard_of(filename)
+        self._rows.pop(shard, None)
+        return self.shards[shard].delete(filename)
+
+    def replace(self, filename: str, chunks: Iterable[tuple], batch_size: int = 1000) -> dict:
+        """
+        See `VectorDB.replace`; the file's shard is replaced in one transaction.
+        """
+        shard = self.shard_of(filename)
+        self._rows.pop(shard, None)
+        return self.shards[shard].replace(filename, chunks, batch_size)
+
+    def sync_file(self, filename: str, chunks: Iterable[tuple], batch_size: int = 1000) -> dict:
+        """
+        See `VectorDB.sync_file`; only the file's shard is touched, in one transaction.
+        """
+        shard = self.shard_of(filename)
+        self._rows.pop(shard, None)
+        return self.shards[shard].sync_file(filename, chunks, batch_size)
+
+    def compact(self, vacuum_pages: int = None) -> dict:
+        """
+        Compacts every shard in parallel, see `VectorDB.compact`.
+
+        :return: Statistics summed over the shards
+        """
+        stats = self._fan_out(lambda shard, db: db.compact(vacuum_pages))
+        return {key: sum(shard_stats[key] for shard_stats in stats) for key in stats[0]}
+
+    def _shard_filters(self, filters: dict, shard: int) -> dict:
+        """
+        Restricts an "ids" filter (global ids) to the row ids of one shard.
+        """
+        if not filters or filters.get("ids") is None:
+            return filters
+        ids = [split_id(int(row_id)) for row_id in filters["ids"]]
+        return {**filters, "ids": [row_id for owner, row_id in ids if owner == shard]}
+
+    def _materialize(self, ids: List[int], scores: List[float]) -> List[SearchResult]:
+        """
+        Fetches the results from their shards, in parallel, see `VectorDB._materialize`.
+
+        :param ids: Global ids of the results, best first
+        :param scores: Score of every result
+        :return: Results in the same order as `ids`, with global ids
+        """
+        by_shard = {}
+        for row_id in ids:
+            shard, local_id = split_id(row_id)
+            by_shard.setdefault(shard, []).append(local_id)
+
+        def fetch(shard, db):
+            return db._materialize(by_shard[shard], [0.0] * len(by_shard[shard]))
+
+        found = {}
+        for shard, results in zip(sorted(by_shard), self._fan_out(fetch, sorted(by_shard))):
+            found.update((global_id(shard, result.id), result) for result in results)
+        return [found[row_id]._replace(id=row_id, score=float(score))
+                for row_id, score in zip(ids, scores) if row_id in found]
+
+    @staticmethod
+    def _merge(rankings: List[Tuple[List[int], List[float]]], top_k: int) -> Tuple[List[int], List[float]]:
+        """
+        Merges per-shard (global ids, scores) lists, each best first, into the global top-k.
+        """
+        merged = heapq.merge(*(zip(ids, scores) for ids, scores in rankings), key=lambda item: -item[1])
+        best = list(itertools.islice(merged, top_k))
+        return [row_id for row_id, _ in best], [score for _, score in best]
+
+    def _search_ids(self, query: np.ndarray, top_k: int, exact: bool = False,
+                    filters: dict = None) -> Tuple[List[int], List[float]]:
+        query = normalize_rows(np.asarray(query).reshape(1, -1))[0]
+
+        def search(shard, db):
+            ids, scores = db._search_ids(query, top_k, exact, self._shard_filters(filters, shard))
+            return [global_id(shard, row_id) for row_id in ids], scores
+
+        return self._merge(self._fan_out(search), top_k)
+
+    def search(self, query: np.array, top_k: int = 3, exact: bool = False,
+               filters: dict = None) -> List[SearchResult]:
+        """
+        Searches every shard in parallel and merges their top-k, see `VectorDB.search`.
+
+        :return: SearchResult records with global ids, most similar first
+        """
+        return self._materialize(*self._search_ids(query, top_k, exact, filters))
+
+    def _search_lexical(self, text: str, top_k: int, filters: dict = None) -> Tuple[List[int], List[float]]:
+        def search(shard, db):
+            ids, scores = db._search_lexical(text, top_k, self._shard_filters(filters, shard))
+            return [global_id(shard, row_id) for row_id in ids], scores
+
+        return self._merge(self._fan_out(search), top_k)
+
+    def search_lexical(self, text: str, top_k: int = 3, filters: dict = None) -> List[SearchResult]:
+        """
+        See `VectorDB.search_lexical`. BM25 statistics are per shard, so scores of different shards
+        are only approximately comparable.
+        """
+        return self._materialize(*self._search_lexical(text, top_k, filters))
+
+    def search_hybrid(self, query: np.ndarray, text: str, top_k: int = 3, candidates: int = 50, rrf_k: int = 60,
+                      prefilter: int = None, exact: bool = False, filters: dict = None) -> List[SearchResult]:
+        """
+        See `VectorDB.search_hybrid`: the merged vector and lexical candidates of all shards are fused.
+        """
+        query = normalize_rows(np.asarray(query).reshape(1, -1))[0]
+
+        def search(shard, db):
+            shard_filters = self._shard_filters(filters, shard)
+            lexical_ids, lexical_scores = db._search_lexical(text, max(candidates, prefilter or 0), shard_filters)
+            if prefilter and lexical_ids:
+                vector_ids, vector_scores = db._search_ids(query, candidates, exact,
+                                                           {**(shard_filters or {}), "ids": lexical_ids})
+            else:
+                vector_ids, vector_scores = db._search_ids(query, candidates, exact, shard_filters)
+            return (([global_id(shard, row_id) for row_id in vector_ids], vector_scores),
+                    ([global_id(shard, row_id) for row_id in lexical_ids], lexical_scores))
+
+        found = self._fan_out(search)
+        vector_ids, _ = self._merge([vector for vector, _ in found], candidates)
+        lexical_ids, _ = self._merge([lexical for _, lexical in found], candidates)
+        fused = reciprocal_rank_fusion([vector_ids, lexical_ids], rrf_k)[:top_k]
+        return self._materialize([row_id for row_id, _ in fused], [score for _, score in fused])
+
+    def search_many(self, queries: np.ndarray, top_k: int = 3, exact: bool = False, query_block: int = 64,
+                    filters: dict = None) -> List[List[SearchResult]]:
+        """
+        See `VectorDB.search_many`; every shard scores the whole batch in parallel.
+        """
+        queries = normalize_rows(np.atleast_2d(np.asarray(queries)))
+
+        def search(shard, db):
+            return [[result._replace(id=global_id(shard, result.id)) for result in results]
+                    for results in db.search_many(queries, top_k, exact, query_block,
+                                                  self._shard_filters(filters, shard))]
+
+        per_shard = self._fan_out(search)
+        return [
+            list(itertools.islice(heapq.merge(*shard_results, key=lambda result: -result.score), top_k))
+            for shard_results in zip(*per_shard)
+        ]
+
+    def _close(self):
+        """
+        Stops the search threads and closes every shard.
+
+        :return:
+        """
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+        for db in self.shards:
+            db._close()
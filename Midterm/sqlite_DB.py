@@ -1,9 +1,20 @@
+import hashlib
 import io
+import itertools
+import json
+import os
+import re
 import sqlite3
-from typing import List, Tuple, Any
+import sys
+import threading
+import time
+from contextlib import closing, contextmanager
+from datetime import datetime
+from typing import Any, Iterable, List, NamedTuple, Tuple
 
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+
+from Midterm.indexes import INDEXES, normalize_rows, positions_of, top_k_indices
 
 def adapt_array(arr):
     """
@@ -34,31 +45,321 @@ def convert_array(text):
     Reference:
         https://stackoverflow.com/a/18622264
     """
+    if not text.startswith(NPY_MAGIC):
+        return convert_vector(text)
     out = io.BytesIO(text)
     out.seek(0)
     return np.load(out)  # noqa
 
-sqlite3.register_adapter(np.ndarray, adapt_array)
+NPY_MAGIC = b"\x93NUMPY"
+
+VECTOR_TYPES = {
+    "vector": np.dtype("<f4"),
+    "halfvector": np.dtype("<f2"),
+}
+
+def adapt_vector(arr, dtype=VECTOR_TYPES["vector"]):
+    """
+    Serializes a vector as raw little-endian bytes, without any header.
+
+    Args:
+        arr: Array to serialize
+        dtype: Storage dtype, float32 by default (float16 for "halfvector" columns)
+
+    Returns:
+        sqlite3.Binary: Raw bytes of the array.
+    """
+    return sqlite3.Binary(np.ascontiguousarray(arr, dtype=dtype).tobytes())
+
+def convert_vector(text, dtype=VECTOR_TYPES["vector"]):
+    """
+    Deserializes a raw vector blob with np.frombuffer, without copying.
+    Blobs written by `adapt_array` (np.save format) are still understood.
+
+    Args:
+        text (bytes): binary blob
+        dtype: Storage dtype of the blob
+    Returns:
+        Read-only numpy array backed by the blob
+    """
+    if text.startswith(NPY_MAGIC):
+        return convert_array(text)
+    return np.frombuffer(text, dtype=dtype)
+
+def convert_half_vector(text):
+    """
+    Deserializes a float16 vector blob (see `convert_vector`).
+    """
+    return convert_vector(text, dtype=VECTOR_TYPES["halfvector"])
+
+sqlite3.register_adapter(np.ndarray, adapt_vector)
 
 sqlite3.register_converter("array", convert_array)
+sqlite3.register_converter("vector", convert_vector)
+sqlite3.register_converter("halfvector", convert_half_vector)
+
+
+def fts_query(text: str) -> str:
+    """
+    Turns free text into an FTS5 query matching any of its words, each quoted so that characters
+    with a meaning in the FTS5 query syntax (e.g. "-", ":" or "*" in codes and identifiers) are
+    matched literally.
+    """
+    return " OR ".join(f'"{token}"' for token in re.findall(r"\w+", text))
+
+
+def reciprocal_rank_fusion(rankings: List[List[Any]], k: int = 60) -> List[Tuple[Any, float]]:
+    """
+    Reciprocal rank fusion (Cormack et al.): every item scores the sum of 1 / (k + rank) over the
+    rankings it appears in, so items ranked high by several retrievers come first.
+
+    :param rankings: Lists of items (e.g. row ids), best first
+    :param k: Damping constant; larger values flatten the contribution of top ranks
+    :return: (item, fused score) pairs, best first
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, 1):
+            fused[item] = fused.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda pair: pair[1], reverse=True)
+
+
+def content_hash(text: str) -> str:
+    """
+    SHA-256 of a chunk's text, used to recognize chunks that were already embedded.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def append_rows(buffer: np.ndarray, array: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Appends rows to an array that lives at the start of a preallocated buffer. The buffer doubles
+    its capacity when it is full, so appending takes amortized time proportional to the new rows
+    instead of copying the whole array every time.
+
+    :param buffer: Buffer the array is a view of, or None
+    :param array: Rows in use (None for none); an array that is not a view of `buffer` is copied
+        into a new buffer
+    :param rows: Rows to append
+    :return: (buffer, view of its rows in use)
+    """
+    size = 0 if array is None else len(array)
+    needed = size + len(rows)
+    if buffer is None or array is None or array.base is not buffer or len(buffer) < needed:
+        grown = np.empty((max(needed, 2 * size),) + rows.shape[1:], dtype=rows.dtype)
+        if size:
+            grown[:size] = array
+        buffer = grown
+    buffer[size:needed] = rows
+    return buffer, buffer[:needed]
+
+
+class IngestedFile(NamedTuple):
+    """
+    What VectorDB.record_file recorded about an ingested file: the hash of its contents, the number
+    of chunks it was split into, and its size and modification time at that point, if known.
+    """
+    fingerprint: str
+    chunks: int
+    size: int = None
+    mtime: float = None
+
+
+class SearchResult(NamedTuple):
+    """
+    A record returned by VectorDB.search: the row id, its cosine similarity to the query and the
+    stored chunk, with the pages it was taken from if known. The vector itself is not part of the result.
+    """
+    id: int
+    score: float
+    filename: str
+    text_content: str
+    created_at: datetime
+    metadata: dict
+    page_start: int = None
+    page_end: int = None
+
+
+DEFAULT_PRAGMAS = {
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 2 ** 20,
+    "cache_size": -64 * 2 ** 10,
+    "temp_store": "MEMORY",
+    "busy_timeout": 30000,
+    # lets VectorDB.compact return free pages to the file system without a full VACUUM
+    "auto_vacuum": "INCREMENTAL",
+}
+
+# bumped whenever the layout of VectorDB's snapshot files changes; older snapshots are ignored
+SNAPSHOT_VERSION = 2
+
+
+class ConnectionManager:
+    """
+    Hands out SQLite connections to the threads of a process: a single writer connection shared by
+    all threads, with writes serialized by a lock, and one read connection per thread. File
+    databases are switched to WAL mode, so readers never wait for the writer and each read block
+    runs in its own transaction, i.e. sees one consistent snapshot of the database.
+
+    In-memory databases cannot be shared between connections, so their reads go through the writer.
+    """
+
+    def __init__(self, database: str = ":memory:", pragmas: dict = None):
+        """
+        :param database: Path to database file, or ":memory:"
+        :param pragmas: PRAGMA overrides applied to every connection, see DEFAULT_PRAGMAS
+        """
+        self.database = database
+        self.in_memory = database == ":memory:"
+        self.pragmas = {**DEFAULT_PRAGMAS, **(pragmas or {})}
+        self._write_lock = threading.RLock()
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+        self._write_depth = 0
+
+        self.writer = self._connect()
+        if not self.in_memory:
+            self.writer.execute("PRAGMA journal_mode=WAL")
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None: transactions are opened explicitly by read() and write()
+        conn = sqlite3.connect(self.database, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False,
+                               isolation_level=None)
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name}={value}")
+        return conn
+
+    def _holds_writer(self) -> bool:
+        return getattr(self._local, "writing", 0) > 0
+
+    @contextmanager
+    def write(self):
+        """
+        Yields a cursor of the writer connection inside a transaction that is committed when the
+        block exits (rolled back on error). Nested write blocks join the outer transaction.
+        Callbacks registered with `after_commit` run once the outermost block has committed and
+        released the writer.
+        """
+        committed = []
+        with self._write_lock:
+            self._local.writing = getattr(self._local, "writing", 0) + 1
+            outermost = self._local.writing == 1
+            try:
+                if outermost:
+                    self._local.after_commit = []
+                    self.writer.execute("BEGIN IMMEDIATE")
+                with closing(self.writer.cursor()) as cursor:
+                    yield cursor
+                if outermost:
+                    self.writer.execute("COMMIT")
+                    committed = self._local.after_commit
+            except BaseException:
+                if outermost and self.writer.in_transaction:
+                    self.writer.execute("ROLLBACK")
+                raise
+            finally:
+                self._local.writing -= 1
+                if outermost:
+                    self._local.after_commit = []
+        for callback in committed:
+            callback()
+
+    def after_commit(self, callback):
+        """
+        Runs `callback` once the calling thread's write transaction has committed, or right away
+        outside of one. Callbacks of a transaction that is rolled back are dropped, so in-memory
+        state updated by them never gets ahead of the database.
+
+        :param callback: Function without arguments
+        :return:
+        """
+        if self._holds_writer():
+            self._local.after_commit.append(callback)
+        else:
+            callback()
+
+    @contextmanager
+    def maintenance(self):
+        """
+        Yields a cursor of the writer connection outside of any transaction, for statements such
+        as VACUUM that cannot run inside one. Other writers are blocked meanwhile.
+        """
+        with self._write_lock, closing(self.writer.cursor()) as cursor:
+            yield cursor
+
+    @contextmanager
+    def read(self):
+        """
+        Yields a cursor of this thread's read connection inside a read transaction, so every
+        statement of the block sees the same snapshot. Inside a write block the writer's cursor
+        is yielded instead, so that uncommitted changes of that block are visible.
+
+        Cursors are closed when their block exits: a statement left unfinished on a connection
+        would otherwise block checkpoints and VACUUM.
+        """
+        if self.in_memory or self._holds_writer():
+            with self._write_lock, closing(self.writer.cursor()) as cursor:
+                yield cursor
+            return
+
+        conn = getattr(self._local, "reader", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.reader = conn
+            with self._readers_lock:
+                self._readers.append(conn)
+        if conn.in_transaction:
+            # nested read block: stay in the snapshot of the outer one
+            with closing(conn.cursor()) as cursor:
+                yield cursor
+            return
+        conn.execute("BEGIN")
+        try:
+            with closing(conn.cursor()) as cursor:
+                yield cursor
+        finally:
+            conn.execute("COMMIT")
+
+    def close(self):
+        """
+        Closes the writer and every read connection.
+        """
+        with self._readers_lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers = []
+        with self._write_lock:
+            self.writer.close()
 
 
 class SQLiteDB:
-    def __init__(self, database: str = ":memory:"):
+    def __init__(self, database: str = ":memory:", pragmas: dict = None):
         """
-        Initializes a SQLite database connection.
+        Initializes the SQLite connections (see ConnectionManager).
 
         Args:
             database (str, optional): Path to database file, with default to an in-memory database.
+            pragmas (dict, optional): PRAGMA overrides, e.g. {"mmap_size": 0}
         """
-        self.conn = sqlite3.connect(database, detect_types=sqlite3.PARSE_DECLTYPES)
-        self.cur = self.conn.cursor()
+        self.connections = ConnectionManager(database, pragmas)
 
+    def _read(self):
+        """
+        Context manager yielding a cursor for a consistent read, see ConnectionManager.read.
+        """
+        return self.connections.read()
 
-    def _create_table(self, table_name: str):
+    def _write(self):
+        """
+        Context manager yielding a cursor inside a serialized write transaction, see ConnectionManager.write.
+        """
+        return self.connections.write()
+
+    def _create_table(self, table_name: str, vector_type: str = "vector", vector_column: str = "arr"):
         """
         Creates a table, if it does not already exist, with columns:
-            arr (the vector, saved as binary array);
+            arr (the vector, saved as raw float32/float16 bytes, or a row offset into a sidecar file);
             id (primary key);
             filename (name of file);
             text_content (associated text);
@@ -66,106 +367,1524 @@ class SQLiteDB:
 
         Args:
             table_name (str): Name of table
+            vector_type (str): Declared type of the vector column, "vector" (float32) or "halfvector" (float16)
+            vector_column (str): Name of the vector column
         """
         sql = f'''
         CREATE TABLE IF NOT EXISTS {table_name} (
-            arr array NOT NULL,
+            {vector_column} {vector_type} NOT NULL,
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             filename TEXT NOT NULL,
             text_content TEXT NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )'''
 
-        self.cur.execute(sql)
-        self.conn.commit()
+        with self._write() as cur:
+            cur.execute(sql)
 
-    def _insert_data(self, table_name: str, data: List[Tuple[np.array, str, str]]):
+    def _insert_data(self, table_name: str, data: List[Tuple[np.array, str, str]],
+                     columns: Tuple[str, ...] = ("arr", "filename", "text_content"), on_conflict: str = None) -> int:
         """
         Inserts new rows into the specified table in the database.
 
         :param table_name: Table where the new records will be inserted
         :param data: Records to insert.
-        :return:
+        :param columns: Columns the values of each record are written to
+        :param on_conflict: Optional conflict resolution, e.g. "IGNORE" to skip rows violating a unique index
+        :return: Number of inserted rows
         """
-        self.cur.executemany(f"INSERT INTO {table_name} (arr, filename, text_content) VALUES (?, ?, ?)", data)
-        self.conn.commit()
+        placeholders = ", ".join("?" * len(columns))
+        verb = f"INSERT OR {on_conflict}" if on_conflict else "INSERT"
+        with self._write() as cur:
+            cur.executemany(f"{verb} INTO {table_name} ({', '.join(columns)}) VALUES ({placeholders})", data)
+            return cur.rowcount
 
-    def _query_data(self, table_name: str, condition: str = None) -> List[Tuple]:
+    def _query_data(self, table_name: str, condition: str = None, params: Tuple = ()) -> List[Tuple]:
         """
         Queries specified table with optional condition
 
         :param table_name: Table to be queried.
-        :param condition: Optional query condition
+        :param condition: Optional query condition, with ? placeholders for `params`
+        :param params: Values bound to the placeholders of the condition
         :return: All record from the select statement
         """
         sql = f"SELECT * FROM {table_name}"
         if condition:
             sql += f" WHERE {condition}"
-        self.cur.execute(sql)
-        return self.cur.fetchall()
+        with self._read() as cur:
+            cur.execute(sql, params)
+            return cur.fetchall()
+
+    def _column_type(self, table_name: str, column: str) -> str:
+        """
+        Returns the declared type of a column, lower-cased.
+
+        :param table_name: Table to inspect
+        :param column: Column name
+        :return: Declared type, or an empty string if the column does not exist
+        """
+        with self._read() as cur:
+            cur.execute(f"PRAGMA table_info({table_name})")
+            rows = cur.fetchall()
+        for row in rows:
+            if row[1] == column:
+                return row[2].lower()
+        return ""
+
+    def _ensure_column(self, table_name: str, column: str, declaration: str):
+        """
+        Adds a column to an existing table if it is missing.
+
+        :param table_name: Table to alter
+        :param column: Column name
+        :param declaration: Type and constraints of the column
+        :return:
+        """
+        with self._write() as cur:
+            if not self._column_type(table_name, column):
+                cur.execute(f"ALTER TABLE {table_name} ADD COLUMN {column} {declaration}")
 
     def _close(self):
         """
-        Closes connection with database.
+        Closes connections with database.
 
         :return:
         """
-        self.conn.close()
+        self.connections.close()
 
 
 class VectorDB(SQLiteDB):
-    def __init__(self, db: str, collection_name: str):
+    def __init__(self, db: str, collection_name: str, vector_type: str = "vector", storage: str = "sqlite",
+                 block_size: int = 65536, index: str = "exact", index_params: dict = None, pragmas: dict = None,
+                 compact_threshold: float = 0.25, snapshot: bool = True):
         """
         Initializes a VectorDB instance connected to a specific collection (table).
 
+        With "sqlite" storage the embeddings live in the table and are kept in memory as a contiguous,
+        L2-normalized float32 matrix with a parallel array of row ids, loaded on the first search and
+        extended on insert (in place, inside buffers that double their capacity when full). With
+        "memmap" storage the normalized float32 vectors live in an append-only sidecar file next to
+        the database, the table only keeps each row's offset into it, and search streams over the
+        memory-mapped file so the page cache rather than the Python heap holds them.
+
         :param db: Path to SQlite database file.
         :param collection_name: Name of the collection (table) for storing vectors
+        :param vector_type: Storage type for new collections, "vector" (float32) or "halfvector" (float16).
+            Existing collections keep the type they were created with.
+        :param storage: "sqlite" or "memmap", used when the collection is created
+        :param block_size: Number of vectors scored per block during search
+        :param index: Search backend, "exact" (brute force), "ivf", "hnsw", the quantized "sq8" and "pq"
+            backends, which keep only compact codes in memory, or the two-stage "matryoshka" backend (see indexes.py)
+        :param index_params: Keyword arguments for the backend, e.g. {"nprobe": 16} or {"M": 32}
+        :param pragmas: SQLite PRAGMA overrides, see ConnectionManager
+        :param compact_threshold: Fraction of tombstoned rows in the loaded matrix at which `delete`
+            starts a background `compact`; None disables automatic compaction
+        :param snapshot: Persist the loaded search state (matrix, ids and index) to snapshot files
+            next to the database, so that a restart restores it instead of rebuilding it, see
+            `save_snapshot`. Ignored for in-memory databases.
+
+        Search, insert and the other methods may be called from several threads: SQLite access goes
+        through the ConnectionManager, and the in-memory search state is guarded by a lock.
         """
-        super().__init__(database=db)
+        super().__init__(database=db, pragmas=pragmas)
         self.collection_name = collection_name
+        self.vector_type = vector_type
+        self.storage = storage
+        self.block_size = block_size
+        self.index = INDEXES[index](**(index_params or {}))
+        # as in the snapshot manifest, which is JSON
+        self.index_params = json.loads(json.dumps(index_params or {}, sort_keys=True, default=str))
+        self.compact_threshold = compact_threshold
+        self._sidecar_base = f"{os.path.splitext(db)[0]}.{collection_name}"
+        self.sidecar_path = f"{self._sidecar_base}.vec"
+        self._matrix = None
+        self._ids = None
+        # _matrix and _ids are views of the first rows of these, see `append_rows`
+        self._matrix_buffer = None
+        self._ids_buffer = None
+        self._lock = threading.RLock()
+        self._compaction = None
+        self.use_snapshot = snapshot and not self.connections.in_memory
+        self._snapshot_key = None
+        # (path, rows) of the snapshot matrix file holding the first rows of _matrix, if any
+        self._snapshot_matrix = None
         self.create()
 
     def create(self):
         """
-        Creates new table if it does not exist
+        Creates new table if it does not exist, and adds columns introduced since it was created
+        (short_arr: normalized leading dimensions of the vector, used by the "matryoshka" backend;
+        metadata: JSON object of user-defined key/values; content_hash: see `content_hash`;
+        page_start / page_end: first and last page of the document the chunk was taken from), the
+        indexes used by search filters and deduplication, the tables of ingested files and their
+        pages (see `record_file`) and the full-text index used by lexical search
         :return:
         """
         sql = f'''SELECT name FROM sqlite_master WHERE type='table' AND name='{self.collection_name}' '''
-        self.cur.execute(sql)
-        res = self.cur.fetchall()
-        if len(res) == 0:
-            self._create_table(self.collection_name)
+        with self._write() as cur:
+            cur.execute(sql)
+            res = cur.fetchall()
+            if len(res) == 0:
+                if self.storage == "memmap":
+                    self._create_table(self.collection_name, "INTEGER", vector_column="row_offset")
+                else:
+                    self._create_table(self.collection_name, self.vector_type)
+            self._create_meta_table()
+            self._ensure_column(self.collection_name, "short_arr", "vector")
+            self._ensure_column(self.collection_name, "metadata", "TEXT")
+            self._ensure_column(self.collection_name, "content_hash", "TEXT")
+            self._ensure_column(self.collection_name, "page_start", "INTEGER")
+            self._ensure_column(self.collection_name, "page_end", "INTEGER")
+            # the unique index has to exist before the backfill, which relies on it to skip duplicates
+            cur.execute(
+                f"CREATE UNIQUE INDEX IF NOT EXISTS {self.collection_name}_content_hash_idx "
+                f"ON {self.collection_name} (content_hash, filename)"
+            )
+            self._backfill_content_hashes()
+            cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.collection_name}_files (
+                filename TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                chunks INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )""")
+            self._ensure_column(f"{self.collection_name}_files", "size", "INTEGER")
+            self._ensure_column(f"{self.collection_name}_files", "mtime", "REAL")
+            if self._column_type(f"{self.collection_name}_pages", "text_content"):
+                # pages used to be stored with their text; only their hashes are kept now
+                cur.execute(f"DROP TABLE {self.collection_name}_pages")
+            cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.collection_name}_pages (
+                filename TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                page_hash TEXT NOT NULL,
+                PRIMARY KEY (filename, page)
+            )""")
+            cur.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.collection_name}_filename_idx ON {self.collection_name} (filename)"
+            )
+            cur.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.collection_name}_created_at_idx "
+                f"ON {self.collection_name} (created_at)"
+            )
+            self._create_fts()
+        self._short_dim = self._get_meta("short_dim")
+        self.sidecar_path = self._sidecar_file(self._get_meta("sidecar_generation", 0))
+
+        if self._column_type(self.collection_name, "row_offset"):
+            self.storage = "memmap"
+            self.vector_type = "vector"
+        else:
+            self.storage = "sqlite"
+            self.vector_type = self._column_type(self.collection_name, "arr")
+
+        if self.storage == "memmap" and self.sidecar_path.startswith(":memory:"):
+            raise ValueError("memmap storage needs a database file, not an in-memory database")
+
+    def _create_fts(self):
+        """
+        Creates the FTS5 index over text_content and the triggers keeping it in sync with the
+        table. It is an external-content index, so the text is not stored a second time; an
+        existing collection is indexed once when the index is created.
+        :return:
+        """
+        table = self.collection_name
+        fts = f"{table}_fts"
+        with self._write() as cur:
+            cur.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (fts,))
+            exists = cur.fetchone() is not None
+            cur.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} "
+                f"USING fts5(text_content, content='{table}', content_rowid='id')"
+            )
+            cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {fts} (rowid, text_content) VALUES (new.id, new.text_content);
+            END""")
+            cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO {fts} ({fts}, rowid, text_content) VALUES ('delete', old.id, old.text_content);
+            END""")
+            cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF text_content ON {table} BEGIN
+                INSERT INTO {fts} ({fts}, rowid, text_content) VALUES ('delete', old.id, old.text_content);
+                INSERT INTO {fts} (rowid, text_content) VALUES (new.id, new.text_content);
+            END""")
+            if not exists:
+                cur.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+
+    def _backfill_content_hashes(self):
+        """
+        Hashes rows stored before the content_hash column existed. Duplicates of a chunk within
+        the same file keep a NULL hash: the unique index makes UPDATE OR IGNORE skip every row
+        after the first (lowest id) one.
+        :return:
+        """
+        with self._write() as cur:
+            cur.execute(f"SELECT id, text_content FROM {self.collection_name} WHERE content_hash IS NULL ORDER BY id")
+            rows = cur.fetchall()
+            cur.executemany(
+                f"UPDATE OR IGNORE {self.collection_name} SET content_hash = ? WHERE id = ?",
+                [(content_hash(text), row_id) for row_id, text in rows],
+            )
+
+    def ingested_file(self, filename: str) -> IngestedFile:
+        """
+        :param filename: Name of an ingested file
+        :return: The IngestedFile recorded for the file by `record_file`, or None
+        """
+        with self._read() as cur:
+            cur.execute(
+                f"SELECT fingerprint, chunks, size, mtime FROM {self.collection_name}_files WHERE filename = ?",
+                (filename,),
+            )
+            row = cur.fetchone()
+        return None if row is None else IngestedFile(*row)
+
+    def record_file(self, filename: str, fingerprint: str, chunks: int, size: int = None, mtime: float = None,
+                    pages: List[Tuple[int, str]] = None):
+        """
+        Records a completely ingested file, so that uploading it again unchanged can be skipped, and
+        a modified version only needs its changes processed.
+
+        :param filename: Name of the file
+        :param fingerprint: Hash of the file's contents
+        :param chunks: Number of chunks the file was split into
+        :param size: Size of the file in bytes, checked before the file is hashed again
+        :param mtime: Modification time of the file, checked with the size
+        :param pages: (page number, page hash) of every page, replacing those recorded before;
+            None keeps them. See `ingested_pages`
+        :return:
+        """
+        with self._write() as cur:
+            cur.execute(
+                f"INSERT OR REPLACE INTO {self.collection_name}_files (filename, fingerprint, chunks, size, mtime) "
+                f"VALUES (?, ?, ?, ?, ?)",
+                (filename, fingerprint, chunks, size, mtime),
+            )
+            if pages is not None:
+                cur.execute(f"DELETE FROM {self.collection_name}_pages WHERE filename = ?", (filename,))
+                cur.executemany(
+                    f"INSERT OR REPLACE INTO {self.collection_name}_pages (filename, page, page_hash) VALUES (?, ?, ?)",
+                    [(filename, *page) for page in pages],
+                )
+
+    def ingested_pages(self, filename: str) -> set:
+        """
+        :param filename: Name of an ingested file
+        :return: Hashes of the file's recorded pages, to tell which pages of a new version changed
+        """
+        with self._read() as cur:
+            cur.execute(f"SELECT page_hash FROM {self.collection_name}_pages WHERE filename = ?", (filename,))
+            return {row[0] for row in cur.fetchall()}
+
+    def file_hashes(self, filename: str) -> set:
+        """
+        :param filename: Name of a file
+        :return: Content hashes of the file's stored chunks, see `sync_file`
+        """
+        with self._read() as cur:
+            cur.execute(f"SELECT content_hash FROM {self.collection_name} WHERE filename = ?", (filename,))
+            return {row[0] for row in cur.fetchall()}
+
+    def vectors_by_hash(self, hashes: List[str]) -> dict:
+        """
+        Looks up stored vectors of chunks by their content hash, so they can be reused instead of
+        being embedded again.
+
+        :param hashes: Content hashes, see `content_hash`
+        :return: Dict mapping every found hash to its vector (normalized for memmap storage)
+        """
+        vector_column = "row_offset" if self.storage == "memmap" else "arr"
+        hashes = list(set(hashes))
+        found = {}
+        with self._read() as cur:
+            for start in range(0, len(hashes), 900):
+                chunk = hashes[start:start + 900]
+                placeholders = ", ".join("?" * len(chunk))
+                cur.execute(
+                    f"SELECT content_hash, {vector_column} FROM {self.collection_name} "
+                    f"WHERE content_hash IN ({placeholders})", chunk
+                )
+                found.update(cur.fetchall())
+            if self.storage == "memmap" and found:
+                sidecar = self._open_sidecar()
+                found = {key: np.array(sidecar[offset]) for key, offset in found.items()}
+        return found
+
+    def _sidecar_file(self, generation: int) -> str:
+        """
+        :param generation: Number of times the sidecar was rewritten by `compact`
+        :return: Path of the sidecar file of that generation
+        """
+        if not generation:
+            return f"{self._sidecar_base}.vec"
+        return f"{self._sidecar_base}.{generation}.vec"
+
+    def _create_meta_table(self):
+        """
+        Creates the key/value table holding per-collection settings (e.g. vector dimension)
+        :return:
+        """
+        with self._write() as cur:
+            cur.execute(f"CREATE TABLE IF NOT EXISTS {self.collection_name}_meta (key TEXT PRIMARY KEY, value)")
+
+    def _get_meta(self, key: str, default: Any = None) -> Any:
+        """
+        Reads a value from the collection's meta table.
+
+        :param key: Setting name
+        :param default: Value returned when the key is missing
+        :return: Stored value or `default`
+        """
+        with self._read() as cur:
+            cur.execute(f"SELECT value FROM {self.collection_name}_meta WHERE key = ?", (key,))
+            row = cur.fetchone()
+        return default if row is None else row[0]
+
+    def _set_meta(self, key: str, value: Any):
+        """
+        Writes a value into the collection's meta table (joining the current write transaction, if any).
+
+        :param key: Setting name
+        :param value: Value to store
+        :return:
+        """
+        with self._write() as cur:
+            cur.execute(
+                f"INSERT OR REPLACE INTO {self.collection_name}_meta (key, value) VALUES (?, ?)", (key, value)
+            )
+
+    def _encode(self, vector: np.ndarray) -> sqlite3.Binary:
+        """
+        Serializes a vector for the collection's column type. Legacy "array" columns receive
+        float32 bytes as well, which `convert_array` reads back transparently.
+
+        :param vector: Vector to serialize
+        :return: Raw vector bytes
+        """
+        return adapt_vector(vector, VECTOR_TYPES.get(self.vector_type, VECTOR_TYPES["vector"]))
+
+    def migrate_storage(self, vector_type: str = "vector"):
+        """
+        Converts the collection in place from the legacy np.save "array" format to raw
+        "vector"/"halfvector" storage. Runs in a single transaction, then vacuums the file.
+
+        :param vector_type: Target column type
+        :return: Number of migrated rows
+        """
+        if self.storage == "memmap":
+            raise ValueError("memmap collections keep their vectors in the sidecar file")
+        if self.vector_type == vector_type:
+            return 0
+
+        dtype = VECTOR_TYPES[vector_type]
+        tmp_name = f"{self.collection_name}__migrating"
+
+        with self._write() as cur:
+            cur.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (self.collection_name,))
+            create_sql = cur.fetchone()[0]
+            create_sql = re.sub(rf"^CREATE TABLE\s+{self.collection_name}\b", f"CREATE TABLE {tmp_name}", create_sql)
+            create_sql = re.sub(r"\barr\s+\w+", f"arr {vector_type}", create_sql, count=1)
+
+            cur.execute(f"PRAGMA table_info({self.collection_name})")
+            columns = [row[1] for row in cur.fetchall()]
+            arr_pos = columns.index("arr")
+            column_list = ", ".join(columns)
+            placeholders = ", ".join("?" * len(columns))
+
+            cur.execute("SELECT seq FROM sqlite_sequence WHERE name=?", (self.collection_name,))
+            seq = cur.fetchone()
+            cur.execute(create_sql)
+
+            reader = self.connections.writer.cursor()
+            reader.execute(f"SELECT {column_list} FROM {self.collection_name}")
+            migrated = 0
+            while True:
+                rows = reader.fetchmany(1000)
+                if not rows:
+                    break
+                converted = []
+                for row in rows:
+                    row = list(row)
+                    row[arr_pos] = adapt_vector(row[arr_pos], dtype)
+                    converted.append(row)
+                cur.executemany(
+                    f"INSERT INTO {tmp_name} ({column_list}) VALUES ({placeholders})", converted
+                )
+                migrated += len(converted)
+
+            cur.execute(f"DROP TABLE {self.collection_name}")
+            cur.execute(f"ALTER TABLE {tmp_name} RENAME TO {self.collection_name}")
+            if seq is not None:
+                cur.execute(
+                    "UPDATE sqlite_sequence SET seq = ? WHERE name = ?", (seq[0], self.collection_name)
+                )
+
+        with self.connections.maintenance() as cur:
+            cur.execute("VACUUM")
+            # in WAL mode the vacuumed pages only reach the main file at a checkpoint
+            cur.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        # dropping the old table dropped its indexes and full-text triggers as well
+        self.create()
+        return migrated
+
+    def _load_matrix(self):
+        """
+        Reads every stored vector once and builds the resident normalized matrix and id array,
+        or maps the sidecar file and builds the offset -> id array for memmap storage.
+        :return:
+        """
+        self._matrix = None
+        self._ids = np.empty(0, dtype=np.int64)
+        self._matrix_buffer = None
+        self._ids_buffer = None
+        self._last_id = 0
+        self._snapshot_matrix = None
+        if self.use_snapshot and self._restore_snapshot():
+            return
+        self._append_rows_after(0)
+        # the backend's persisted state is only loaded if it was built with the same parameters
+        params = json.dumps({"index": self.index.name, "params": self.index_params}, sort_keys=True)
+        if self._get_meta("index_params") != params or not self.index.load(self):
+            self.index.build(self)
+            self._set_meta("index_params", params)
+        self.save_snapshot()
+
+    def load(self):
+        """
+        Loads the search state now instead of on the first search, e.g. when an application starts.
+        :return:
+        """
+        with self._lock:
+            if self._ids is None:
+                self._load_matrix()
+
+    def _snapshot_manifest_path(self) -> str:
+        return f"{self._sidecar_base}.snapshot.json"
+
+    def _snapshot_identity(self) -> dict:
+        """
+        Settings a snapshot must have been taken with to be restored.
+        """
+        return {
+            "version": SNAPSHOT_VERSION,
+            "collection": self.collection_name,
+            "storage": self.storage,
+            "vector_type": self.vector_type,
+            "index": self.index.name,
+            "index_params": self.index_params,
+            "sidecar_generation": int(self._get_meta("sidecar_generation", 0)),
+        }
+
+    def _snapshot_state_key(self) -> Tuple[int, int, int]:
+        """
+        :return: (positions, live rows, last id) of the loaded state, which change with every
+            insert, delete and compaction
+        """
+        return len(self._ids), int(np.count_nonzero(self._ids >= 0)), int(self._last_id)
+
+    def _read_snapshot_manifest(self) -> dict:
+        try:
+            with open(self._snapshot_manifest_path()) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def save_snapshot(self) -> bool:
+        """
+        Writes the loaded search state to snapshot files next to the database: the row ids as .npy,
+        the normalized matrix (sqlite storage with a resident matrix; memmap storage already keeps it
+        in the sidecar) as a raw float32 file, the backend's state (see SearchIndex.snapshot) as
+        .npz, and a JSON manifest naming them together with the number of rows and the last row id
+        they cover. The matrix file is append-only: while the matrix only grew since the last
+        snapshot, just the new rows are written to its end, and it is rewritten whole only after
+        the matrix was built or compacted. The manifest is replaced atomically after the other
+        files are on disk, so a crash leaves the previous snapshot in place (rows appended past its
+        row count are ignored and overwritten). Called after the state is built from the table and
+        by `_close`.
+
+        :return: True if a snapshot was written, False if it is disabled, nothing is loaded or the
+            current snapshot is up to date
+        """
+        if not self.use_snapshot:
+            return False
+        with self._lock:
+            if self._ids is None or self._snapshot_state_key() == self._snapshot_key:
+                return False
+            previous = self._read_snapshot_manifest() or {}
+            generation = int(previous.get("generation", 0)) + 1
+            files = {"ids": f"{self._sidecar_base}.snapshot.{generation}.ids.npy",
+                     "index": f"{self._sidecar_base}.snapshot.{generation}.index.npz"}
+
+            def write(path, save, value):
+                with open(path, "wb") as file:
+                    save(file, value)
+                    file.flush()
+                    os.fsync(file.fileno())
+
+            write(files["ids"], np.save, self._ids)
+            write(files["index"], lambda file, state: np.savez(file, **state), self.index.snapshot(self))
+            matrix_shape = None
+            if self.storage == "sqlite" and self._matrix is not None:
+                path, written = self._snapshot_matrix or (None, 0)
+                if (path is None or previous.get("files", {}).get("matrix") != path
+                        or previous.get("matrix_shape", [None])[0] != written or len(self._matrix) < written):
+                    # the matrix was built or compacted since: start a new file
+                    path, written = f"{self._sidecar_base}.snapshot.{generation}.matrix.f32", 0
+                row_bytes = self._matrix.shape[1] * 4
+                with open(path, "r+b" if written else "wb") as file:
+                    file.truncate(written * row_bytes)
+                    file.seek(written * row_bytes)
+                    file.write(memoryview(np.ascontiguousarray(self._matrix[written:], dtype="<f4")))
+                    file.flush()
+                    os.fsync(file.fileno())
+                files["matrix"] = path
+                matrix_shape = list(self._matrix.shape)
+
+            positions, rows, last_id = self._snapshot_state_key()
+            manifest = {**self._snapshot_identity(), "generation": generation, "positions": positions,
+                        "rows": rows, "last_id": last_id, "files": files, "matrix_shape": matrix_shape}
+            temporary = f"{self._snapshot_manifest_path()}.tmp"
+            write(temporary, lambda file, value: file.write(json.dumps(value).encode()), manifest)
+            os.replace(temporary, self._snapshot_manifest_path())
+            self._snapshot_key = (positions, rows, last_id)
+            self._snapshot_matrix = None if matrix_shape is None else (files["matrix"], matrix_shape[0])
+
+        for path in set(previous.get("files", {}).values()) - set(files.values()):
+            try:
+                os.remove(path)
+            except OSError:
+                # still memory-mapped on platforms that do not allow removing open files
+                pass
+        return True
+
+    def _restore_snapshot(self) -> bool:
+        """
+        Restores the matrix, ids and backend state from the snapshot files if they were taken with
+        the current settings and the rows they cover are unchanged (same number of rows up to the
+        snapshot's last row id; ids are never reused), then replays the rows inserted since.
+        The matrix is memory-mapped, so restoring takes time proportional to the new rows only.
+
+        :return: True if the snapshot was restored, False if the state has to be built from the table
+        """
+        manifest = self._read_snapshot_manifest()
+        if manifest is None or any(manifest.get(key) != value for key, value in self._snapshot_identity().items()):
+            return False
+        with self._read() as cur:
+            cur.execute(f"SELECT COUNT(*) FROM {self.collection_name} WHERE id <= ?", (manifest["last_id"],))
+            if cur.fetchone()[0] != manifest["rows"]:
+                return False
+            if self.storage == "memmap":
+                matrix = self._open_sidecar()
+        try:
+            ids = np.load(manifest["files"]["ids"])
+            if self.storage == "sqlite":
+                matrix = manifest["files"].get("matrix")
+                if matrix is not None:
+                    matrix = np.memmap(matrix, dtype="<f4", mode="r", shape=tuple(manifest["matrix_shape"]))
+            with np.load(manifest["files"]["index"]) as state:
+                state = {key: state[key] for key in state.files}
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        if self.storage == "sqlite":
+            resident = self.index.resident and len(ids) > 0
+            valid = (matrix is not None) == resident and (matrix is None or len(matrix) == len(ids))
+        else:
+            valid = len(ids) == 0 or (matrix is not None and len(matrix) >= len(ids))
+        if len(ids) != manifest["positions"] or not valid:
+            return False
+
+        self._matrix = matrix
+        self._ids = ids
+        self._last_id = manifest["last_id"]
+        self._snapshot_key = self._snapshot_state_key()
+        if self.storage == "sqlite" and matrix is not None:
+            self._snapshot_matrix = (manifest["files"]["matrix"], len(matrix))
+        if not self.index.restore(self, state):
+            self.index.build(self)
+        positions = self._append_rows_after(self._last_id)
+        if len(positions):
+            self.index.add(self, positions)
+        return True
+
+    def _open_sidecar(self):
+        """
+        Memory-maps the sidecar file read-only with its current number of rows. Called inside a read
+        block, the map covers every row visible to that block's snapshot, since sidecar rows are
+        written before the transaction that records their offsets commits.
+        :return: The memmap, or None if the sidecar is empty
+        """
+        dim = self._get_meta("dim")
+        self.sidecar_path = self._sidecar_file(self._get_meta("sidecar_generation", 0))
+        if dim is None or not os.path.exists(self.sidecar_path):
+            return None
+        rows = os.path.getsize(self.sidecar_path) // (int(dim) * 4)
+        if rows == 0:
+            return None
+        return np.memmap(self.sidecar_path, dtype="<f4", mode="r", shape=(rows, int(dim)))
+
+    def _append_sidecar_rows_after(self, last_id: int):
+        """
+        Remaps the sidecar file and records the offsets of rows with an id greater than `last_id`.
+        Offsets without a row (e.g. from an interrupted insert) keep the id -1 and are never returned.
+
+        :param last_id: Largest id already known
+        :return: Positions of the newly recorded rows
+        """
+        with self._read() as cur:
+            self._matrix = self._open_sidecar()
+            rows = 0 if self._matrix is None else len(self._matrix)
+            if rows > len(self._ids):
+                self._append_ids(np.full(rows - len(self._ids), -1, dtype=np.int64))
+            cur.execute(
+                f"SELECT id, row_offset FROM {self.collection_name} WHERE id > ? ORDER BY id", (last_id,)
+            )
+            rows = cur.fetchall()
+        for row_id, offset in rows:
+            self._ids[offset] = row_id
+            self._last_id = row_id
+        return np.array([offset for _, offset in rows], dtype=np.int64)
+
+    def _append_rows_after(self, last_id: int):
+        """
+        Appends vectors with an id greater than `last_id` to the resident matrix.
+
+        :param last_id: Largest id already present in the matrix
+        :return: Positions of the appended rows
+        """
+        if self.storage == "memmap":
+            return self._append_sidecar_rows_after(last_id)
+
+        if not self.index.resident:
+            # only ids are tracked; the backend fetches the vectors it needs through _vectors
+            with self._read() as cur:
+                cur.execute(f"SELECT id FROM {self.collection_name} WHERE id > ? ORDER BY id", (last_id,))
+                ids = np.array([row[0] for row in cur.fetchall()], dtype=np.int64)
+            if len(ids) == 0:
+                return ids
+            start = len(self._ids)
+            self._append_ids(ids)
+            self._last_id = int(ids[-1])
+            return np.arange(start, len(self._ids))
+
+        with self._read() as cur:
+            cur.execute(f"SELECT id, arr FROM {self.collection_name} WHERE id > ? ORDER BY id", (last_id,))
+            rows = cur.fetchall()
+        if len(rows) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        vectors = normalize_rows(np.stack([row[1] for row in rows]))
+
+        start = len(self._ids)
+        self._matrix_buffer, self._matrix = append_rows(self._matrix_buffer, self._matrix, vectors)
+        self._append_ids(ids)
+        self._last_id = int(ids[-1])
+        return np.arange(start, len(self._ids))
+
+    def _append_ids(self, ids: np.ndarray):
+        """
+        Appends row ids to the loaded id array, see `append_rows`.
+
+        :param ids: Ids of the appended positions (-1 for positions without a row)
+        :return:
+        """
+        self._ids_buffer, self._ids = append_rows(self._ids_buffer, self._ids, ids)
+
+    def _append_to_sidecar(self, vectors: np.ndarray) -> int:
+        """
+        Appends normalized vectors to the end of the sidecar file.
+
+        :param vectors: 2D array of vectors
+        :return: Offset of the first appended row
+        """
+        dim = self._get_meta("dim")
+        if dim is None:
+            dim = vectors.shape[1]
+            self._set_meta("dim", dim)
+        elif int(dim) != vectors.shape[1]:
+            raise ValueError(f"Expected vectors of dimension {dim}, got {vectors.shape[1]}")
+
+        row_bytes = int(dim) * 4
+        self.sidecar_path = self._sidecar_file(self._get_meta("sidecar_generation", 0))
+        with open(self.sidecar_path, "ab") as file:
+            # a torn write from an earlier crash would shift every later row, so pad to a row boundary
+            size = file.tell()
+            if size % row_bytes:
+                file.write(b"\0" * (row_bytes - size % row_bytes))
+                size += row_bytes - size % row_bytes
+            file.write(normalize_rows(vectors).astype("<f4", copy=False).tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+        return size // row_bytes
+
+    def _write_batch(self, data: List[tuple]) -> int:
+        """
+        Writes records to the table (and the sidecar) in a single transaction, without touching
+        the resident matrix or the index. Records whose text is already stored for the same
+        filename are skipped.
+
+        :param data: List of (vector, filename, text[, metadata[, pages]]) tuples, see `insert`
+        :return: Number of inserted records
+        """
+        vectors = np.stack([row[0] for row in data])
+        if self._short_dim is None:
+            short = [None] * len(data)
+        else:
+            short = [adapt_vector(v) for v in normalize_rows(vectors[:, :int(self._short_dim)])]
+        metadata = [json.dumps(row[3]) if len(row) > 3 and row[3] else None for row in data]
+        pages = [tuple(row[4]) if len(row) > 4 and row[4] else (None, None) for row in data]
+        hashes = [content_hash(row[2]) for row in data]
+
+        # the sidecar append and the row insert form one write, so offsets of concurrent inserts never interleave
+        with self._write():
+            if self.storage == "memmap":
+                first_offset = self._append_to_sidecar(vectors)
+                stored = [first_offset + i for i in range(len(data))]
+                vector_column = "row_offset"
+            else:
+                stored = [self._encode(vector) for vector in vectors]
+                vector_column = "arr"
+            rows = [(stored[i], row[1], row[2], short[i], metadata[i], hashes[i], *pages[i])
+                    for i, row in enumerate(data)]
+            return self._insert_data(
+                self.collection_name, rows,
+                columns=(vector_column, "filename", "text_content", "short_arr", "metadata", "content_hash",
+                         "page_start", "page_end"),
+                on_conflict="IGNORE",
+            )
 
     def insert(self, data: List[Tuple[np.array, str, str]]):
         """
-        Inserts new records into table
-        :param data: List of tuples to be inserted
+        Inserts new records into table and, if it is loaded, into the resident matrix.
+        Records whose text is already stored under the same filename are skipped.
+        :param data: List of (vector, filename, text) tuples to be inserted, optionally with a fourth
+            element: a dict of metadata that search filters can match on (or None), and a fifth:
+            the (first, last) page of the document the text was taken from
+        :return: Number of inserted records
+        """
+        if len(data) == 0:
+            return 0
+        inserted = self._write_batch(data)
+        if self._ids is not None:
+            self.connections.after_commit(self._sync)
+        return inserted
+
+    def bulk_insert(self, records: Iterable[tuple], batch_size: int = 1000) -> dict:
+        """
+        Streams records into the table: at most `batch_size` records are buffered and each batch is
+        written in one transaction with the same (cached) INSERT statement. The resident matrix and
+        the index are only updated once, after the last batch, so a slow producer (e.g. an
+        embedding API) is never held up by index maintenance.
+
+        :param records: Iterable of (vector, filename, text[, metadata[, pages]]) tuples, e.g. a generator
+        :param batch_size: Number of records per transaction
+        :return: Statistics: rows (inserted), skipped (already stored, see `insert`), batches,
+            seconds, write_seconds (time spent in SQLite and the sidecar) and rows_per_sec
+        """
+        records = iter(records)
+        rows = 0
+        skipped = 0
+        batches = 0
+        write_seconds = 0.0
+        start = time.perf_counter()
+        try:
+            while True:
+                batch = list(itertools.islice(records, batch_size))
+                if not batch:
+                    break
+                write_start = time.perf_counter()
+                inserted = self._write_batch(batch)
+                write_seconds += time.perf_counter() - write_start
+                rows += inserted
+                skipped += len(batch) - inserted
+                batches += 1
+        finally:
+            # the batches written before a failing (or cancelled) producer stay committed, so they are indexed
+            # too; inside an enclosing write (see `replace`) they are only indexed once that one commits
+            if rows and self._ids is not None:
+                write_start = time.perf_counter()
+                self.connections.after_commit(self._sync)
+                write_seconds += time.perf_counter() - write_start
+        seconds = time.perf_counter() - start
+        return {
+            "rows": rows,
+            "skipped": skipped,
+            "batches": batches,
+            "seconds": seconds,
+            "write_seconds": write_seconds,
+            "rows_per_sec": rows / seconds if seconds > 0 else 0.0,
+        }
+
+    def _sync(self):
+        """
+        Appends rows written since the matrix was loaded and indexes them. Only called outside of
+        write transactions (see ConnectionManager.after_commit): rows of a transaction that is
+        still open may be rolled back, and their ids reused.
+        :return:
+        """
+        with self._lock:
+            positions = self._append_rows_after(self._last_id)
+            if len(positions):
+                self.index.add(self, positions)
+
+    def delete(self, filename: str) -> int:
+        """
+        Deletes every record of a file. The rows are removed from the table right away and
+        tombstoned in the loaded matrix and the search backend (their id becomes -1, so no search
+        returns them); the space they take in memory and in the sidecar file is reclaimed by
+        `compact`, which starts in the background once `compact_threshold` is reached.
+
+        :param filename: Name of the file whose records are deleted
+        :return: Number of deleted records
+        """
+        with self._lock:
+            if self._ids is None:
+                self._load_matrix()
+            with self._write() as cur:
+                cur.execute(f"SELECT id FROM {self.collection_name} WHERE filename = ?", (filename,))
+                ids = np.array([row[0] for row in cur.fetchall()], dtype=np.int64)
+                cur.execute(f"DELETE FROM {self.collection_name} WHERE filename = ?", (filename,))
+                cur.execute(f"DELETE FROM {self.collection_name}_files WHERE filename = ?", (filename,))
+                cur.execute(f"DELETE FROM {self.collection_name}_pages WHERE filename = ?", (filename,))
+                self.connections.after_commit(lambda: self._tombstone(ids))
+                # after the tombstones, which inside an outer transaction (e.g. `replace`) wait for its commit
+                self.connections.after_commit(lambda: self._compact_if_needed(len(ids)))
+        return len(ids)
+
+    def _tombstone(self, ids: np.ndarray):
+        """
+        Removes deleted rows from the loaded matrix and the search backend: their id becomes -1.
+        Called once the deletion has committed.
+
+        :param ids: Ids of the deleted rows
+        :return:
+        """
+        positions = positions_of(self._ids, ids) if len(self._ids) else ids[:0]
+        positions = positions[positions >= 0]
+        if len(positions):
+            self.index.remove(self, positions)
+            self._ids[positions] = -1
+
+    def _compact_if_needed(self, deleted: int):
+        """
+        Starts a background `compact` once the share of tombstoned rows reaches `compact_threshold`.
+        Called once the deletion has committed and its rows are tombstoned.
+
+        :param deleted: Number of rows just deleted
+        :return:
+        """
+        with self._lock:
+            dead = int(np.count_nonzero(self._ids < 0)) if self._ids is not None else 0
+            total = len(self._ids) if self._ids is not None else 0
+        if deleted and self.compact_threshold is not None and total and dead / total >= self.compact_threshold:
+            self.compact_in_background()
+
+    def replace(self, filename: str, chunks: Iterable[tuple], batch_size: int = 1000) -> dict:
+        """
+        Replaces every record of a file with new chunks in one transaction, so searches see
+        either the old or the new version of the file, never a mix or neither. The loaded matrix
+        and the search backend are only updated once the transaction has committed; if the chunks
+        raise, the old version stays searchable.
+
+        :param filename: Name of the file
+        :param chunks: Iterable of (vector, text[, metadata[, pages]]) tuples of the new version
+        :param batch_size: See `bulk_insert`
+        :return: Statistics of `bulk_insert`, plus the number of `deleted` records
+        """
+        with self._lock, self._write():
+            deleted = self.delete(filename)
+            stats = self.bulk_insert(((chunk[0], filename, *chunk[1:]) for chunk in chunks), batch_size)
+        stats["deleted"] = deleted
+        return stats
+
+    def sync_file(self, filename: str, chunks: Iterable[tuple], batch_size: int = 1000) -> dict:
+        """
+        Brings the records of a file in line with the chunks of its new version, touching only what
+        changed: chunks whose text is already stored for the file keep their row (and vector), with
+        their pages and metadata updated if they moved; new chunks are inserted; rows whose text is
+        no longer part of the file are deleted.
+
+        For a file with stored records the chunks are read (and so embedded) first, then applied in
+        one transaction, so searches see either the old or the new version of the file and the
+        write lock is held only for the writes; memory use grows with the changed chunks, whose
+        vectors are held until then. A file without stored records is streamed in with `bulk_insert`.
+
+        :param filename: Name of the file
+        :param chunks: Iterable of (vector, text[, metadata[, pages]]) tuples of the new version; the
+            vector may be None for a text already stored for the file (see `file_hashes`)
+        :param batch_size: See `bulk_insert`
+        :return: Statistics of `bulk_insert`, plus the number of `kept`, `updated` and `deleted` records
+        """
+        if not self.file_hashes(filename):
+            stats = self.bulk_insert(((chunk[0], filename, *chunk[1:]) for chunk in chunks), batch_size)
+            stats.update(kept=0, updated=0, deleted=0)
+            return stats
+
+        chunks = list(chunks)
+        with self._lock:
+            if self._ids is None:
+                self._load_matrix()
+            with self._write() as cur:
+                cur.execute(
+                    f"SELECT content_hash, id, page_start, page_end, metadata FROM {self.collection_name} "
+                    f"WHERE filename = ?", (filename,)
+                )
+                stored = {row[0]: row[1:] for row in cur.fetchall()}
+                kept = set()
+                updates = []
+                new = []
+                for chunk in chunks:
+                    chunk_hash = content_hash(chunk[1])
+                    if chunk_hash not in stored:
+                        if chunk[0] is None:
+                            raise ValueError(f"A new chunk of {filename} has no vector")
+                        new.append((chunk[0], filename, *chunk[1:]))
+                    elif chunk_hash not in kept:
+                        kept.add(chunk_hash)
+                        row_id, page_start, page_end, metadata = stored[chunk_hash]
+                        new_metadata = json.dumps(chunk[2]) if len(chunk) > 2 and chunk[2] else None
+                        new_pages = tuple(chunk[3]) if len(chunk) > 3 and chunk[3] else (None, None)
+                        if (page_start, page_end) != new_pages or metadata != new_metadata:
+                            updates.append((*new_pages, new_metadata, row_id))
+
+                cur.executemany(
+                    f"UPDATE {self.collection_name} SET page_start = ?, page_end = ?, metadata = ? WHERE id = ?",
+                    updates,
+                )
+                removed = [stored[chunk_hash][0] for chunk_hash in stored if chunk_hash not in kept]
+                for start in range(0, len(removed), 900):
+                    part = removed[start:start + 900]
+                    cur.execute(f"DELETE FROM {self.collection_name} WHERE id IN ({', '.join('?' * len(part))})", part)
+                removed_ids = np.array(removed, dtype=np.int64)
+                self.connections.after_commit(lambda: self._tombstone(removed_ids))
+                self.connections.after_commit(lambda: self._compact_if_needed(len(removed_ids)))
+                stats = self.bulk_insert(new, batch_size)
+
+        stats.update(kept=len(kept), updated=len(updates), deleted=len(removed))
+        return stats
+
+    def compact(self, vacuum_pages: int = None) -> dict:
+        """
+        Reclaims the space of deleted records: drops tombstoned positions from the loaded matrix
+        and the search backend, rewrites the sidecar file without them (memmap storage) and
+        returns free database pages to the file system with an incremental VACUUM. With sqlite
+        storage searches only wait for the in-memory swap; with memmap storage they also wait
+        while the sidecar is rewritten.
+
+        :param vacuum_pages: Maximum number of free pages to release, default all of them
+        :return: Statistics: tombstones (positions dropped from memory), sidecar_bytes and
+            pages (space released)
+        """
+        stats = {"tombstones": 0, "sidecar_bytes": 0, "pages": 0}
+        old_sidecar = None
+        with self._lock:
+            if self.storage == "memmap":
+                old_sidecar, stats["sidecar_bytes"] = self._rewrite_sidecar()
+            if self._ids is not None:
+                keep = self._ids >= 0
+                stats["tombstones"] = int(len(keep) - np.count_nonzero(keep))
+                if self.storage == "memmap":
+                    # offsets changed: remap the new sidecar
+                    self._load_matrix()
+                elif stats["tombstones"]:
+                    if self._matrix is not None:
+                        self._matrix = self._matrix[keep]
+                    self._ids = self._ids[keep]
+                    # the next append moves the compacted arrays into new buffers, and the next
+                    # snapshot writes the matrix to a new file
+                    self._matrix_buffer = self._ids_buffer = None
+                    self._snapshot_matrix = None
+                    self.index.compact(self)
+        if old_sidecar is not None and os.path.exists(old_sidecar):
+            os.remove(old_sidecar)
+
+        with self.connections.maintenance() as cur:
+            free_pages = cur.execute("PRAGMA freelist_count").fetchone()[0]
+            if cur.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                # databases created before incremental auto-vacuum need one full VACUUM to switch
+                cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                cur.execute("VACUUM")
+            else:
+                # executescript steps the pragma to completion; execute would release a single page
+                cur.executescript(f"PRAGMA incremental_vacuum({vacuum_pages or 0});")
+            stats["pages"] = free_pages - cur.execute("PRAGMA freelist_count").fetchone()[0]
+            if not self.connections.in_memory:
+                cur.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return stats
+
+    def compact_in_background(self) -> threading.Thread:
+        """
+        Runs `compact` in a daemon thread, unless a compaction is already running.
+
+        :return: The compaction thread
+        """
+        with self._lock:
+            if self._compaction is None or not self._compaction.is_alive():
+                self._compaction = threading.Thread(target=self.compact, name="vectordb-compact", daemon=True)
+                self._compaction.start()
+            return self._compaction
+
+    def _rewrite_sidecar(self) -> Tuple[str, int]:
+        """
+        Copies the vectors of the remaining rows into a new sidecar file, in id order, and points
+        the rows and the collection at it in one transaction. A crash before the commit leaves
+        the old file in use; the new one is only an orphan.
+
+        :return: (path of the replaced sidecar file, number of bytes released)
+        """
+        with self._write() as cur:
+            dim = self._get_meta("dim")
+            sidecar = self._open_sidecar()
+            if dim is None or sidecar is None:
+                return None, 0
+            cur.execute(f"SELECT id, row_offset FROM {self.collection_name} ORDER BY id")
+            rows = cur.fetchall()
+            if len(rows) == len(sidecar):
+                return None, 0
+
+            generation = int(self._get_meta("sidecar_generation", 0)) + 1
+            new_path = self._sidecar_file(generation)
+            with open(new_path, "wb") as file:
+                for start in range(0, len(rows), self.block_size):
+                    offsets = [offset for _, offset in rows[start:start + self.block_size]]
+                    file.write(np.asarray(sidecar[offsets]).astype("<f4", copy=False).tobytes())
+                file.flush()
+                os.fsync(file.fileno())
+            cur.executemany(
+                f"UPDATE {self.collection_name} SET row_offset = ? WHERE id = ?",
+                [(offset, row_id) for offset, (row_id, _) in enumerate(rows)],
+            )
+            self._set_meta("sidecar_generation", generation)
+        return sidecar.filename, (len(sidecar) - len(rows)) * int(dim) * 4
+
+    def _close(self):
+        """
+        Waits for a running background compaction, saves the snapshot, then closes the connections.
+
         :return:
         """
-        self._insert_data(self.collection_name, data)
+        if self._compaction is not None:
+            self._compaction.join()
+        self.save_snapshot()
+        super()._close()
+
+    def _materialize(self, ids: List[int], scores: List[float]) -> List[SearchResult]:
+        """
+        Fetches filename, text and metadata of the final results in one `WHERE id IN (...)` query,
+        so the scoring pass never has to read more than ids and vectors.
+
+        :param ids: Row ids of the results, best first
+        :param scores: Cosine similarity of every result
+        :return: Results in the same order as `ids`
+        """
+        rows = {}
+        for start in range(0, len(ids), 900):
+            chunk = ids[start:start + 900]
+            placeholders = ", ".join("?" * len(chunk))
+            with self._read() as cur:
+                cur.execute(
+                    f"SELECT id, filename, text_content, created_at, metadata, page_start, page_end "
+                    f"FROM {self.collection_name} "
+                    f"WHERE id IN ({placeholders})", chunk
+                )
+                rows.update((row[0], row) for row in cur.fetchall())
+
+        results = []
+        for row_id, score in zip(ids, scores):
+            if row_id in rows:
+                _, filename, text_content, created_at, metadata, page_start, page_end = rows[row_id]
+                results.append(SearchResult(row_id, float(score), filename, text_content, created_at,
+                                            json.loads(metadata) if metadata else {}, page_start, page_end))
+        return results
+
+    def _vectors(self, positions: np.ndarray) -> np.ndarray:
+        """
+        Returns the normalized vectors at the given positions, from the resident matrix or the
+        memory-mapped sidecar, or fetched from the table by id when no matrix is kept in memory.
 
-    def search(self, query: np.array, top_k: int = 3):
+        :param positions: Positions of the rows
+        :return: 2D float32 array, one row per position
+        """
+        if self._matrix is not None:
+            return np.asarray(self._matrix[positions])
+
+        ids = self._ids[positions].tolist()
+        if not ids:
+            return np.empty((0, 0), dtype=np.float32)
+        by_id = {}
+        with self._read() as cur:
+            for start in range(0, len(ids), 900):
+                chunk = ids[start:start + 900]
+                placeholders = ", ".join("?" * len(chunk))
+                cur.execute(f"SELECT id, arr FROM {self.collection_name} WHERE id IN ({placeholders})", chunk)
+                by_id.update(cur.fetchall())
+        return normalize_rows(np.stack([by_id[i] for i in ids]))
+
+    def _vector_blocks(self):
+        """
+        Yields (start position, normalized vectors) for consecutive blocks of at most `block_size` rows.
+        Without a matrix in memory the blocks are read from the table by id range.
+        """
+        n = len(self._ids)
+        for start in range(0, n, self.block_size):
+            end = min(start + self.block_size, n)
+            if self._matrix is not None:
+                yield start, np.asarray(self._matrix[start:end])
+                continue
+            # tombstoned positions (id -1) have no row any more and are left as zero vectors
+            block_ids = self._ids[start:end]
+            live = block_ids[block_ids >= 0]
+            if len(live) == 0:
+                continue
+            with self._read() as cur:
+                cur.execute(
+                    f"SELECT id, arr FROM {self.collection_name} WHERE id BETWEEN ? AND ? ORDER BY id",
+                    (int(live[0]), int(live[-1])),
+                )
+                rows = cur.fetchall()
+            vectors = normalize_rows(np.stack([row[1] for row in rows]))
+            positions = positions_of(block_ids, np.array([row[0] for row in rows], dtype=np.int64))
+            block = np.zeros((end - start, vectors.shape[1]), dtype=np.float32)
+            block[positions[positions >= 0]] = vectors[positions >= 0]
+            yield start, block
+
+    def _score_blocks(self, query: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Scores the stored vectors block by block, keeping only the running top-k of each block,
+        so temporary memory stays bounded by `block_size` even for a memory-mapped corpus.
+
+        :param query: Normalized query vector
+        :param top_k: Number of positions to return
+        :return: (positions, cosine similarities) of the best rows, best first
+        """
+        n = len(self._ids)
+        if n <= self.block_size and self._matrix is not None:
+            scores = np.asarray(self._matrix) @ query
+            scores[self._ids[:n] < 0] = -np.inf
+            top = top_k_indices(scores, top_k)
+            return top, scores[top]
+
+        best_positions = []
+        best_scores = []
+        for start, block in self._vector_blocks():
+            scores = block @ query
+            scores[self._ids[start:start + len(block)] < 0] = -np.inf
+            top = top_k_indices(scores, top_k)
+            best_positions.append(top + start)
+            best_scores.append(scores[top])
+
+        positions = np.concatenate(best_positions)
+        scores = np.concatenate(best_scores)
+        top = top_k_indices(scores, top_k)
+        return positions[top], scores[top]
+
+    def _score_blocks_many(self, queries: np.ndarray, top_k: int,
+                           query_block: int = 64) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Batched brute-force scoring: every block of vectors is read once and scored against a block
+        of queries with one matrix-matrix product. Temporary memory is bounded by
+        query_block x block_size scores.
+
+        :param queries: 2D array of normalized query vectors
+        :param top_k: Number of positions to return per query
+        :param query_block: Number of queries scored together
+        :return: Per query, (positions, cosine similarities) of the best rows, best first
+        """
+        k = min(top_k, len(self._ids))
+        best_positions = np.zeros((len(queries), 0), dtype=np.int64)
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        for start, block in self._vector_blocks():
+            valid = self._ids[start:start + len(block)] >= 0
+            block_positions = []
+            block_scores = []
+            for q_start in range(0, len(queries), query_block):
+                scores = queries[q_start:q_start + query_block] @ block.T
+                scores[:, ~valid] = -np.inf
+                top = np.argpartition(-scores, min(k, scores.shape[1]) - 1, axis=1)[:, :k]
+                block_positions.append(top + start)
+                block_scores.append(np.take_along_axis(scores, top, axis=1))
+            positions = np.concatenate([best_positions, np.concatenate(block_positions)], axis=1)
+            scores = np.concatenate([best_scores, np.concatenate(block_scores)], axis=1)
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            best_positions = np.take_along_axis(positions, top, axis=1)
+            best_scores = np.take_along_axis(scores, top, axis=1)
+
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        best_positions = np.take_along_axis(best_positions, order, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        return [
+            (positions[np.isfinite(scores)], scores[np.isfinite(scores)])
+            for positions, scores in zip(best_positions, best_scores)
+        ]
+
+    def _filter_clause(self, filters: dict) -> Tuple[str, List]:
+        """
+        Translates structured search filters into a SQL condition with bound parameters.
+
+        :param filters: Dict with any of:
+            "filenames": iterable of filenames a record must belong to;
+            "created_after" / "created_before": datetime or 'YYYY-MM-DD HH:MM:SS' bounds (inclusive, UTC);
+            "metadata": dict of key/values the record's metadata must contain;
+            "text": free text, of which a record must contain at least one word (full-text index);
+            "ids": iterable of row ids a record must be one of.
+        :return: (condition, params)
+        """
+        clauses = []
+        params = []
+        if filters.get("filenames") is not None:
+            filenames = list(filters["filenames"])
+            clauses.append(f"filename IN ({', '.join('?' * len(filenames))})" if filenames else "0")
+            params += filenames
+        for key, operator in (("created_after", ">="), ("created_before", "<=")):
+            value = filters.get(key)
+            if value is not None:
+                if isinstance(value, datetime):
+                    value = value.strftime("%Y-%m-%d %H:%M:%S")
+                clauses.append(f"created_at {operator} ?")
+                params.append(value)
+        for key, value in (filters.get("metadata") or {}).items():
+            clauses.append("json_extract(metadata, ?) = ?")
+            params += [f'$."{key}"', value]
+        if filters.get("text") is not None:
+            match = fts_query(filters["text"])
+            fts = f"{self.collection_name}_fts"
+            clauses.append(f"id IN (SELECT rowid FROM {fts} WHERE {fts} MATCH ?)" if match else "0")
+            params += [match] if match else []
+        if filters.get("ids") is not None:
+            ids = [int(row_id) for row_id in filters["ids"]]
+            clauses.append(f"id IN ({', '.join('?' * len(ids))})" if ids else "0")
+            params += ids
+        unknown = set(filters) - {"filenames", "created_after", "created_before", "metadata", "text", "ids"}
+        if unknown:
+            raise ValueError(f"Unknown search filters: {', '.join(sorted(unknown))}")
+        return " AND ".join(clauses) or "1", params
+
+    def _search_filtered(self, query: np.ndarray, top_k: int, filters: dict) -> Tuple[List[int], List[float]]:
+        """
+        Exact search restricted to the records matching the filters. The filters run in SQLite
+        (using the filename/created_at indexes) and only the matching rows' vectors are scored,
+        read in batches of `block_size`.
+
+        :param query: Normalized query vector
+        :param top_k: Number of ids to return
+        :param filters: See `_filter_clause`
+        :return: (ids, cosine similarities) of the best matching records, best first
+        """
+        condition, params = self._filter_clause(filters)
+        with self._lock, self._read() as cursor:
+            if self.storage == "memmap":
+                sidecar = self._open_sidecar()
+                vector_column = "row_offset"
+            elif self._matrix is not None:
+                vector_column = "NULL"
+            else:
+                vector_column = "arr"
+
+            cursor.execute(
+                f"SELECT id, {vector_column} FROM {self.collection_name} WHERE {condition} ORDER BY id", params
+            )
+            best_ids = []
+            best_scores = []
+            while True:
+                rows = cursor.fetchmany(self.block_size)
+                if not rows:
+                    break
+                ids = np.array([row[0] for row in rows], dtype=np.int64)
+                if self.storage == "memmap":
+                    vectors = np.asarray(sidecar[[row[1] for row in rows]])
+                elif vector_column == "NULL":
+                    positions = positions_of(self._ids, ids)
+                    if (positions < 0).any():
+                        # written by another connection since the matrix was loaded
+                        self._sync()
+                        positions = positions_of(self._ids, ids)
+                    vectors = self._matrix[positions]
+                else:
+                    vectors = normalize_rows(np.stack([row[1] for row in rows]))
+                scores = vectors @ query
+                top = top_k_indices(scores, top_k)
+                best_ids.append(ids[top])
+                best_scores.append(scores[top])
+
+        if not best_ids:
+            return [], []
+        ids = np.concatenate(best_ids)
+        scores = np.concatenate(best_scores)
+        top = top_k_indices(scores, top_k)
+        return ids[top].tolist(), scores[top].tolist()
+
+    def _search_ids(self, query: np.ndarray, top_k: int, exact: bool = False,
+                    filters: dict = None) -> Tuple[List[int], List[float]]:
+        """
+        Vector search without materializing the results, see `search`.
+
+        :return: (ids, cosine similarities) of the best records, best first
+        """
+        query = normalize_rows(np.asarray(query).reshape(1, -1))[0]
+        if filters:
+            return self._search_filtered(query, top_k, filters)
+
+        with self._lock:
+            if self._ids is None:
+                self._load_matrix()
+            if len(self._ids) == 0:
+                return [], []
+            if self.index.trained and not exact:
+                positions, scores = self.index.search(self, query, top_k)
+            else:
+                positions, scores = self._score_blocks(query, top_k)
+            ids = self._ids[positions]
+        return ids[ids >= 0].tolist(), scores[ids >= 0].tolist()
+
+    def search(self, query: np.array, top_k: int = 3, exact: bool = False,
+               filters: dict = None) -> List[SearchResult]:
         """
         Searches for the top-k most similar records in the collection based on their cosine similarity.
 
+        Scores every stored vector with matrix-vector products against the resident matrix (or the
+        memory-mapped sidecar, block by block) and selects the best ones with argpartition. When an
+        approximate index is configured and trained, only the candidates it selects are scored.
+
         :param query: Query vector for comparing with stored data
         :param top_k: Number of similar records to return, default as 3
-        :return:
+        :param exact: Force a brute-force search even if an approximate index is configured
+        :param filters: Optional structured filters evaluated in SQL before any vector is scored,
+            e.g. {"filenames": ["report.pdf"], "created_after": "2025-01-01", "metadata": {"lang": "en"}}
+            (see `_filter_clause`); filtered searches are always exact over the matching subset
+        :return: SearchResult records, most similar first
         """
-        rows = self._query_data(self.collection_name)
+        return self._materialize(*self._search_ids(query, top_k, exact, filters))
 
-        similarities = []
-        for row in rows:
-            similarity = cosine_similarity(
-                [query],
-                [row[0]]
-            )[0][0]
-            similarities.append(similarity)
+    def _search_lexical(self, text: str, top_k: int, filters: dict = None) -> Tuple[List[int], List[float]]:
+        """
+        Full-text search ranked with BM25, see `search_lexical`.
 
-        top_indices = np.argsort(similarities)[-top_k:][::-1]
+        :return: (ids, BM25 relevance) of the best records, best first
+        """
+        match = fts_query(text)
+        if not match:
+            return [], []
+        fts = f"{self.collection_name}_fts"
+        if filters:
+            condition, params = self._filter_clause(filters)
+            sql = (f"SELECT {fts}.rowid, bm25({fts}) AS rank FROM {fts} "
+                   f"JOIN {self.collection_name} ON {self.collection_name}.id = {fts}.rowid "
+                   f"WHERE {fts} MATCH ? AND {condition} ORDER BY rank LIMIT ?")
+        else:
+            params = []
+            sql = f"SELECT rowid, rank FROM {fts} WHERE {fts} MATCH ? ORDER BY rank LIMIT ?"
+        with self._read() as cur:
+            cur.execute(sql, [match] + params + [top_k])
+            rows = cur.fetchall()
+        # FTS5's bm25() is negated so that better matches sort first
+        return [row[0] for row in rows], [-row[1] for row in rows]
+
+    def search_lexical(self, text: str, top_k: int = 3, filters: dict = None) -> List[SearchResult]:
+        """
+        Searches the collection's full-text index for records containing any word of `text`, ranked
+        with BM25, so exact identifiers, codes and rare terms are found even when their embedding
+        is not close to the query's.
+
+        :param text: Query text
+        :param top_k: Number of records to return
+        :param filters: Optional structured filters, see `search`
+        :return: SearchResult records, best first; their score is the BM25 relevance (higher is better)
+        """
+        return self._materialize(*self._search_lexical(text, top_k, filters))
+
+    def search_hybrid(self, query: np.ndarray, text: str, top_k: int = 3, candidates: int = 50, rrf_k: int = 60,
+                      prefilter: int = None, exact: bool = False, filters: dict = None) -> List[SearchResult]:
+        """
+        Combines vector and lexical search: the best `candidates` records of each are fused with
+        reciprocal rank fusion (see `reciprocal_rank_fusion`).
+
+        :param query: Query vector
+        :param text: Query text for the full-text index
+        :param top_k: Number of records to return
+        :param candidates: Number of records taken from each ranking
+        :param rrf_k: Damping constant of the fusion
+        :param prefilter: If given, only the `prefilter` best lexical matches are scored against the
+            query vector instead of the whole collection, which is much cheaper on large corpora.
+            Falls back to a full vector search when nothing matches lexically.
+        :param exact: Force a brute-force vector search, see `search`
+        :param filters: Optional structured filters, see `search`
+        :return: SearchResult records, best first; their score is the fused score
+        """
+        lexical_ids, _ = self._search_lexical(text, max(candidates, prefilter or 0), filters)
+        if prefilter and lexical_ids:
+            vector_ids, _ = self._search_ids(query, candidates, exact, {**(filters or {}), "ids": lexical_ids})
+        else:
+            vector_ids, _ = self._search_ids(query, candidates, exact, filters)
+        fused = reciprocal_rank_fusion([vector_ids, lexical_ids[:candidates]], rrf_k)[:top_k]
+        return self._materialize([row_id for row_id, _ in fused], [score for _, score in fused])
+
+    def search_many(self, queries: np.ndarray, top_k: int = 3, exact: bool = False, query_block: int = 64,
+                    filters: dict = None) -> List[List[SearchResult]]:
+        """
+        Searches for the top-k most similar records of every query in a batch. With exact search
+        the stored vectors are scanned once for the whole batch using blocked matrix-matrix products.
+
+        :param queries: 2D array of query vectors, one per row
+        :param top_k: Number of similar records to return per query
+        :param exact: Force a brute-force search even if an approximate index is configured
+        :param query_block: Number of queries scored together in the brute-force scan
+        :param filters: Optional structured filters, see `search`
+        :return: Per query, SearchResult records, most similar first
+        """
+        queries = normalize_rows(np.atleast_2d(np.asarray(queries)))
+        if filters:
+            return [self._materialize(*self._search_filtered(query, top_k, filters)) for query in queries]
+
+        with self._lock:
+            if self._ids is None:
+                self._load_matrix()
+            if len(self._ids) == 0:
+                return [[] for _ in queries]
+            if self.index.trained and not exact:
+                found = self.index.search_many(self, queries, top_k)
+            else:
+                found = self._score_blocks_many(queries, top_k, query_block)
+            found = [(self._ids[positions], scores) for positions, scores in found]
+
+        # one materialization query for the whole batch
+        unique_ids = np.unique(np.concatenate([ids for ids, _ in found]))
+        unique_ids = unique_ids[unique_ids >= 0].tolist()
+        by_id = {result.id: result for result in self._materialize(unique_ids, [0.0] * len(unique_ids))}
+
+        results = []
+        for ids, scores in found:
+            results.append([
+                by_id[row_id]._replace(score=float(score))
+                for row_id, score in zip(ids.tolist(), scores.tolist()) if row_id in by_id
+            ])
+        return results
+
+    def recall_check(self, queries: np.ndarray, top_k: int = 10) -> float:
+        """
+        Measures how many of the exact top-k results the configured backend returns.
+
+        :param queries: 2D array of query vectors
+        :param top_k: Number of results compared per query
+        :return: Recall@k between 0 and 1
+        """
+        hits = 0
+        total = 0
+        for query in queries:
+            exact = {result.id for result in self.search(query, top_k, exact=True)}
+            found = {result.id for result in self.search(query, top_k)}
+            hits += len(exact & found)
+            total += len(exact)
+        return hits / total if total else 1.0
 
-        top_docs = []
-        for idx in top_indices:
-            top_docs.append(rows[idx])
 
-        return top_docs
+if __name__ == "__main__":
+    # One-shot migration of an existing database: python sqlite_DB.py midterm.db [collection] [vector|halfvector]
+    db_path = sys.argv[1] if len(sys.argv) > 1 else "midterm.db"
+    collection = sys.argv[2] if len(sys.argv) > 2 else "vectors"
+    target_type = sys.argv[3] if len(sys.argv) > 3 else "vector"
+    vector_db = VectorDB(db=db_path, collection_name=collection)
+    count = vector_db.migrate_storage(target_type)
+    print(f"Migrated {count} rows of '{collection}' to {target_type} storage")
+    vector_db._close()
@@ -0,0 +1,60 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from Midterm import embedding_cache
+from Midterm.embedding_cache import EmbeddingCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # every call is a later time, so the order of use decides the eviction
+    ticks = itertools.count(1000)
+    monkeypatch.setattr(embedding_cache.time, "time", lambda: float(next(ticks)))
+
+
+def vector(i):
+    return np.full(4, i, dtype=np.float32)
+
+
+def test_cached_embeddings_are_found_in_memory_and_after_a_restart(tmp_path, clock):
+    path = str(tmp_path / "cache.db")
+    cache = EmbeddingCache(path, hot_entries=2)
+    try:
+        cache.put_many("model", 0, {f"h{i}": vector(i) for i in range(3)})
+        found = cache.get_many("model", 0, ["h0", "h2", "h0", "missing"])
+        assert sorted(found) == ["h0", "h2"]
+        assert np.array_equal(found["h0"], vector(0)) and np.array_equal(found["h2"], vector(2))
+        # h0 was pushed out of the two hot entries and read from the file
+        assert (cache.hot_hits, cache.disk_hits, cache.misses) == (1, 1, 1)
+        # models and dimensions have their own entries
+        assert cache.get_many("model", 256, ["h0"]) == {}
+        assert cache.get_many("other", 0, ["h0"]) == {}
+    finally:
+        cache._close()
+
+    cache = EmbeddingCache(path)
+    try:
+        assert cache.stats()["entries"] == 3
+        assert np.array_equal(cache.get_many("model", 0, ["h1"])["h1"], vector(1))
+    finally:
+        cache._close()
+
+
+def test_least_recently_used_embeddings_are_evicted(tmp_path, clock):
+    cache = EmbeddingCache(str(tmp_path / "cache.db"), max_entries=10, hot_entries=4)
+    try:
+        for i in range(10):
+            cache.put_many("model", 0, {f"h{i}": vector(i)})
+        # a lookup counts as a use: h0 and h1 become the most recently used
+        assert len(cache.get_many("model", 0, ["h0", "h1"])) == 2
+        cache.put_many("model", 0, {"new": vector(10)})
+
+        # 11 entries evict down to 9, the least recently used first
+        assert cache.stats()["entries"] == 9
+        assert cache.evictions == 2
+        assert sorted(cache.get_many("model", 0, [f"h{i}" for i in range(10)] + ["new"])) == \
+            sorted(["h0", "h1", "new"] + [f"h{i}" for i in range(4, 10)])
+    finally:
+        cache._close()
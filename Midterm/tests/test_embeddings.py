@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+from openai import AsyncOpenAI, OpenAI
+
+from Midterm.benchmark import stand_in_embeddings_server
+from Midterm.Helpers.embeddings import AsyncEmbeddingPipeline, EmbeddingBatcher
+
+TEXTS = [f"chunk {i}: " + "lorem ipsum " * (i % 7 + 1) for i in range(50)]
+
+
+def stand_in(**options):
+    server = stand_in_embeddings_server(0.0, 8, **options)
+    return server, f"http://127.0.0.1:{server.server_port}/v1"
+
+
+@pytest.fixture
+def server():
+    server, base_url = stand_in()
+    yield base_url
+    server.shutdown()
+
+
+def one_by_one(base_url, texts):
+    return EmbeddingBatcher(OpenAI(api_key="test", base_url=base_url), max_items=1).embed(texts)
+
+
+def test_batches_respect_item_and_token_limits(server):
+    client = OpenAI(api_key="test", base_url=server)
+    expected = one_by_one(server, TEXTS)
+
+    batcher = EmbeddingBatcher(client, max_items=16)
+    assert np.array_equal(batcher.embed(TEXTS), expected)
+    assert batcher.requests == 4
+
+    batcher = EmbeddingBatcher(client, max_items=512, max_tokens=100)
+    batches = list(batcher._batches(TEXTS))
+    assert sum(batches, []) == TEXTS
+    assert all(sum(map(batcher.count_tokens, batch)) <= 100 for batch in batches)
+    assert np.array_equal(batcher.embed(TEXTS), expected)
+    assert batcher.requests == len(batches) > 1
+
+
+def test_rejected_batches_are_split(server):
+    limited, base_url = stand_in(max_items=8)
+    try:
+        batcher = EmbeddingBatcher(OpenAI(api_key="test", base_url=base_url, max_retries=0), max_items=50)
+        assert np.array_equal(batcher.embed(TEXTS), one_by_one(server, TEXTS))
+        # 50 -> 25 -> 12/13 -> 6/7, and every batch on the way costs a request
+        assert batcher.splits == 7
+        assert batcher.requests == 15
+    finally:
+        limited.shutdown()
+
+
+def test_pipeline_keeps_order_and_retries_failed_requests(server):
+    flaky, base_url = stand_in(failure_rate=0.3)
+    pipeline = AsyncEmbeddingPipeline(AsyncOpenAI(api_key="test", base_url=base_url), max_items=4,
+                                      concurrency=4, max_retries=20, base_delay=0.01, max_delay=0.05)
+    try:
+        # the stand-in draws its failures from numpy's global generator; this seed fails the third request
+        np.random.seed(1)
+        assert np.array_equal(pipeline.embed(TEXTS), one_by_one(server, TEXTS))
+        assert pipeline.retries > 0
+        assert pipeline.requests == 13 + pipeline.retries
+    finally:
+        pipeline.close()
+        flaky.shutdown()
+    assert pipeline._loop is None
+
+
+def test_pipeline_cancels_unconsumed_requests(server):
+    pipeline = AsyncEmbeddingPipeline(AsyncOpenAI(api_key="test", base_url=server), max_items=1, concurrency=2)
+    try:
+        embeddings = pipeline.embed_iter(TEXTS)
+        next(embeddings)
+        embeddings.close()
+        # at most the batches in flight when the caller stopped were requested
+        assert pipeline.requests <= 4
+    finally:
+        pipeline.close()
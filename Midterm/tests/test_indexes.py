@@ -0,0 +1,71 @@
+import numpy as np
+
+from Midterm.sqlite_DB import VectorDB
+
+
+def clustered_vectors(n, dim, seed=0, scale=None):
+    # embeddings cluster by topic; uniform random vectors would make every index look bad
+    rng = np.random.default_rng(seed)
+    centers = np.random.default_rng(0).normal(size=(32, dim))
+    vectors = centers[rng.integers(0, len(centers), n)] + 0.4 * rng.normal(size=(n, dim))
+    return (vectors if scale is None else vectors * scale).astype(np.float32)
+
+
+def check_backend(tmp_path, index, index_params, min_recall, n=2000, dim=32, scale=None):
+    path = str(tmp_path / f"{index}.db")
+    vectors = clustered_vectors(n, dim, scale=scale)
+    queries = clustered_vectors(20, dim, seed=1, scale=scale)
+    # the last quarter of the rows belongs to a file that is deleted again
+    deleted_from = 3 * n // 4
+
+    db = VectorDB(db=path, collection_name="vectors", index=index, index_params=index_params)
+    try:
+        db.bulk_insert((vector, "a.txt" if i < deleted_from else "b.txt", f"chunk {i}")
+                       for i, vector in enumerate(vectors))
+        db.load()
+        assert db.index.trained
+        assert db.recall_check(queries) >= min_recall
+        before = [[result.id for result in db.search(query, top_k=10)] for query in queries]
+    finally:
+        db._close()
+
+    # restarted from the snapshot, and from the tables alone
+    for snapshot in (True, False):
+        db = VectorDB(db=path, collection_name="vectors", index=index, index_params=index_params, snapshot=snapshot)
+        try:
+            db.load()
+            assert [[result.id for result in db.search(query, top_k=10)] for query in queries] == before
+        finally:
+            db._close()
+
+    db = VectorDB(db=path, collection_name="vectors", index=index, index_params=index_params, compact_threshold=None)
+    try:
+        db.delete("b.txt")
+        assert db.compact()["tombstones"] == n - deleted_from
+        assert len(db._ids) == deleted_from
+        assert db.recall_check(queries) >= min_recall
+        assert all(result.id <= deleted_from for query in queries for result in db.search(query, top_k=10))
+    finally:
+        db._close()
+
+
+def test_ivf_recall_and_persistence(tmp_path):
+    check_backend(tmp_path, "ivf", {"n_lists": 32, "nprobe": 8}, min_recall=0.9)
+
+
+def test_hnsw_recall_and_persistence(tmp_path):
+    check_backend(tmp_path, "hnsw", {"M": 8, "ef_construction": 64, "ef_search": 64}, min_recall=0.9, n=800)
+
+
+def test_scalar_quantized_recall_and_persistence(tmp_path):
+    check_backend(tmp_path, "sq8", {"rerank": 50}, min_recall=0.95)
+
+
+def test_product_quantized_recall_and_persistence(tmp_path):
+    check_backend(tmp_path, "pq", {"m": 8, "rerank": 100}, min_recall=0.9)
+
+
+def test_matryoshka_recall_and_persistence(tmp_path):
+    # Matryoshka-trained embeddings carry most of their information in the leading dimensions
+    scale = np.exp(-np.arange(64) / 16)
+    check_backend(tmp_path, "matryoshka", {"coarse_dim": 16, "candidates": 100}, min_recall=0.9, dim=64, scale=scale)
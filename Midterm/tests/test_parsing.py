@@ -0,0 +1,59 @@
+import os
+
+import PyPDF2
+import pytest
+from openai import OpenAI
+
+from Midterm.benchmark import stand_in_embeddings_server
+from Midterm.Helpers.parsing import ingest_documents
+from Midterm.sqlite_DB import VectorDB
+
+
+@pytest.fixture
+def client():
+    server = stand_in_embeddings_server(0.0, 16)
+    yield OpenAI(api_key="test", base_url=f"http://127.0.0.1:{server.server_port}/v1")
+    server.shutdown()
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = VectorDB(db=str(tmp_path / "ingest.db"), collection_name="vectors", snapshot=False)
+    yield db
+    db._close()
+
+
+def test_ingest_pdf_without_pages(tmp_path, client, db):
+    path = str(tmp_path / "empty.pdf")
+    with open(path, "wb") as file:
+        PyPDF2.PdfWriter().write(file)
+    progress = []
+
+    results = dict(ingest_documents(client, db, [path], max_workers=1,
+                                    progress=lambda *args: progress.append(args)))
+
+    assert "error" not in results[path]
+    assert results[path]["rows"] == 0
+    assert db.ingested_file("empty.pdf") is not None
+
+
+def test_reingestion_embeds_only_changed_chunks(tmp_path, client, db):
+    path = str(tmp_path / "notes.txt")
+    paragraphs = [" ".join(f"part{i} word{j}." for j in range(60)) for i in range(40)]
+    with open(path, "w") as file:
+        file.write("\n\n".join(paragraphs))
+    assert dict(ingest_documents(client, db, [path], max_workers=1))[path]["embedded"] == 40
+
+    # touched but unchanged: neither parsed nor embedded
+    os.utime(path, (0, 0))
+    stats = dict(ingest_documents(client, db, [path], max_workers=1))[path]
+    assert stats["file_skipped"] and stats["embedded"] == 0
+
+    paragraphs[20] = paragraphs[20].replace("word5.", "changed.")
+    with open(path, "w") as file:
+        file.write("\n\n".join(paragraphs))
+    stats = dict(ingest_documents(client, db, [path], max_workers=1))[path]
+    assert (stats["embedded"], stats["kept"], stats["deleted"], stats["requests"]) == (1, 39, 1, 1)
+    with db._read() as cur:
+        cur.execute("SELECT text_content FROM vectors WHERE text_content LIKE '%part20 word4.%'")
+        assert ["part20 changed." in text for text, in cur.fetchall()] == [True]
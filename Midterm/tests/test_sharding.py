@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from Midterm.sharding import ShardedVectorDB, split_id
+from Midterm.sqlite_DB import VectorDB
+
+
+def found(results):
+    return [(result.filename, result.text_content, round(result.score, 5)) for result in results]
+
+
+@pytest.mark.parametrize("routing", ["hash", "size"])
+def test_sharded_search_matches_unsharded_search(tmp_path, routing):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(600, 16)).astype(np.float32)
+    queries = rng.normal(size=(10, 16)).astype(np.float32)
+    # grouped by file, as ingestion writes them, so size routing fills one shard after the other
+    records = [(vector, f"{i // 50}.txt", f"chunk {i}") for i, vector in enumerate(vectors)]
+
+    db = VectorDB(db=str(tmp_path / "plain.db"), collection_name="vectors", snapshot=False)
+    sharded = ShardedVectorDB(str(tmp_path / "sharded.db"), "vectors", shards=3, routing=routing,
+                              max_shard_rows=150, snapshot=False)
+    try:
+        db.bulk_insert(records)
+        sharded.bulk_insert(records)
+        assert len({split_id(result.id)[0] for result in sharded.search(queries[0], top_k=50)}) > 1
+
+        for filters in (None, {"filenames": ["1.txt", "5.txt"]}):
+            for query in queries:
+                assert (found(sharded.search(query, top_k=10, filters=filters))
+                        == found(db.search(query, top_k=10, filters=filters)))
+            assert ([found(results) for results in sharded.search_many(queries, top_k=10, filters=filters)]
+                    == [found(results) for results in db.search_many(queries, top_k=10, filters=filters)])
+
+        assert sharded.delete("3.txt") == db.delete("3.txt") == 50
+        for query in queries:
+            assert found(sharded.search(query, top_k=10)) == found(db.search(query, top_k=10))
+    finally:
+        db._close()
+        sharded._close()
@@ -0,0 +1,229 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+from Midterm.sqlite_DB import VectorDB, content_hash, reciprocal_rank_fusion
+
+
+def test_open_legacy_db_with_duplicate_chunks(tmp_path):
+    # a database written before content hashes existed, with the same file uploaded twice
+    path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(path)
+    conn.execute('''
+    CREATE TABLE vectors (
+        arr array NOT NULL,
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        filename TEXT NOT NULL,
+        text_content TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+    rows = [(np.full(4, i + 1, dtype=np.float32).tobytes(), "report.pdf", f"chunk {i}") for i in range(3)]
+    conn.executemany("INSERT INTO vectors (arr, filename, text_content) VALUES (?, ?, ?)", rows * 2)
+    conn.commit()
+    conn.close()
+
+    db = VectorDB(db=path, collection_name="vectors", snapshot=False)
+    try:
+        with db._read() as cur:
+            cur.execute("SELECT id, content_hash FROM vectors ORDER BY id")
+            hashes = dict(cur.fetchall())
+        assert [hashes[i] for i in (1, 2, 3)] == [content_hash(f"chunk {i}") for i in range(3)]
+        assert [hashes[i] for i in (4, 5, 6)] == [None, None, None]
+        assert len(db.search(np.ones(4, dtype=np.float32), top_k=6)) == 6
+    finally:
+        db._close()
+
+
+def test_failed_replace_leaves_search_state_unchanged(tmp_path):
+    db = VectorDB(db=str(tmp_path / "replace.db"), collection_name="vectors", snapshot=False)
+    try:
+        vectors = np.eye(8, dtype=np.float32)
+        db.insert([(vectors[i], "a.txt", f"chunk {i}") for i in range(3)])
+        db.load()
+
+        def chunks():
+            yield vectors[3], "new chunk"
+            raise RuntimeError("embedding failed")
+
+        with pytest.raises(RuntimeError):
+            db.replace("a.txt", chunks())
+
+        # the rollback kept the old version of the file, and it is still searchable
+        assert [result.id for result in db.search(vectors[0], top_k=1)] == [1]
+        assert sorted(db._ids.tolist()) == [1, 2, 3]
+
+        # the id of the rolled back row is reused, for a row with a different vector
+        db.insert([(vectors[4], "b.txt", "other chunk")])
+        assert [(result.id, result.text_content) for result in db.search(vectors[4], top_k=1)] == [(4, "other chunk")]
+        assert db.search(vectors[3], top_k=1)[0].score < 0.5
+    finally:
+        db._close()
+
+
+def test_inserts_grow_the_resident_matrix_in_place(tmp_path):
+    db = VectorDB(db=str(tmp_path / "grow.db"), collection_name="vectors", snapshot=False)
+    try:
+        vectors = np.random.default_rng(0).normal(size=(40, 16)).astype(np.float32)
+        db.insert([(vectors[0], "a.txt", "chunk 0")])
+        db.load()
+        for i in range(1, 40):
+            buffer = db._matrix_buffer
+            db.insert([(vectors[i], "a.txt", f"chunk {i}")])
+            # the buffer is only reallocated when it is full, i.e. whenever its size doubles
+            assert db._matrix_buffer is buffer or len(db._matrix_buffer) == 2 * i
+        assert db._matrix.base is db._matrix_buffer and db._ids.base is db._ids_buffer
+        assert db._ids.tolist() == list(range(1, 41))
+        for i in (0, 17, 39):
+            assert db.search(vectors[i], top_k=1)[0].text_content == f"chunk {i}"
+    finally:
+        db._close()
+
+
+def test_snapshot_appends_only_new_rows(tmp_path):
+    path = str(tmp_path / "snapshot.db")
+    vectors = np.random.default_rng(0).normal(size=(30, 16)).astype(np.float32)
+    db = VectorDB(db=path, collection_name="vectors")
+    try:
+        db.insert([(vectors[i], "a.txt", f"chunk {i}") for i in range(20)])
+        db.load()
+        matrix_file = db._read_snapshot_manifest()["files"]["matrix"]
+        with open(matrix_file, "rb") as file:
+            written = file.read()
+        db.insert([(vectors[i], "b.txt", f"chunk {i}") for i in range(20, 30)])
+        assert db.save_snapshot()
+        # the same file, with the new rows after the ones already written
+        assert db._read_snapshot_manifest()["files"]["matrix"] == matrix_file
+        with open(matrix_file, "rb") as file:
+            assert file.read(len(written)) == written
+            assert len(file.read()) == 10 * 16 * 4
+    finally:
+        db._close()
+
+    db = VectorDB(db=path, collection_name="vectors")
+    try:
+        db.load()
+        assert isinstance(db._matrix, np.memmap) and db._matrix.shape == (30, 16)
+        for i in (0, 25):
+            assert db.search(vectors[i], top_k=1)[0].text_content == f"chunk {i}"
+        # compaction drops rows, so the next snapshot starts a new file
+        db.delete("b.txt")
+        db.compact()
+        assert db.save_snapshot()
+        assert db._read_snapshot_manifest()["files"]["matrix"] != matrix_file
+    finally:
+        db._close()
+
+
+def test_replace_starts_compaction_once_committed(tmp_path):
+    db = VectorDB(db=str(tmp_path / "compact.db"), collection_name="vectors", snapshot=False, compact_threshold=0.25)
+    try:
+        vectors = np.eye(8, dtype=np.float32)
+        db.insert([(vectors[i], "a.txt", f"chunk {i}") for i in range(4)])
+        db.load()
+
+        db.replace("a.txt", ((vectors[i], f"new chunk {i}") for i in range(4, 8)))
+
+        # half of the positions were tombstoned by the replace
+        assert db._compaction is not None
+        db._compaction.join()
+        assert db._ids.tolist() == [5, 6, 7, 8]
+        assert db.search(vectors[5], top_k=1)[0].text_content == "new chunk 5"
+    finally:
+        db._close()
+
+
+def test_snapshot_is_rebuilt_for_other_index_params(tmp_path):
+    path = str(tmp_path / "params.db")
+    vectors = np.random.default_rng(0).normal(size=(400, 8)).astype(np.float32)
+    db = VectorDB(db=path, collection_name="vectors", index="ivf", index_params={"n_lists": 4, "min_train_size": 16})
+    try:
+        db.insert([(vector, "a.txt", f"chunk {i}") for i, vector in enumerate(vectors)])
+        db.load()
+    finally:
+        db._close()
+
+    db = VectorDB(db=path, collection_name="vectors", index="ivf", index_params={"n_lists": 4, "min_train_size": 16})
+    try:
+        assert db._restore_snapshot()
+    finally:
+        db._close()
+
+    db = VectorDB(db=path, collection_name="vectors", index="ivf", index_params={"n_lists": 8, "min_train_size": 16})
+    try:
+        assert not db._restore_snapshot()
+        db.load()
+        assert len(db.index.centroids) == 8
+    finally:
+        db._close()
+
+
+@pytest.mark.parametrize("storage", ["sqlite", "memmap"])
+def test_filtered_search_ranks_only_matching_records(tmp_path, storage):
+    db = VectorDB(db=str(tmp_path / "filters.db"), collection_name="vectors", storage=storage, snapshot=False)
+    try:
+        vectors = np.random.default_rng(0).normal(size=(60, 8)).astype(np.float32)
+        db.insert([(vector, f"{i % 3}.txt", f"chunk {i}", {"lang": "en" if i % 2 else "de"})
+                   for i, vector in enumerate(vectors)])
+        query = vectors[7]
+
+        results = db.search(query, top_k=5, filters={"filenames": ["1.txt"], "metadata": {"lang": "en"}})
+
+        # the exact top 5 of the rows matching both filters (ids are 1-based)
+        matching = [i for i in range(60) if i % 3 == 1 and i % 2]
+        scores = vectors[matching] @ query / np.linalg.norm(vectors[matching], axis=1) / np.linalg.norm(query)
+        expected = [matching[i] + 1 for i in np.argsort(-scores)[:5]]
+        assert [result.id for result in results] == expected
+        assert results[0].id == 8 and results[0].score == pytest.approx(1.0, abs=1e-5)
+        assert db.search(query, top_k=5, filters={"filenames": []}) == []
+        with pytest.raises(ValueError):
+            db.search(query, filters={"filename": "1.txt"})
+    finally:
+        db._close()
+
+
+def test_full_text_index_follows_inserts_updates_and_deletes(tmp_path):
+    db = VectorDB(db=str(tmp_path / "fts.db"), collection_name="vectors", snapshot=False)
+    try:
+        vectors = np.eye(4, dtype=np.float32)
+        db.insert([(vectors[0], "a.txt", "the invoice was paid by wire"),
+                   (vectors[1], "b.txt", "nothing to see here")])
+        assert [result.id for result in db.search_lexical("wire")] == [1]
+
+        with db._write() as cur:
+            cur.execute("UPDATE vectors SET text_content = 'the invoice was paid by cheque' WHERE id = 1")
+        assert db.search_lexical("wire") == []
+        assert [result.id for result in db.search_lexical("cheque")] == [1]
+
+        db.delete("a.txt")
+        assert db.search_lexical("invoice") == []
+        with db._write() as cur:
+            # raises if the external-content index disagrees with the table
+            cur.execute("INSERT INTO vectors_fts (vectors_fts) VALUES ('integrity-check')")
+    finally:
+        db._close()
+
+
+def test_reciprocal_rank_fusion_favours_items_ranked_by_both():
+    fused = reciprocal_rank_fusion([["a", "c", "b"], ["c", "b"]], k=60)
+    assert [item for item, _ in fused] == ["c", "b", "a"]
+    assert fused[0][1] == pytest.approx(1 / 62 + 1 / 61)
+
+
+def test_hybrid_search_finds_rare_terms_the_vector_ranks_low(tmp_path):
+    db = VectorDB(db=str(tmp_path / "hybrid.db"), collection_name="vectors", snapshot=False)
+    try:
+        vectors = np.array([[1, 0, 0], [1, 0.3, 0], [0.2, 1, 0]], dtype=np.float32)
+        db.insert([(vectors[0], "a.txt", "a general overview of the product"),
+                   (vectors[1], "a.txt", "error XJ-42"),
+                   (vectors[2], "a.txt", "what to do about error XJ-42 when it shows up")])
+        query = np.array([1, 0, 0], dtype=np.float32)
+
+        assert [result.id for result in db.search(query, top_k=3)] == [1, 2, 3]
+        assert [result.id for result in db.search_lexical("XJ-42", top_k=3)] == [2, 3]
+        results = db.search_hybrid(query, "XJ-42", top_k=3)
+        # the chunk ranked by both comes first, and the lexical match beats the vector-only one
+        assert [result.id for result in results] == [2, 3, 1]
+        assert results[0].score == pytest.approx(1 / 62 + 1 / 61)
+    finally:
+        db._close()
@@ -0,0 +1,50 @@
+import random
+
+import pytest
+
+from Midterm.Helpers.text import approximate_tokens, split_tokens
+
+
+def pages(count=12, seed=0):
+    # numbered words, so every word can be traced to its page; sentences, paragraphs and a few
+    # words longer than any budget
+    rng = random.Random(seed)
+    word = 0
+    for page in range(1, count + 1):
+        paragraphs = []
+        for _ in range(rng.randint(1, 4)):
+            sentences = []
+            for _ in range(rng.randint(1, 6)):
+                words = []
+                for _ in range(rng.randint(1, 25)):
+                    words.append(f"p{page}w{word}" + ("x" * 300 if rng.random() < 0.005 else ""))
+                    word += 1
+                sentences.append(" ".join(words) + rng.choice([".", "!", "?", ","]))
+            paragraphs.append(" ".join(sentences))
+        yield page, "\n\n".join(paragraphs) + "\n"
+
+
+@pytest.mark.parametrize("count_tokens", [approximate_tokens, lambda text: len(text.split())])
+def test_chunks_keep_to_the_budget_and_cover_the_text(count_tokens):
+    max_tokens, overlap_tokens = 60, 10
+    chunks = list(split_tokens(pages(), max_tokens, overlap_tokens, count_tokens))
+    words = [word for _, text in pages() for word in text.split()]
+
+    covered = []
+    for chunk in chunks:
+        chunk_words = chunk.text.split()
+        assert count_tokens(chunk.text) <= max_tokens
+        # the chunk continues the text where the previous one ended, repeating at most the overlap
+        position = words.index(chunk_words[0], max(len(covered) - overlap_tokens, 0))
+        assert position <= len(covered)
+        assert words[position:position + len(chunk_words)] == chunk_words
+        covered = words[:position + len(chunk_words)]
+        chunk_pages = {int(word[1:word.index("w")]) for word in chunk_words}
+        assert (chunk.page_start, chunk.page_end) == (min(chunk_pages), max(chunk_pages))
+    assert covered == words
+
+
+def test_long_words_are_cut_to_the_budget():
+    chunks = list(split_tokens([(1, "short " + "y" * 1000 + " end")], max_tokens=20, overlap_tokens=0))
+    assert "".join(chunk.text.replace(" ", "") for chunk in chunks) == "short" + "y" * 1000 + "end"
+    assert all(approximate_tokens(chunk.text) <= 20 for chunk in chunks)